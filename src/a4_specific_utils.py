@@ -1,18 +1,40 @@
-import sqlite3
-import folium
+import hashlib
+import os
+import re
 
+import catalog
+import db_connection
 import utils
 
 
 _GENERATED_FILES_DIR = "generated_files"
 _QUESTION_FILE_COUNTERS_LTABLE = {}
+_SHARED_QUESTION_FILE_COUNTERS = None
 
 _FOLIUM_EDMONTON_MAP_COORDS = [53.52199, -113.49099]
 _FOLIUM_AVG_RAD_SIZE = 1000
 _FOLIUM_ADDITIONAL_RAD_SIZE = 75
 
+# Maps with at least this many markers draw them as a single GeoJSON layer on a canvas (see add_markers_as_layer)
+_BULK_MARKERS_THRESHOLD = 500
+
+# Decimal places kept in the bulk layer. 5 places of latitude/longitude is about a metre.
+_BULK_COORD_DECIMALS = 5
+_BULK_RADIUS_DECIMALS = 1
+
+# Styles each point of the bulk layer from its properties: r is the radius, c the colour and p the popup
+_BULK_LAYER_ON_EACH_FEATURE_JS = """
+function (feature, layer) {
+    var props = feature.properties;
+    layer.setRadius(props.r);
+    layer.setStyle({color: props.c, fillColor: props.c});
+    layer.bindPopup(props.p);
+}
+"""
+
 _VALID_CRIME_TYPES = {}
 _NUM_NEIGHBORHOODS = -1
+_CATALOG = None
 
 
 class FolioMarker:
@@ -23,12 +45,16 @@ class FolioMarker:
         self.val = val
 
 
-def init(db_path):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
+def init(rebuild_stale_catalog=True):
+    """ Loads the valid crime types and neighborhood count of the database set in db_connection from its catalog (see
+    catalog.py), building the catalog first if it doesn't have one yet.
 
-    _get_crime_types_from_db(cur)
-    _get_num_neighborhoods_with_some_pop_from_db(cur)
+    If the catalog is stale and rebuild_stale_catalog is True, it's rebuilt in the background and its values replace
+    the stale ones once it's done.
+    """
+    db_path = db_connection.get_db_path()
+    _set_catalog(catalog.get_catalog(db_path, get_catalog_path(db_path),
+                                     _set_catalog if rebuild_stale_catalog else None))
 
 
 def generate_filename_for_question_file(q_num, extention):
@@ -36,10 +62,20 @@ def generate_filename_for_question_file(q_num, extention):
 
     The filename generated is the following format: {Question-Number}-{count}.{extention} (See lab specs)
     This function should keep track of how nany files have beein generated for that question and maintain a counter.
+    The counter starts after the last file already in the directory, so files of earlier runs aren't overwritten.
+    If shared counters were set (see set_shared_question_file_counters), they are used instead so that several
+    processes never hand out the same filename.
     """
 
+    if _SHARED_QUESTION_FILE_COUNTERS is not None and q_num in _SHARED_QUESTION_FILE_COUNTERS:
+        counter = _SHARED_QUESTION_FILE_COUNTERS[q_num]
+        with counter.get_lock():
+            counter.value += 1
+            file_num = counter.value
+        return "{}/{}-{}.{}".format(_GENERATED_FILES_DIR, q_num, file_num, extention)
+
     if q_num not in _QUESTION_FILE_COUNTERS_LTABLE:
-        _QUESTION_FILE_COUNTERS_LTABLE[q_num] = 1
+        _QUESTION_FILE_COUNTERS_LTABLE[q_num] = get_last_question_file_num(q_num, _GENERATED_FILES_DIR) + 1
 
     file_num = _QUESTION_FILE_COUNTERS_LTABLE[q_num]
     _QUESTION_FILE_COUNTERS_LTABLE[q_num] += 1
@@ -47,6 +83,73 @@ def generate_filename_for_question_file(q_num, extention):
     return "{}/{}".format(_GENERATED_FILES_DIR, file_name)
 
 
+def get_last_question_file_num(q_num, dir_path):
+    """
+    Returns the highest count of the {q_num}-{count}.{extention} files in dir_path, or 0 if there are none.
+    """
+    file_name_pattern = re.compile(re.escape(q_num) + r"-(\d+)\.[^.]+")
+    try:
+        file_names = os.listdir(dir_path)
+    except FileNotFoundError:
+        return 0
+
+    file_nums = [int(match.group(1)) for match in map(file_name_pattern.fullmatch, file_names) if match is not None]
+    return max(file_nums, default=0)
+
+
+def set_generated_files_dir(dir_path):
+    """
+    Write the files of generate_filename_for_question_file to dir_path instead of the default directory.
+    """
+    global _GENERATED_FILES_DIR
+    _GENERATED_FILES_DIR = dir_path
+
+
+def get_generated_files_dir():
+    return _GENERATED_FILES_DIR
+
+
+def get_db_files_dir(db_path, kind):
+    """
+    Returns the directory under generated_files that the files of kind (ex. "heatmap_grids") derived from the database
+    at db_path are kept in. Every database file gets its own directory.
+    """
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    path_hash = hashlib.sha256(os.path.abspath(db_path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(_GENERATED_FILES_DIR, kind, "{}-{}".format(stem, path_hash))
+
+
+def set_shared_question_file_counters(counters):
+    """ Use process-shared counters for generate_filename_for_question_file
+
+    :param counters: A dict of question number -> multiprocessing.Value('i') holding the last file number handed out.
+    """
+    global _SHARED_QUESTION_FILE_COUNTERS
+    _SHARED_QUESTION_FILE_COUNTERS = counters
+
+
+def get_valid_crime_type(crime_type):
+    """
+    Returns the crime type exactly as it is spelled in the database, or False if it's not a valid crime type.
+    """
+    return _VALID_CRIME_TYPES.get(crime_type.lower(), False)
+
+
+def add_crime_types(crime_types):
+    """
+    Adds any crime types that are new (ex. from newly appended incidents) to the valid crime types.
+    """
+    for crime_type in crime_types:
+        _VALID_CRIME_TYPES.setdefault(crime_type.lower(), crime_type)
+
+
+def get_crime_types():
+    """
+    Returns every crime type, spelled as it is in the database.
+    """
+    return sorted(_VALID_CRIME_TYPES.values())
+
+
 def get_and_validate_crime_type(input_prompt):
     """ Prompt the user with input_prompt, get a crime, and then validate that's it's a valid crime.
 
@@ -62,20 +165,61 @@ def get_and_validate_crime_type(input_prompt):
     return _VALID_CRIME_TYPES[crime_type]
 
 
-def create_new_edmonton_map():
+def get_and_validate_crime_types(input_prompt):
+    """ Prompt the user with input_prompt for a comma separated list of crimes, and validate each of them.
+
+    An empty answer means every crime type. Returns the list of crime types (spelled as in the database), or False if
+    any of them isn't valid.
     """
-    Creates a new map object centered on Edmonton
+    answer = input(input_prompt).strip()
+    if answer == "":
+        return get_crime_types()
+
+    crime_types = []
+    for crime_type in answer.split(","):
+        valid_crime_type = get_valid_crime_type(crime_type.strip())
+        if valid_crime_type is False:
+            utils.print_error("\"{}\" is not a valid crime type.".format(crime_type.strip()))
+            return False
+        if valid_crime_type not in crime_types:
+            crime_types.append(valid_crime_type)
+
+    return crime_types
+
+
+def create_new_edmonton_map(num_markers=0, location=None):
+    """ Creates a new map object centered on Edmonton
+
+    :param num_markers: How many markers will be added. Big maps are drawn on a canvas, which stays fast with any
+                        number of markers, instead of with one SVG element per marker.
+    :param location: The [latitude, longitude] to center the map on instead (ex. the point of a spatial query).
     """
-    return folium.Map(location=_FOLIUM_EDMONTON_MAP_COORDS, zoom_start=12)
+    # Imported here since importing folium is slow and only needed once a map is made
+    import folium
+    return folium.Map(location=_FOLIUM_EDMONTON_MAP_COORDS if location is None else location, zoom_start=12,
+                      prefer_canvas=num_markers >= _BULK_MARKERS_THRESHOLD)
 
 
 def add_markers_to_map(map, markers, avg_val):
     """ Plots the given markers on a map
 
+    Many markers are plotted as a single layer (see add_markers_as_layer), fewer as one circle each.
+
     :param map: The map to add markers to
     :markers: A list of FolioMarkers that describe info for each maker to place on the map
     :avg_val: The avg value to use for the markers passed in. Any marker vals less/greater than the average will scaled.
     """
+    if len(markers) >= _BULK_MARKERS_THRESHOLD:
+        add_markers_as_layer(map, markers, avg_val)
+    else:
+        add_markers_as_circles(map, markers, avg_val)
+
+
+def add_markers_as_circles(map, markers, avg_val):
+    """
+    Plots each of the given markers on a map as its own circle (See add_markers_to_map for the parameters)
+    """
+    import folium
 
     for marker in markers:
         calc_radius = (marker.val / avg_val) * _FOLIUM_AVG_RAD_SIZE + _FOLIUM_ADDITIONAL_RAD_SIZE
@@ -90,6 +234,39 @@ def add_markers_to_map(map, markers, avg_val):
         ).add_to(map)
 
 
+def add_markers_as_layer(map, markers, avg_val):
+    """ Plots the given markers on a map as one GeoJSON layer (See add_markers_to_map for the parameters)
+
+    Every marker is a point feature carrying only its radius, colour and popup, and a single JavaScript function
+    styles them all, so the page grows by a few dozen bytes per marker instead of a whole script block.
+    """
+    import folium
+    import numpy as np
+
+    if len(markers) == 0:
+        return
+
+    vals = np.fromiter((marker.val for marker in markers), dtype=np.float64, count=len(markers))
+    radii = np.round((vals / avg_val) * _FOLIUM_AVG_RAD_SIZE + _FOLIUM_ADDITIONAL_RAD_SIZE, _BULK_RADIUS_DECIMALS)
+
+    features = []
+    for (marker, radius) in zip(markers, radii.tolist()):
+        (lat, long) = marker.coords
+        features.append({
+            "type": "Feature",
+            # GeoJSON coordinates are (longitude, latitude)
+            "geometry": {"type": "Point", "coordinates": [round(long, _BULK_COORD_DECIMALS),
+                                                          round(lat, _BULK_COORD_DECIMALS)]},
+            "properties": {"r": radius, "c": marker.colour, "p": str(marker.str)},
+        })
+
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        marker=folium.Circle(fill=True),
+        on_each_feature=folium.JsCode(_BULK_LAYER_ON_EACH_FEATURE_JS),
+    ).add_to(map)
+
+
 def write_map_to_file(map, q_num):
     """
     Writes the given map to file named appropiately by the question number
@@ -98,29 +275,49 @@ def write_map_to_file(map, q_num):
     map.save(map_file_name)
 
     print("Wrote \"{}\" to disk.".format(map_file_name))
+    return map_file_name
 
 
 def get_num_neighborhoods():
     return _NUM_NEIGHBORHOODS
 
 
-def _get_crime_types_from_db(cur):
-    cur.execute("SELECT DISTINCT Crime_Type \
-                FROM crime_incidents")
-    crime_type_tuples = cur.fetchall()
+def get_catalog():
+    """
+    Returns the catalog.Catalog loaded by init, which may be stale until its rebuild is done.
+    """
+    return _CATALOG
+
+
+def add_appended_incidents(append_result):
+    """
+    Adds the incidents an ingest.append_incidents call appended (its AppendResult) to the catalog and its values.
+    """
+    catalog.add_appended_incidents(_CATALOG, append_result)
+    add_crime_types(append_result.crime_types)
+
+
+def finish_own_writes(catalog_was_fresh):
+    """ Called after the program's own writes to the database (ex. rollups, indexes, appended incidents), with whether
+    the catalog was fresh before them.
+
+    A catalog that was fresh is re-stamped with the new version of the database file and written (the writes either
+    didn't change its values or were added to it, see add_appended_incidents). A stale one is rebuilt in the background.
+    """
+    db_path = db_connection.get_db_path()
+    if catalog_was_fresh:
+        catalog.restamp_catalog(_CATALOG, db_path, get_catalog_path(db_path))
+    elif not _CATALOG.is_fresh(db_path):
+        catalog.rebuild_in_background(db_path, get_catalog_path(db_path), _set_catalog)
+
 
-    crime_type_strs = utils.map_tuple_list_to_string_list(crime_type_tuples)
-    for crime_type in crime_type_strs:
-        _VALID_CRIME_TYPES[crime_type.lower()] = crime_type
+def get_catalog_path(db_path):
+    return os.path.join(get_db_files_dir(db_path, "catalog"), "catalog.json")
 
 
-def _get_num_neighborhoods_with_some_pop_from_db(cur):
-    global _NUM_NEIGHBORHOODS
-    cur.execute("SELECT COUNT(*) \
-                FROM \
-                ( \
-                    SELECT (p.CANADIAN_CITIZEN + p.NON_CANADIAN_CITIZEN + p.NO_RESPONSE) as tot_pop \
-                    FROM POPULATION p \
-                ) \
-                WHERE tot_pop > 0")
-    _NUM_NEIGHBORHOODS = int(cur.fetchall()[0][0])
+def _set_catalog(new_catalog):
+    global _CATALOG, _NUM_NEIGHBORHOODS
+    _CATALOG = new_catalog
+    # Only adds, so crime types added since the catalog was built (see add_crime_types) stay valid
+    add_crime_types(new_catalog.crime_types)
+    _NUM_NEIGHBORHOODS = new_catalog.num_neighbourhoods_with_pop
@@ -0,0 +1,222 @@
+# Non-interactive batch mode. Runs Q1-Q4 for every job in a job file over a pool of worker processes.
+
+import csv
+import multiprocessing
+import os
+import pathlib
+import time
+
+import a4_specific_utils
+import db_connection
+import menu_options
+import utils
+
+
+_QUESTIONS = ["Q1", "Q2", "Q3", "Q4"]
+
+'''
+The columns expected in the job file. A header row naming them is required.
+Columns a question doesn't use can be left empty (ex. Q2 only needs n).
+'''
+_JOB_FILE_COLUMNS = ["question", "crime_type", "start_year", "end_year", "n"]
+
+
+'''
+A single line of the job file.
+'''
+class BatchJob:
+    def __init__(self, line_num, question, crime_type, start_year, end_year, n):
+        self.line_num = line_num
+        self.question = question
+        self.crime_type = crime_type
+        self.start_year = start_year
+        self.end_year = end_year
+        self.n = n
+
+    def describe(self):
+        return "{} crime_type={} years={}-{} n={}".format(
+            self.question, self.crime_type, self.start_year, self.end_year, self.n)
+
+
+'''
+The outcome of running a BatchJob. error is None if the job succeeded, and file_name is None if it had nothing to write
+(ex. no neighborhoods to map) or failed.
+'''
+class BatchJobResult:
+    def __init__(self, job, file_name, elapsed_secs, error):
+        self.job = job
+        self.file_name = file_name
+        self.elapsed_secs = elapsed_secs
+        self.error = error
+
+
+def run_batch(db_path, job_file_path, num_workers, engine_name=menu_options.ENGINE_SQLITE):
+    """ Run every job in the job file and print a per-job report.
+
+    engine_name picks how the workers answer the questions (see menu_options.ENGINES). The jobs are already spread
+    over the workers, so with ENGINE_PARALLEL they answer like ENGINE_SQLITE.
+
+    Returns True if every job succeeded.
+    """
+    jobs = read_job_file(job_file_path)
+    if jobs is False:
+        return False
+
+    (results, total_elapsed) = run_jobs(db_path, jobs, num_workers, engine_name)
+
+    num_failed = 0
+    num_without_output = 0
+    for res in results:
+        if res.error is None and res.file_name is None:
+            num_without_output += 1
+            print("[empty]  line {}: {} -> nothing to write ({:.3f}s)".format(
+                res.job.line_num, res.job.describe(), res.elapsed_secs))
+        elif res.error is None:
+            print("[ok]     line {}: {} -> \"{}\" ({:.3f}s)".format(
+                res.job.line_num, res.job.describe(), res.file_name, res.elapsed_secs))
+        else:
+            num_failed += 1
+            print("[failed] line {}: {} ({:.3f}s): {}".format(
+                res.job.line_num, res.job.describe(), res.elapsed_secs, res.error))
+
+    print("Ran {} jobs on {} workers in {:.3f}s ({} failed, {} with nothing to write).".format(
+        len(results), num_workers, total_elapsed, num_failed, num_without_output))
+    return num_failed == 0
+
+
+def run_jobs(db_path, jobs, num_workers, engine_name=menu_options.ENGINE_SQLITE, out_dir=None):
+    """ Run the BatchJobs over a pool of num_workers processes, writing their files to out_dir (default: the
+    directory of a4_specific_utils.get_generated_files_dir).
+
+    Returns a tuple of (list of BatchJobResult in the order of jobs, total wall time in seconds).
+    """
+    out_dir = a4_specific_utils.get_generated_files_dir() if out_dir is None else out_dir
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Each question gets a counter shared by every worker so that the generated filenames stay unique.
+    counters = {q_num: multiprocessing.Value('i', a4_specific_utils.get_last_question_file_num(q_num, out_dir))
+                for q_num in _QUESTIONS}
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(db_path, counters, engine_name, out_dir)) as pool:
+        results = pool.map(_run_job, jobs, chunksize=1)
+    db_connection.close_all_connections()
+
+    return (results, time.perf_counter() - start)
+
+
+def read_job_file(job_file_path):
+    """ Parse the job file into a list of BatchJobs.
+
+    Returns False (after printing an error) if the file is malformed.
+    """
+    if not pathlib.Path(job_file_path).exists():
+        utils.print_error("The supplied job file \"{}\" does not exist!".format(job_file_path))
+        return False
+
+    jobs = []
+    with open(job_file_path, newline='') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames is None or any(col not in reader.fieldnames for col in _JOB_FILE_COLUMNS):
+            utils.print_error("The job file must have a header row with the columns: {}".format(
+                ", ".join(_JOB_FILE_COLUMNS)))
+            return False
+
+        # Line 1 is the header
+        for line_num, row in enumerate(reader, start=2):
+            job = _parse_job_row(line_num, row)
+            if job is False:
+                return False
+            jobs.append(job)
+
+    return jobs
+
+
+def _parse_job_row(line_num, row):
+    question = row["question"].strip().upper()
+    if question not in _QUESTIONS:
+        utils.print_error("Line {}: \"{}\" is not a valid question (expected one of {}).".format(
+            line_num, row["question"], ", ".join(_QUESTIONS)))
+        return False
+
+    ints = {}
+    for col in ["start_year", "end_year", "n"]:
+        val = (row[col] or "").strip()
+        if val == "":
+            ints[col] = None
+            continue
+
+        ints[col] = utils.try_parse_int(val)
+        if ints[col] is False:
+            utils.print_error("Line {}: Cannot parse \"{}\" into an integer for {}.".format(line_num, val, col))
+            return False
+
+    crime_type = (row["crime_type"] or "").strip()
+    return BatchJob(line_num, question, crime_type, ints["start_year"], ints["end_year"], ints["n"])
+
+
+def _init_worker(db_path, counters, engine_name, out_dir):
+    # Never try to open a window from a worker. Setting the backend through the environment means matplotlib doesn't
+    # have to be imported until a worker actually draws a plot.
+    os.environ["MPLBACKEND"] = "Agg"
+
+    # Each worker opens its own read-only connection on first use (see db_connection.get_connection)
+    db_connection.set_db_path(db_path)
+    # The main process already started rebuilding a stale catalog
+    a4_specific_utils.init(rebuild_stale_catalog=False)
+    a4_specific_utils.set_generated_files_dir(out_dir)
+    a4_specific_utils.set_shared_question_file_counters(counters)
+
+    # Workers forked from a process that already loaded the columnar engine share its arrays
+    if engine_name == menu_options.ENGINE_NUMPY and menu_options.get_engine() is None:
+        import columnar_engine
+        menu_options.set_engine(columnar_engine.ColumnarEngine.load(db_connection.get_connection()))
+
+
+def _run_job(job):
+    start = time.perf_counter()
+    try:
+        error = _validate_job(job)
+        file_name = None
+        if error is None:
+            file_name = _dispatch_job(job)
+    except Exception as e:
+        file_name = None
+        error = "{}: {}".format(type(e).__name__, e)
+
+    return BatchJobResult(job, file_name, time.perf_counter() - start, error)
+
+
+def _validate_job(job):
+    needs_years = job.question in ["Q1", "Q3", "Q4"]
+    needs_n = job.question in ["Q2", "Q3", "Q4"]
+    needs_crime_type = job.question in ["Q1", "Q3"]
+
+    if needs_years:
+        if job.start_year is None or job.end_year is None:
+            return "start_year and end_year are required for {}".format(job.question)
+        if job.start_year > job.end_year:
+            return "end_year must be greater or equal to start_year"
+
+    if needs_n and (job.n is None or job.n < 0):
+        return "n must be a non-negative integer for {}".format(job.question)
+
+    if needs_crime_type:
+        crime_type = a4_specific_utils.get_valid_crime_type(job.crime_type)
+        if crime_type is False:
+            return "\"{}\" is not a valid crime type".format(job.crime_type)
+        # Use the exact case of how the crime type is spelled in the database
+        job.crime_type = crime_type
+
+    return None
+
+
+def _dispatch_job(job):
+    if job.question == "Q1":
+        return menu_options.run_q1(job.crime_type, job.start_year, job.end_year, show_plot=False)
+    if job.question == "Q2":
+        return menu_options.run_q2(job.n)
+    if job.question == "Q3":
+        return menu_options.run_q3(job.start_year, job.end_year, job.crime_type, job.n)
+    return menu_options.run_q4(job.start_year, job.end_year, job.n)
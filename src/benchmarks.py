@@ -0,0 +1,828 @@
+# Benchmarks for the query paths. Run with: python benchmarks.py --db_path <db> <benchmark> [options]
+#
+# The suite benchmark makes its own synthetic databases (see generate_db.py) instead, so it doesn't take a --db_path.
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import a4_specific_utils
+import batch
+import columnar_engine
+import db_connection
+import generate_db
+import heatmap_grid
+import menu_options
+import parallel_query
+import rollups
+import spatial_index
+import utils
+
+
+DEFAULT_SUITE_WORK_DIR = "{}/benchmark_dbs".format(a4_specific_utils._GENERATED_FILES_DIR)
+DEFAULT_SUITE_OUT_PATH = "{}/benchmark_suite.json".format(a4_specific_utils._GENERATED_FILES_DIR)
+
+_SUITE_NUM_YEARS = 11
+_SUITE_NUM_CRIME_TYPES = 8
+
+_SPATIAL_NUM_YEARS = 2
+_SPATIAL_NUM_CRIME_TYPES = 2
+
+
+'''
+Timing results for a benchmarked function.
+'''
+class BenchResult:
+    def __init__(self, name, times_secs):
+        self.name = name
+        self.times_secs = times_secs
+
+    def mean_ms(self):
+        return statistics.mean(self.times_secs) * 1000
+
+    def median_ms(self):
+        return statistics.median(self.times_secs) * 1000
+
+    def total_secs(self):
+        return sum(self.times_secs)
+
+    def to_dict(self):
+        return {"runs": len(self.times_secs), "mean_ms": self.mean_ms(), "median_ms": self.median_ms(),
+                "min_ms": min(self.times_secs) * 1000, "max_ms": max(self.times_secs) * 1000}
+
+    def describe(self):
+        return "{:<40} runs={:<5} total={:8.3f}s mean={:9.3f}ms median={:9.3f}ms".format(
+            self.name, len(self.times_secs), self.total_secs(), self.mean_ms(), self.median_ms())
+
+
+def time_calls(name, func, num_runs):
+    """
+    Calls func num_runs times and returns a BenchResult with the wall time of each call.
+    """
+    times = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return BenchResult(name, times)
+
+
+def bench_connections(args):
+    """
+    Compares repeated Q3 queries through the shared connection layer against a fresh sqlite3.connect per query
+    (how every menu option used to get its connection).
+    """
+    crime_type = _get_crime_type_arg(args)
+    if crime_type is False:
+        return
+
+    run_q3 = lambda: menu_options.query_q3(args.start_year, args.end_year, crime_type, args.n)
+
+    shared = time_calls("Q3 with shared connection", run_q3, args.runs)
+
+    get_shared_connection = db_connection.get_connection
+    db_connection.get_connection = lambda: sqlite3.connect(args.db_path)
+    try:
+        fresh = time_calls("Q3 with new connection per query", run_q3, args.runs)
+    finally:
+        db_connection.get_connection = get_shared_connection
+
+    print(fresh.describe())
+    print(shared.describe())
+    print("Speedup: {:.2f}x".format(fresh.total_secs() / shared.total_secs()))
+
+
+def bench_q4(args):
+    """
+    Compares Q4's latency at increasing N against the old version that ran one query per neighbourhood.
+    """
+    for n in args.ns:
+        legacy = time_calls("Q4 one query per neighbourhood N={}".format(n),
+                            lambda: _legacy_query_q4(args.start_year, args.end_year, n), args.runs)
+        single_pass = time_calls("Q4 single pass N={}".format(n),
+                                 lambda: menu_options.query_q4(args.start_year, args.end_year, n), args.runs)
+
+        print(legacy.describe())
+        print(single_pass.describe())
+        print("Speedup: {:.2f}x".format(legacy.total_secs() / single_pass.total_secs()))
+
+
+def _legacy_query_q4(lower_limit, upper_limit, n):
+    """
+    The old Q4 query: two aggregations to find the top N with ties, then one query per neighbourhood to find its
+    most common crime type (over every year).
+    """
+    cur = db_connection.get_connection().cursor()
+    ratio_query = "SELECT n_name, tot_pop, SUM(c.Incidents_Count), \
+                   CAST(tot_pop AS FLOAT) / CAST(SUM(c.Incidents_Count) AS FLOAT) as pop_crime_rat \
+                   FROM \
+                   ( \
+                       SELECT p.Neighbourhood_Name as n_name, \
+                              (p.CANADIAN_CITIZEN + p.NON_CANADIAN_CITIZEN + p.NO_RESPONSE) as tot_pop \
+                       FROM POPULATION p \
+                   ) \
+                   INNER JOIN crime_incidents c ON n_name = c.Neighbourhood_Name \
+                   WHERE c.Year >= ? AND c.Year <= ? \
+                   GROUP BY n_name \
+                   {} \
+                   ORDER BY pop_crime_rat DESC \
+                   {}"
+
+    list_rat = cur.execute(ratio_query.format("", "LIMIT ?"), (lower_limit, upper_limit, n)).fetchall()
+    if len(list_rat) == 0:
+        return []
+    # N can be more than the number of neighbourhoods with incidents, which are then all in the top N
+    bot_of_top = list_rat[min(n, len(list_rat)) - 1][3]
+    new_rat = cur.execute(ratio_query.format("HAVING pop_crime_rat >= ?", ""),
+                          (lower_limit, upper_limit, bot_of_top)).fetchall()
+
+    rows = []
+    for rat in new_rat:
+        c_type = cur.execute("SELECT c.Neighbourhood_Name, c.Crime_type, l.Latitude, l.Longitude \
+                              From crime_incidents c, coordinates l \
+                              where c.Neighbourhood_name = ? AND l.Neighbourhood_Name = c.Neighbourhood_Name \
+                              GROUP BY c.Crime_type \
+                              ORDER BY sum(c.Incidents_count) DESC LIMIT 1", (rat[0],)).fetchall()
+        rows.append((c_type[0][0], c_type[0][1], c_type[0][2], c_type[0][3], rat[3]))
+    return rows
+
+
+def bench_engines(args):
+    """
+    Compares the columnar engine's load cost and per question latency against the SQLite queries.
+    """
+    crime_type = _get_crime_type_arg(args)
+    if crime_type is False:
+        return
+
+    start = time.perf_counter()
+    engine = columnar_engine.ColumnarEngine.load(db_connection.get_connection())
+    load_secs = time.perf_counter() - start
+    print("Columnar engine load: {:.3f}s ({} incidents)".format(load_secs, len(engine.year)))
+
+    questions = [
+        ("Q1", lambda: menu_options.query_q1(crime_type, args.start_year, args.end_year)),
+        ("Q2", lambda: menu_options.query_q2(args.n)),
+        ("Q3", lambda: menu_options.query_q3(args.start_year, args.end_year, crime_type, args.n)),
+        ("Q4", lambda: menu_options.query_q4(args.start_year, args.end_year, args.n)),
+    ]
+
+    for (q_num, func) in questions:
+        menu_options.set_engine(None)
+        sqlite_res = time_calls("{} sqlite".format(q_num), func, args.runs)
+        menu_options.set_engine(engine)
+        numpy_res = time_calls("{} numpy".format(q_num), func, args.runs)
+        menu_options.set_engine(None)
+
+        saved_secs = sqlite_res.mean_ms() / 1000 - numpy_res.mean_ms() / 1000
+        break_even = "never" if saved_secs <= 0 else "{:.0f}".format(load_secs / saved_secs)
+        print(sqlite_res.describe())
+        print(numpy_res.describe())
+        print("Speedup: {:.2f}x, queries to pay back the load: {}".format(
+            sqlite_res.total_secs() / numpy_res.total_secs(), break_even))
+
+
+def bench_startup(args):
+    """
+    Measures the cold start time of main.py until the first menu prompt, and for comparison the time it would take to
+    import the heavy libraries the questions use.
+    """
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    cmd = [sys.executable, "-u", main_path, "--db_path", args.db_path]
+
+    def start_and_quit():
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        # The menu ends with the quit option
+        for line in proc.stdout:
+            if line.startswith("q -->"):
+                break
+        proc.communicate("q\n")
+
+    heavy_imports = [sys.executable, "-c", "import pandas, matplotlib.pyplot, folium"]
+    print(time_calls("Start to first menu prompt", start_and_quit, args.runs).describe())
+    print(time_calls("import pandas, matplotlib, folium", lambda: subprocess.run(heavy_imports, check=True),
+                     args.runs).describe())
+
+
+def bench_suite(args):
+    """ Times each question's query, marker construction and map/plot output on synthetic databases of each scale.
+
+    The databases are kept in args.work_dir and reused by later runs, since the big ones take a while to generate.
+    Writes every result to args.out as JSON so that runs can be compared.
+    """
+    os.makedirs(args.work_dir, exist_ok=True)
+    report = {
+        "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "runs": args.runs,
+        "params": {"crime_type": args.crime_type, "start_year": args.start_year, "end_year": args.end_year,
+                   "n": args.n},
+        "scales": [],
+    }
+
+    for num_rows in args.scales:
+        db_path = os.path.join(args.work_dir, "synthetic_{}.db".format(num_rows))
+        num_neighbourhoods = generate_db.get_num_neighbourhoods_for_rows(num_rows, _SUITE_NUM_YEARS,
+                                                                         _SUITE_NUM_CRIME_TYPES)
+        generate_secs = None
+        if not os.path.exists(db_path):
+            print("Generating {} incidents in \"{}\"...".format(num_rows, db_path))
+            start = time.perf_counter()
+            generate_db.generate_db(db_path, num_neighbourhoods, args.start_year, _SUITE_NUM_YEARS,
+                                    _SUITE_NUM_CRIME_TYPES, num_rows)
+            generate_secs = time.perf_counter() - start
+
+        db_connection.set_db_path(db_path)
+        a4_specific_utils.init()
+        crime_type = _get_crime_type_arg(args)
+        if crime_type is False:
+            return
+
+        scale = {
+            "rows": db_connection.get_connection().execute("SELECT COUNT(*) FROM crime_incidents").fetchone()[0],
+            "neighbourhoods": a4_specific_utils.get_num_neighborhoods(),
+            "db_path": db_path,
+            "generate_secs": generate_secs,
+            "questions": {},
+        }
+        print("Scale: {} incidents, {} neighbourhoods".format(scale["rows"], scale["neighbourhoods"]))
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            for (q_num, phases) in _get_suite_phases(args, crime_type, out_dir):
+                scale["questions"][q_num] = {}
+                for (phase, func) in phases:
+                    res = time_calls("{} {}".format(q_num, phase), func, args.runs)
+                    print(res.describe())
+                    scale["questions"][q_num][phase] = res.to_dict()
+
+        report["scales"].append(scale)
+
+    db_connection.close_all_connections()
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Wrote \"{}\" to disk.".format(args.out))
+
+
+def _get_suite_phases(args, crime_type, out_dir):
+    """ Returns a list of (question number, list of (phase name, function running the phase)).
+
+    Each phase after the query runs on the result of a single query, so only that phase is timed.
+    """
+    def plot_q1():
+        menu_options.plot_q1(q1_df.copy(), crime_type, os.path.join(out_dir, "Q1.png"))
+
+    def map_markers(q_num, *marker_lists):
+        def write_map():
+            avg_val = menu_options.get_avg_marker_val(marker_lists[-1])
+            edmonton_map = a4_specific_utils.create_new_edmonton_map(sum(len(m) for m in marker_lists))
+            for markers in marker_lists:
+                a4_specific_utils.add_markers_to_map(edmonton_map, markers, avg_val)
+            edmonton_map.save(os.path.join(out_dir, "{}.html".format(q_num)))
+        return write_map
+
+    q1_df = menu_options.query_q1(crime_type, args.start_year, args.end_year)
+
+    (q2_bot, q2_top) = menu_options.query_q2(args.n)
+    q2_markers = lambda: (menu_options.create_marker_for_q2_query_items(q2_bot, "red"),
+                          menu_options.create_marker_for_q2_query_items(q2_top, "blue"))
+
+    q3_rows = menu_options.query_q3(args.start_year, args.end_year, crime_type, args.n)
+    q3_markers = lambda: menu_options.create_markers_for_q3_query_items(q3_rows)
+
+    q4_rows = menu_options.query_q4(args.start_year, args.end_year, args.n)
+    q4_markers = lambda: menu_options.create_markers_for_q4_query_items(q4_rows)
+
+    return [
+        ("Q1", [("query", lambda: menu_options.query_q1(crime_type, args.start_year, args.end_year)),
+                ("plot", plot_q1)]),
+        ("Q2", [("query", lambda: menu_options.query_q2(args.n)),
+                ("markers", q2_markers),
+                ("map", map_markers("Q2", *q2_markers()))]),
+        ("Q3", [("query", lambda: menu_options.query_q3(args.start_year, args.end_year, crime_type, args.n)),
+                ("markers", q3_markers),
+                ("map", map_markers("Q3", q3_markers()))]),
+        ("Q4", [("query", lambda: menu_options.query_q4(args.start_year, args.end_year, args.n)),
+                ("markers", q4_markers),
+                ("map", map_markers("Q4", q4_markers()))]),
+    ]
+
+
+def bench_maps(args):
+    """ Compares writing maps of random markers one circle at a time against as a single layer.
+
+    Also reports the size of each page, which is what the browser has to parse and run when it's opened.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    for num_markers in args.counts:
+        lats = rng.uniform(generate_db._MIN_LAT, generate_db._MAX_LAT, size=num_markers).tolist()
+        longs = rng.uniform(generate_db._MIN_LONG, generate_db._MAX_LONG, size=num_markers).tolist()
+        vals = rng.integers(1, 1000, size=num_markers).tolist()
+        markers = [a4_specific_utils.FolioMarker([lat, long], "MARKER {} <br> {}".format(i, val), "crimson", val)
+                   for (i, (lat, long, val)) in enumerate(zip(lats, longs, vals))]
+        avg_val = menu_options.get_avg_marker_val(markers)
+
+        modes = [("layer", a4_specific_utils.add_markers_as_layer)]
+        if num_markers <= args.max_circles:
+            modes.insert(0, ("circles", a4_specific_utils.add_markers_as_circles))
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            for (mode, add_markers) in modes:
+                path = os.path.join(out_dir, "{}.html".format(mode))
+
+                def write_map():
+                    edmonton_map = a4_specific_utils.create_new_edmonton_map(num_markers)
+                    add_markers(edmonton_map, markers, avg_val)
+                    edmonton_map.save(path)
+
+                res = time_calls("{} markers as {}".format(num_markers, mode), write_map, args.runs)
+                print("{} size={:.1f}KiB".format(res.describe(), os.path.getsize(path) / 1024))
+
+
+def bench_plots(args):
+    """ Renders a Q1 chart for every crime type and decade of the database, over pools of each number of workers.
+
+    Reports the throughput in charts per second and the peak memory of the busiest worker.
+    """
+    cur = db_connection.get_connection().cursor()
+    (min_year, max_year) = cur.execute("SELECT MIN(Year), MAX(Year) FROM crime_incidents").fetchone()
+    if min_year is None:
+        utils.print_error("crime_incidents is empty, there is nothing to plot.")
+        return
+
+    decades = [(max(start, min_year), min(start + 9, max_year))
+               for start in range(min_year - min_year % 10, max_year + 1, 10)]
+    jobs = [batch.BatchJob(i, "Q1", crime_type, start_year, end_year, None)
+            for i in range(args.runs)
+            for crime_type in a4_specific_utils.get_crime_types()
+            for (start_year, end_year) in decades]
+    print("{} crime types x {} decades x {} runs = {} charts".format(
+        len(a4_specific_utils.get_crime_types()), len(decades), args.runs, len(jobs)))
+
+    # Finished workers are waited on by the pool, so the children's peak covers every pool measured so far
+    for num_workers in args.workers:
+        with tempfile.TemporaryDirectory() as out_dir:
+            (results, total_secs) = batch.run_jobs(args.db_path, jobs, num_workers, menu_options.ENGINE_SQLITE,
+                                                   out_dir)
+
+        errors = [res.error for res in results if res.error is not None]
+        if errors:
+            utils.print_error("{} charts failed, the first error: {}".format(len(errors), errors[0]))
+            return
+
+        print("workers={:<3} total={:8.3f}s {:8.1f} charts/s peak worker memory={:.1f}MiB".format(
+            num_workers, total_secs, len(jobs) / total_secs, _get_peak_children_memory_mib()))
+
+
+def bench_pivot(args):
+    """
+    Compares one Q1 query per crime type against a single Q1 pivot query over the same crime types.
+    """
+    crime_types = a4_specific_utils.get_crime_types()
+    cur = db_connection.get_connection().cursor()
+    (min_year, max_year) = cur.execute("SELECT MIN(Year), MAX(Year) FROM crime_incidents").fetchone()
+    if min_year is None:
+        utils.print_error("crime_incidents is empty, there is nothing to query.")
+        return
+
+    for num_types in args.num_types:
+        selected = tuple(crime_types[:num_types])
+        per_type = time_calls("Q1 once per crime type ({} types)".format(len(selected)),
+                              lambda: [menu_options.query_q1(crime_type, min_year, max_year) for crime_type in selected],
+                              args.runs)
+        pivot = time_calls("Q1 pivot ({} types)".format(len(selected)),
+                           lambda: menu_options.query_q1_pivot(selected, min_year, max_year, args.by_year), args.runs)
+        print(per_type.describe())
+        print(pivot.describe())
+
+
+def bench_parallel(args):
+    """ Q3 and Q4 serially and with the year range split over pools of each number of worker processes.
+
+    Checks that every parallel result is the same as the serial one, and reports the speedup over the serial query.
+    """
+    crime_type = _get_crime_type_arg(args)
+    if crime_type is False:
+        return
+
+    questions = [
+        ("Q3", lambda: menu_options.query_q3(args.start_year, args.end_year, crime_type, args.n)),
+        ("Q4", lambda: menu_options.query_q4(args.start_year, args.end_year, args.n)),
+    ]
+
+    serial = {}
+    for (q_num, func) in questions:
+        res = time_calls("{} serial".format(q_num), func, args.runs)
+        serial[q_num] = (res, sorted(func()))
+        print(res.describe())
+
+    for num_workers in args.workers:
+        executor = parallel_query.ParallelExecutor(args.db_path, num_workers)
+        menu_options.set_parallel_executor(executor)
+        try:
+            for (q_num, func) in questions:
+                (serial_res, serial_rows) = serial[q_num]
+                if sorted(func()) != serial_rows:
+                    utils.print_error("{} with {} workers doesn't match the serial result.".format(q_num, num_workers))
+                    return
+
+                res = time_calls("{} over {} workers".format(q_num, num_workers), func, args.runs)
+                print("{} speedup={:.2f}x".format(res.describe(), serial_res.median_ms() / res.median_ms()))
+        finally:
+            menu_options.set_parallel_executor(None)
+            executor.close()
+
+
+def bench_server(args):
+    """ Starts server.py and loads it with a mix of Q1-Q4 requests from each number of concurrent keep-alive clients.
+
+    Reports the p50/p99 latency and the throughput of each level, and how many requests were coalesced with an
+    identical one already in flight.
+    """
+    if args.distinct is not None and args.distinct < 1:
+        utils.print_error("--distinct must be at least 1 (got {})".format(args.distinct))
+        return
+
+    cur = db_connection.get_connection().cursor()
+    (min_year, max_year) = cur.execute("SELECT MIN(Year), MAX(Year) FROM crime_incidents").fetchone()
+    if min_year is None:
+        utils.print_error("crime_incidents is empty, there is nothing to query.")
+        return
+
+    targets = _get_server_targets(a4_specific_utils.get_crime_types(), min_year, max_year, args.rendered)
+    if args.distinct is not None:
+        targets = targets[:args.distinct]
+    print("{} distinct requests, {} requests per concurrency level".format(len(targets), args.runs))
+
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    cmd = [sys.executable, "-u", server_path, "--db_path", args.db_path, "--port", "0", "--threads",
+           str(args.threads), "--cache_mb", str(args.cache_mb)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    try:
+        line = proc.stdout.readline()
+        if not line.startswith("Serving on http://"):
+            utils.print_error("server.py didn't start (it printed \"{}\").".format(line.strip()))
+            return
+        (host, port) = line.split()[2][len("http://"):].rsplit(":", 1)
+
+        for concurrency in args.concurrency:
+            (latencies_secs, total_secs, errors) = asyncio.run(
+                _load_server(host, int(port), targets, args.runs, concurrency))
+            if errors:
+                utils.print_error("{} requests failed, the first: {}".format(len(errors), errors[0]))
+                return
+
+            quantiles = statistics.quantiles(latencies_secs, n=100, method="inclusive")
+            print("concurrency={:<4} total={:8.3f}s {:8.1f} req/s p50={:9.3f}ms p99={:9.3f}ms".format(
+                concurrency, total_secs, len(latencies_secs) / total_secs, quantiles[49] * 1000,
+                quantiles[98] * 1000))
+
+        health = json.loads(asyncio.run(_get_from_server(host, int(port), "/health"))[1])
+        print("{} requests answered, {} coalesced with an identical request in flight".format(
+            health["requests"], health["coalesced"]))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _get_server_targets(crime_types, min_year, max_year, rendered):
+    """
+    Returns the request targets of the load test: every question over every crime type and every year range ending
+    in the last year, for a few N.
+    """
+    year_ranges = [(start_year, max_year) for start_year in range(min_year, max_year + 1)]
+    ns = [5, 10]
+    q1_format = "&format=png" if rendered else ""
+    map_format = "&format=html" if rendered else ""
+
+    targets = ["/q2?n={}{}".format(n, map_format) for n in ns]
+    for (start_year, end_year) in year_ranges:
+        targets += ["/q4?start_year={}&end_year={}&n={}{}".format(start_year, end_year, n, map_format) for n in ns]
+        for crime_type in crime_types:
+            params = urllib.parse.urlencode({"crime_type": crime_type, "start_year": start_year, "end_year": end_year})
+            targets.append("/q1?{}{}".format(params, q1_format))
+            targets += ["/q3?{}&n={}{}".format(params, n, map_format) for n in ns]
+    return targets
+
+
+async def _load_server(host, port, targets, num_requests, concurrency):
+    """
+    Sends num_requests requests, cycling through targets, from concurrency clients that each keep one connection open.
+    Returns a tuple of (each request's latency, total seconds, errors).
+    """
+    next_request = iter(range(num_requests))
+    latencies_secs = []
+    errors = []
+
+    async def client():
+        (reader, writer) = await asyncio.open_connection(host, port)
+        try:
+            for i in next_request:
+                target = targets[i % len(targets)]
+                start = time.perf_counter()
+                (status, body) = await _send_request(reader, writer, host, target)
+                latencies_secs.append(time.perf_counter() - start)
+                if status != 200:
+                    errors.append("{} {}: {}".format(status, target, body[:200]))
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return (latencies_secs, time.perf_counter() - start, errors)
+
+
+async def _get_from_server(host, port, target):
+    (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        return await _send_request(reader, writer, host, target)
+    finally:
+        writer.close()
+
+
+async def _send_request(reader, writer, host, target):
+    """
+    Sends a GET for target on a kept alive connection. Returns a tuple of (status, body).
+    """
+    writer.write("GET {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(target, host).encode("latin-1"))
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        (name, _, value) = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            content_length = int(value)
+    return (status, await reader.readexactly(content_length))
+
+
+def bench_spatial(args):
+    """ Compares radius, bounding box and nearest neighbourhood queries through the R*Tree against scanning every
+    neighbourhood's coordinates, on synthetic databases with more and more neighbourhoods.
+
+    Each query is sized to find about args.k neighbourhoods, so the indexed times should barely grow with the number of
+    neighbourhoods while the scans grow linearly. The databases are kept in args.work_dir and reused by later runs.
+    """
+    os.makedirs(args.work_dir, exist_ok=True)
+    get_index_exists = spatial_index.spatial_index_exists
+
+    for num_neighbourhoods in args.counts:
+        db_path = os.path.join(args.work_dir, "spatial_{}.db".format(num_neighbourhoods))
+        if not os.path.exists(db_path):
+            print("Generating {} neighbourhoods in \"{}\"...".format(num_neighbourhoods, db_path))
+            generate_db.generate_db(db_path, num_neighbourhoods, 2009, _SPATIAL_NUM_YEARS, _SPATIAL_NUM_CRIME_TYPES,
+                                    num_neighbourhoods * 6)
+            rollups.refresh_rollups(db_path, rebuild=True)
+        db_connection.set_db_path(db_path)
+
+        # The neighbourhoods are spread uniformly over generate_db's bounds, so this is how many there are per km^2
+        mid_lat = (generate_db._MIN_LAT + generate_db._MAX_LAT) / 2
+        area_km2 = (generate_db._MAX_LAT - generate_db._MIN_LAT) * spatial_index._KM_PER_DEGREE * \
+            (generate_db._MAX_LONG - generate_db._MIN_LONG) * spatial_index._KM_PER_DEGREE * \
+            math.cos(math.radians(mid_lat))
+        per_km2 = num_neighbourhoods / area_km2
+        radius_km = math.sqrt(args.k / (per_km2 * math.pi))
+        half_side = math.sqrt(args.k / per_km2) / 2 / spatial_index._KM_PER_DEGREE
+
+        rng = random.Random(0)
+        points = [(rng.uniform(generate_db._MIN_LAT, generate_db._MAX_LAT),
+                   rng.uniform(generate_db._MIN_LONG, generate_db._MAX_LONG)) for _ in range(args.runs)]
+        queries = [
+            ("radius", lambda lat, long: spatial_index.query_within_radius(lat, long, radius_km, 2009, 2010)),
+            ("box", lambda lat, long: spatial_index.query_within_box(lat - half_side, long - half_side,
+                                                                     lat + half_side, long + half_side, 2009, 2010)),
+            ("nearest", lambda lat, long: spatial_index.query_nearest(lat, long, args.k, 2009, 2010)),
+        ]
+
+        print("Scale: {} neighbourhoods, radius {:.3f}km".format(num_neighbourhoods, radius_km))
+        for (name, query) in queries:
+            points_left = iter(points)
+            run_query = lambda: query(*next(points_left))
+            indexed = time_calls("{} with R*Tree".format(name), run_query, args.runs)
+
+            spatial_index.spatial_index_exists = lambda conn: False
+            try:
+                points_left = iter(points)
+                scanned = time_calls("{} with coordinate scan".format(name), run_query, args.runs)
+            finally:
+                spatial_index.spatial_index_exists = get_index_exists
+
+            print(indexed.describe())
+            print(scanned.describe())
+            print("Speedup: {:.2f}x".format(scanned.total_secs() / indexed.total_secs()))
+
+        db_connection.close_all_connections()
+
+
+def bench_heatmap(args):
+    """ Compares scrubbing a window of years across the database, a step at a time, with a Q3 aggregation of every
+    neighbourhood and its map against summing the precomputed heatmap grids and mapping the sum.
+
+    Both are timed with the map rendered to HTML, and the grid sums alone too.
+    """
+    crime_type = _get_crime_type_arg(args)
+    if crime_type is False:
+        return
+
+    grids = heatmap_grid.build_heatmap_grids(args.db_path, args.cells)
+    db_connection.set_db_path(args.db_path)
+    steps = [(year, year + args.window - 1) for year in grids.years[:max(1, len(grids.years) - args.window + 1)]]
+    num_neighbourhoods = a4_specific_utils.get_num_neighborhoods()
+    print("Scrubbing a {} year window over {} steps".format(args.window, len(steps)))
+
+    def scrub(step_func):
+        steps_left = itertools.cycle(steps)
+        return lambda: step_func(*next(steps_left))
+
+    q3_query_step = lambda lower, upper: menu_options.query_q3(lower, upper, crime_type, num_neighbourhoods)
+    q3_step = lambda lower, upper: menu_options.create_q3_map(q3_query_step(lower, upper)).get_root().render()
+    grids = heatmap_grid.get_heatmap_grids()
+    sum_step = lambda lower, upper: grids.sum_years(lower, upper, [crime_type])
+    heatmap_step = lambda lower, upper: heatmap_grid.create_heatmap(grids, sum_step(lower, upper)).get_root().render()
+
+    q3 = time_calls("Q3 query and map per step", scrub(q3_step), args.runs)
+    heatmap = time_calls("Grid sum and heatmap per step", scrub(heatmap_step), args.runs)
+    q3_query = time_calls("Q3 query per step", scrub(q3_query_step), args.runs)
+    sums = time_calls("Grid sum per step", scrub(sum_step), args.runs)
+
+    print(q3.describe())
+    print(heatmap.describe())
+    print("Speedup: {:.2f}x".format(q3.total_secs() / heatmap.total_secs()))
+    print(q3_query.describe())
+    print(sums.describe())
+    print("Speedup: {:.2f}x".format(q3_query.total_secs() / sums.total_secs()))
+
+
+def _get_peak_children_memory_mib():
+    # ru_maxrss is in KiB on Linux (and bytes on macOS)
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+
+def _get_crime_type_arg(args):
+    crime_type = a4_specific_utils.get_valid_crime_type(args.crime_type)
+    if crime_type is False:
+        utils.print_error("\"{}\" is not a valid crime type.".format(args.crime_type))
+    return crime_type
+
+
+def _add_q3_args(parser):
+    parser.add_argument('--crime_type', default="Assault", help="The crime type to query (default: Assault)")
+    parser.add_argument('--start_year', type=int, default=2009)
+    parser.add_argument('--end_year', type=int, default=2019)
+    parser.add_argument('--n', type=int, default=10, help="The number of neighborhoods to query")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="CMPUT_291 Query Benchmarks")
+    parser.add_argument('--db_path', help="The path to the database file to benchmark against (not used by suite)")
+    parser.add_argument('--runs', type=int, default=200, help="The number of times to run each benchmark")
+    parser.set_defaults(needs_db=True)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    connections_parser = subparsers.add_parser(
+        "connections", help="Repeated Q3 queries with and without the shared connection layer")
+    _add_q3_args(connections_parser)
+    connections_parser.set_defaults(run_func=bench_connections)
+
+    q4_parser = subparsers.add_parser(
+        "q4", help="Q4 latency versus N, single pass against one query per neighbourhood")
+    q4_parser.add_argument('--start_year', type=int, default=2009)
+    q4_parser.add_argument('--end_year', type=int, default=2019)
+    q4_parser.add_argument('--ns', type=int, nargs="+", default=[1, 10, 50, 100, 200],
+                           help="The values of N to measure")
+    q4_parser.set_defaults(run_func=bench_q4)
+
+    engines_parser = subparsers.add_parser(
+        "engines", help="Columnar engine load cost and per question latency against SQLite")
+    _add_q3_args(engines_parser)
+    engines_parser.set_defaults(run_func=bench_engines)
+
+    startup_parser = subparsers.add_parser(
+        "startup", help="Cold start time of main.py to the first menu prompt (try it with --runs 20)")
+    startup_parser.set_defaults(run_func=bench_startup)
+
+    suite_parser = subparsers.add_parser(
+        "suite", help="Query, marker and map/plot times of every question on synthetic databases of several sizes "
+                      "(try it with --runs 5)")
+    _add_q3_args(suite_parser)
+    suite_parser.add_argument('--scales', type=int, nargs="+", default=[100000, 1000000, 10000000],
+                              help="The number of incident rows of each synthetic database")
+    suite_parser.add_argument('--work_dir', default=DEFAULT_SUITE_WORK_DIR,
+                              help="Where to keep the synthetic databases (default: {})".format(DEFAULT_SUITE_WORK_DIR))
+    suite_parser.add_argument('--out', default=DEFAULT_SUITE_OUT_PATH,
+                              help="The JSON file to write the results to (default: {})".format(DEFAULT_SUITE_OUT_PATH))
+    suite_parser.set_defaults(run_func=bench_suite, needs_db=False)
+
+    maps_parser = subparsers.add_parser(
+        "maps", help="Writing maps of many markers one circle at a time against as one layer (try it with --runs 3)")
+    maps_parser.add_argument('--counts', type=int, nargs="+", default=[100, 10000, 100000],
+                             help="The numbers of markers to measure")
+    maps_parser.add_argument('--max_circles', type=int, default=10000,
+                             help="Skip drawing one circle per marker above this many markers (default: 10000)")
+    maps_parser.set_defaults(run_func=bench_maps, needs_db=False)
+
+    plots_parser = subparsers.add_parser(
+        "plots", help="Q1 charts per second rendering every crime type x decade in parallel (try it with --runs 5)")
+    plots_parser.add_argument('--workers', type=int, nargs="+", default=[1, multiprocessing.cpu_count()],
+                              help="The numbers of worker processes to measure")
+    plots_parser.set_defaults(run_func=bench_plots)
+
+    pivot_parser = subparsers.add_parser(
+        "pivot", help="Q1 pivot of several crime types in one query against one Q1 query per crime type")
+    pivot_parser.add_argument('--num_types', type=int, nargs="+", default=[1, 2, 4, 8],
+                              help="The numbers of crime types to compare (the first ones alphabetically)")
+    pivot_parser.add_argument('--by_year', action="store_true", help="Split the pivot's months by year")
+    pivot_parser.set_defaults(run_func=bench_pivot)
+
+    parallel_parser = subparsers.add_parser(
+        "parallel", help="Q3/Q4 speedup from splitting the year range over more worker processes")
+    _add_q3_args(parallel_parser)
+    parallel_parser.add_argument('--workers', type=int, nargs="+",
+                                 default=sorted({1, 2, 4, multiprocessing.cpu_count()}),
+                                 help="The numbers of worker processes to measure")
+    parallel_parser.set_defaults(run_func=bench_parallel)
+
+    server_parser = subparsers.add_parser(
+        "server", help="p50/p99 latency and throughput of server.py at increasing numbers of concurrent clients "
+                       "(--runs is the number of requests per level)")
+    server_parser.add_argument('--concurrency', type=int, nargs="+", default=[1, 4, 16, 64],
+                               help="The numbers of concurrent clients to measure")
+    server_parser.add_argument('--threads', type=int, default=min(32, multiprocessing.cpu_count() + 4),
+                               help="The number of threads the server answers requests with")
+    server_parser.add_argument('--cache_mb', type=int, default=0,
+                               help="The server's result cache size (default: 0, so every request is queried)")
+    server_parser.add_argument('--rendered', action="store_true",
+                               help="Request the PNG plots and HTML maps instead of JSON")
+    server_parser.add_argument('--distinct', type=int,
+                               help="Only cycle through this many distinct requests, so that concurrent clients send "
+                                    "identical ones (default: all of them)")
+    server_parser.set_defaults(run_func=bench_server)
+
+    heatmap_parser = subparsers.add_parser(
+        "heatmap", help="Scrubbing through years with Q3 aggregations and maps against the precomputed heatmap grids")
+    heatmap_parser.add_argument('--crime_type', default="Assault", help="The crime type to map (default: Assault)")
+    heatmap_parser.add_argument('--window', type=int, default=2, help="The number of years per step (default: 2)")
+    heatmap_parser.add_argument('--cells', type=int, default=heatmap_grid.DEFAULT_NUM_CELLS,
+                                help="The number of rows and of columns of the grid (default: {})".format(
+                                    heatmap_grid.DEFAULT_NUM_CELLS))
+    heatmap_parser.set_defaults(run_func=bench_heatmap)
+
+    spatial_parser = subparsers.add_parser(
+        "spatial", help="Radius, bounding box and nearest neighbourhood queries with the R*Tree against a coordinate "
+                        "scan, at increasing numbers of neighbourhoods")
+    spatial_parser.add_argument('--counts', type=int, nargs="+", default=[1000, 10000, 100000],
+                                help="The numbers of neighbourhoods of each synthetic database")
+    spatial_parser.add_argument('--k', type=int, default=20,
+                                help="About how many neighbourhoods each query should find (default: 20)")
+    spatial_parser.add_argument('--work_dir', default=DEFAULT_SUITE_WORK_DIR,
+                                help="Where to keep the synthetic databases (default: {})".format(
+                                    DEFAULT_SUITE_WORK_DIR))
+    spatial_parser.set_defaults(run_func=bench_spatial, needs_db=False)
+
+    args = parser.parse_args()
+
+    if not args.needs_db:
+        args.run_func(args)
+        return
+
+    if args.db_path is None:
+        utils.print_error("--db_path is required by the {} benchmark.".format(args.benchmark))
+        return
+
+    if not os.path.exists(args.db_path) or not utils.file_is_a_valid_database(args.db_path):
+        utils.print_error("\"{}\" is not an sqlite3 database file.".format(args.db_path))
+        return
+
+    db_connection.set_db_path(args.db_path)
+    a4_specific_utils.init()
+
+    args.run_func(args)
+    db_connection.close_all_connections()
+
+
+if __name__ == "__main__":
+    main()
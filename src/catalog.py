@@ -0,0 +1,185 @@
+# Catalog of the database's metadata: its crime types, neighbourhood counts, year/month bounds and row counts.
+#
+# The program needs the crime types and the number of populated neighbourhoods before its first prompt, and getting
+# them from the tables means scanning all of crime_incidents and population. The catalog stores them in a small JSON
+# file instead (see a4_specific_utils.get_catalog_path), so startup reads one file whatever the size of the tables.
+#
+# The catalog remembers the version of the database file it was built from (see db_connection.get_db_file_version),
+# and any write to the database makes it stale. A missing catalog is built before it's returned. A stale one is
+# returned as it is while a fresh one is built in a background thread, which then hands it to a callback and replaces
+# the file. Until then the program runs with the stale catalog, which may lack crime types added since and have older
+# counts.
+#
+# The program's own writes would make the catalog stale too, and have it scan the tables again on the next run. Writes
+# that don't change anything the catalog holds (ex. rollups and indexes) only re-stamp a fresh catalog with the new
+# version of the file (see restamp_catalog), and appended incidents are added to it (see add_appended_incidents).
+
+import json
+import os
+import threading
+
+import db_connection
+
+
+_CATALOG_FORMAT_VERSION = 1
+
+
+'''
+Metadata of a database, as of the version of its file in file_version.
+'''
+class Catalog:
+    def __init__(self, file_version, crime_types, num_neighbourhoods_with_pop, num_neighbourhoods, first_month,
+                 last_month, row_counts):
+        self.file_version = file_version
+        # Sorted, spelled as they are in crime_incidents
+        self.crime_types = crime_types
+        # Neighbourhoods with a total population above 0, and every neighbourhood named by any table
+        self.num_neighbourhoods_with_pop = num_neighbourhoods_with_pop
+        self.num_neighbourhoods = num_neighbourhoods
+        # (Year, Month) of the earliest and latest incidents, None if there are no incidents
+        self.first_month = first_month
+        self.last_month = last_month
+        # Table name -> number of rows
+        self.row_counts = row_counts
+
+    def is_fresh(self, db_path):
+        return self.file_version == db_connection.get_db_file_version(db_path)
+
+    def to_dict(self):
+        return {"format_version": _CATALOG_FORMAT_VERSION, "file_version": self.file_version,
+                "crime_types": self.crime_types, "num_neighbourhoods_with_pop": self.num_neighbourhoods_with_pop,
+                "num_neighbourhoods": self.num_neighbourhoods, "first_month": self.first_month,
+                "last_month": self.last_month, "row_counts": self.row_counts}
+
+    @staticmethod
+    def from_dict(catalog_dict):
+        """
+        Returns the Catalog of a dict from to_dict, or None if it was written by an incompatible version.
+        """
+        if catalog_dict.get("format_version") != _CATALOG_FORMAT_VERSION:
+            return None
+
+        # JSON turns the tuples into lists
+        to_tuple = lambda val: None if val is None else tuple(to_tuple(v) if isinstance(v, list) else v for v in val)
+        return Catalog(to_tuple(catalog_dict["file_version"]), catalog_dict["crime_types"],
+                       catalog_dict["num_neighbourhoods_with_pop"], catalog_dict["num_neighbourhoods"],
+                       to_tuple(catalog_dict["first_month"]), to_tuple(catalog_dict["last_month"]),
+                       catalog_dict["row_counts"])
+
+
+def get_catalog(db_path, catalog_path, on_rebuilt=None):
+    """ Returns the catalog of the database at db_path, kept in the file catalog_path.
+
+    A missing (or unreadable) catalog is built and written first. A stale catalog is returned as it is, and if
+    on_rebuilt is given a fresh one is built in the background and passed to on_rebuilt(catalog) once it's done.
+    """
+    catalog = load_catalog(catalog_path)
+    if catalog is None:
+        catalog = build_catalog(db_path)
+        write_catalog(catalog, catalog_path)
+    elif not catalog.is_fresh(db_path) and on_rebuilt is not None:
+        rebuild_in_background(db_path, catalog_path, on_rebuilt)
+    return catalog
+
+
+def add_appended_incidents(catalog, append_result):
+    """
+    Updates the catalog in place with the incidents an ingest.append_incidents call appended (its AppendResult).
+    """
+    catalog.crime_types = sorted(set(catalog.crime_types).union(append_result.crime_types))
+    catalog.num_neighbourhoods += append_result.num_new_neighbourhoods
+    if append_result.first_month is not None:
+        catalog.first_month = min(catalog.first_month or append_result.first_month, append_result.first_month)
+        catalog.last_month = max(catalog.last_month or append_result.last_month, append_result.last_month)
+    catalog.row_counts["crime_incidents"] += append_result.num_inserted
+
+
+def restamp_catalog(catalog, db_path, catalog_path):
+    """ Marks the catalog as built from the database file as it is now and writes it to catalog_path.
+
+    Only for after the program's own writes to a database whose catalog was fresh before them, once whatever they
+    changed that the catalog holds was applied to it (ex. with add_appended_incidents).
+    """
+    catalog.file_version = db_connection.get_db_file_version(db_path)
+    write_catalog(catalog, catalog_path)
+
+
+def build_catalog(db_path):
+    """
+    Returns a new Catalog of the database at db_path, read from its tables with a connection of its own.
+    """
+    # Taken before reading, so that a write made while the catalog is built leaves it stale instead of wrong
+    file_version = db_connection.get_db_file_version(db_path)
+
+    conn = db_connection.open_read_only_connection(db_path)
+    try:
+        crime_types = [crime_type for (crime_type,) in conn.execute(
+            "SELECT DISTINCT Crime_Type FROM crime_incidents WHERE Crime_Type IS NOT NULL ORDER BY Crime_Type")]
+
+        num_neighbourhoods_with_pop = count_neighbourhoods_with_pop(conn)
+        num_neighbourhoods = conn.execute("SELECT COUNT(*) \
+                                           FROM ( \
+                                               SELECT Neighbourhood_Name FROM population \
+                                               UNION SELECT Neighbourhood_Name FROM coordinates \
+                                               UNION SELECT Neighbourhood_Name FROM crime_incidents \
+                                           ) \
+                                           WHERE Neighbourhood_Name IS NOT NULL").fetchone()[0]
+
+        first_month = conn.execute("SELECT Year, Month FROM crime_incidents ORDER BY Year, Month LIMIT 1").fetchone()
+        last_month = conn.execute("SELECT Year, Month FROM crime_incidents \
+                                   ORDER BY Year DESC, Month DESC LIMIT 1").fetchone()
+
+        # The call to string.format only substitutes hard coded table names
+        row_counts = {table: conn.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+                      for table in ["crime_incidents", "population", "coordinates"]}
+    finally:
+        conn.close()
+
+    return Catalog(file_version, crime_types, num_neighbourhoods_with_pop, num_neighbourhoods, first_month,
+                   last_month, row_counts)
+
+
+def count_neighbourhoods_with_pop(conn):
+    """
+    Returns the number of neighbourhoods with a total population above 0. Only reads population, a small table.
+    """
+    return conn.execute("SELECT COUNT(*) \
+                         FROM population \
+                         WHERE CANADIAN_CITIZEN + NON_CANADIAN_CITIZEN + NO_RESPONSE > 0").fetchone()[0]
+
+
+def load_catalog(catalog_path):
+    """
+    Returns the Catalog in catalog_path, or None if there is none or it can't be read.
+    """
+    try:
+        with open(catalog_path) as f:
+            return Catalog.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_catalog(catalog, catalog_path):
+    os.makedirs(os.path.dirname(catalog_path) or ".", exist_ok=True)
+
+    # Written to a temporary file and renamed over the old one, so a reader never sees half a catalog
+    tmp_path = "{}.{}.tmp".format(catalog_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(catalog.to_dict(), f)
+    os.replace(tmp_path, catalog_path)
+
+
+def rebuild_in_background(db_path, catalog_path, on_rebuilt):
+    """ Builds a fresh catalog in a daemon thread, passes it to on_rebuilt(catalog) and writes it to catalog_path.
+
+    Returns the thread.
+    """
+    def rebuild():
+        catalog = build_catalog(db_path)
+        on_rebuilt(catalog)
+        write_catalog(catalog, catalog_path)
+
+    # A daemon, so quitting doesn't wait for it. The file is only ever replaced whole (see write_catalog).
+    thread = threading.Thread(target=rebuild, name="catalog-rebuild", daemon=True)
+    thread.start()
+    return thread
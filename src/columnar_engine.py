@@ -0,0 +1,221 @@
+# In-memory columnar engine.
+#
+# Loads crime_incidents, population and coordinates once into NumPy column arrays and answers Q1-Q4 with vectorized
+# group-bys instead of running an SQLite aggregation per question. Neighbourhood names and crime types are dictionary
+# encoded: each distinct string gets an integer code (in sorted order), and the incident columns only store the codes.
+#
+# The query_* methods return the same results as the SQL queries in menu_options (rows tied in rank may come back in a
+# different order).
+
+import time
+
+import numpy as np
+import pandas as pd
+
+
+_LOAD_CHUNK_SIZE = 1000000
+
+
+class ColumnarEngine:
+    def __init__(self, neigh_names, crime_types, year, month, crime_type, neigh, count, tot_pop, lat, long):
+        # Dictionaries: code -> string
+        self.neigh_names = neigh_names
+        self.crime_types = crime_types
+        self.crime_type_codes = {name: code for (code, name) in enumerate(crime_types)}
+
+        # crime_incidents columns
+        self.year = year
+        self.month = month
+        self.crime_type = crime_type
+        self.neigh = neigh
+        self.count = count
+
+        # Per neighbourhood code. tot_pop is -1 for neighbourhoods that aren't in population and lat/long are NaN for
+        # neighbourhoods that aren't in coordinates.
+        self.tot_pop = tot_pop
+        self.lat = lat
+        self.long = long
+
+    @staticmethod
+    def load(conn):
+        """
+        Loads the three tables from the given connection into a new ColumnarEngine.
+        """
+        neigh_names = _fetch_column(conn, "SELECT Neighbourhood_Name FROM crime_incidents \
+                                           UNION SELECT Neighbourhood_Name FROM population \
+                                           UNION SELECT Neighbourhood_Name FROM coordinates \
+                                           ORDER BY 1")
+        crime_types = _fetch_column(conn, "SELECT DISTINCT Crime_Type FROM crime_incidents ORDER BY 1")
+
+        num_rows = conn.execute("SELECT COUNT(*) FROM crime_incidents").fetchone()[0]
+        year = np.empty(num_rows, dtype=np.int16)
+        month = np.empty(num_rows, dtype=np.int8)
+        crime_type = np.empty(num_rows, dtype=np.int16)
+        neigh = np.empty(num_rows, dtype=np.int32)
+        count = np.empty(num_rows, dtype=np.int32)
+
+        # Read in chunks so only one chunk of python objects exists at a time
+        pos = 0
+        for chunk in pd.read_sql_query("SELECT Neighbourhood_Name, Year, Month, Crime_Type, Incidents_Count \
+                                        FROM crime_incidents", conn, chunksize=_LOAD_CHUNK_SIZE):
+            end = pos + len(chunk)
+            year[pos:end] = chunk["Year"].to_numpy()
+            month[pos:end] = chunk["Month"].to_numpy()
+            crime_type[pos:end] = pd.Categorical(chunk["Crime_Type"], categories=crime_types).codes
+            neigh[pos:end] = pd.Categorical(chunk["Neighbourhood_Name"], categories=neigh_names).codes
+            count[pos:end] = chunk["Incidents_Count"].to_numpy()
+            pos = end
+
+        tot_pop = np.full(len(neigh_names), -1, dtype=np.int64)
+        pop = pd.read_sql_query("SELECT Neighbourhood_Name, \
+                                 (CANADIAN_CITIZEN + NON_CANADIAN_CITIZEN + NO_RESPONSE) AS tot_pop \
+                                 FROM population", conn)
+        tot_pop[pd.Categorical(pop["Neighbourhood_Name"], categories=neigh_names).codes] = pop["tot_pop"].to_numpy()
+
+        lat = np.full(len(neigh_names), np.nan)
+        long = np.full(len(neigh_names), np.nan)
+        coords = pd.read_sql_query("SELECT Neighbourhood_Name, Latitude, Longitude FROM coordinates", conn)
+        coord_codes = pd.Categorical(coords["Neighbourhood_Name"], categories=neigh_names).codes
+        lat[coord_codes] = coords["Latitude"].to_numpy()
+        long[coord_codes] = coords["Longitude"].to_numpy()
+
+        return ColumnarEngine(neigh_names, crime_types, year, month, crime_type, neigh, count, tot_pop, lat, long)
+
+    def num_neighborhoods(self):
+        return len(self.neigh_names)
+
+    def query_q1(self, crime_type, lower_limit, upper_limit):
+        """
+        Returns a DataFrame of (Month, total_incidents) for crime_type between the two years (inclusive).
+        """
+        in_years = (self.year >= lower_limit) & (self.year <= upper_limit)
+        months_with_incidents = np.bincount(self.month[in_years], minlength=13) > 0
+
+        code = self.crime_type_codes.get(crime_type, -1)
+        of_type = in_years & (self.crime_type == code)
+        type_months = self.month[of_type]
+        totals = np.bincount(type_months, weights=self.count[of_type], minlength=13)
+        months_with_type = np.bincount(type_months, minlength=13) > 0
+
+        months = np.nonzero(months_with_incidents)[0]
+        # Months without any incidents of crime_type have no total (NULL in the SQL query)
+        total_incidents = np.where(months_with_type[months], totals[months], np.nan)
+
+        df = pd.DataFrame({"Month": months.astype(np.int64), "total_incidents": total_incidents})
+        if not np.isnan(total_incidents).any():
+            df["total_incidents"] = df["total_incidents"].astype(np.int64)
+        return df
+
+    def query_q2(self, num_least_populous, num_most_populous):
+        """
+        Returns a tuple of (least populous, most populous) lists of (n_name, tot_pop, lat, long) rows, including ties.
+        """
+        has_coords = ~np.isnan(self.lat) & (self.lat != 0) & (self.long != 0)
+        codes = np.nonzero((self.tot_pop > 0) & has_coords)[0]
+        pops = self.tot_pop[codes]
+
+        def to_rows(idxs):
+            return [(self.neigh_names[c], int(self.tot_pop[c]), float(self.lat[c]), float(self.long[c]))
+                    for c in codes[idxs]]
+
+        return (to_rows(top_n_indices_with_ties(pops, num_least_populous, descending=False)),
+                to_rows(top_n_indices_with_ties(pops, num_most_populous)))
+
+    def query_q3(self, lower_limit, upper_limit, crime_type, num_neighborhood):
+        """
+        Returns a list of (counts, Neighbourhood_Name, Latitude, Longitude) rows ordered by counts, including ties.
+        """
+        code = self.crime_type_codes.get(crime_type, -1)
+        selected = (self.year >= lower_limit) & (self.year <= upper_limit) & (self.crime_type == code)
+
+        neighs = self.neigh[selected]
+        counts = np.bincount(neighs, weights=self.count[selected], minlength=self.num_neighborhoods())
+        has_incidents = np.bincount(neighs, minlength=self.num_neighborhoods()) > 0
+
+        codes = np.nonzero(has_incidents & ~np.isnan(self.lat))[0]
+        idxs = top_n_indices_with_ties(counts[codes], num_neighborhood)
+        return [(int(counts[c]), self.neigh_names[c], float(self.lat[c]), float(self.long[c])) for c in codes[idxs]]
+
+    def query_q4(self, lower_limit, upper_limit, n):
+        """
+        Returns a list of (Neighbourhood_Name, most common Crime_Type, Latitude, Longitude, ratio) rows ordered by
+        ratio, including ties.
+        """
+        in_years = (self.year >= lower_limit) & (self.year <= upper_limit)
+        num_types = len(self.crime_types)
+
+        # Sum every (neighbourhood, crime type) pair at once by flattening the pair into a single index
+        pair = self.neigh[in_years].astype(np.int64) * num_types + self.crime_type[in_years]
+        type_counts = np.bincount(pair, weights=self.count[in_years], minlength=self.num_neighborhoods() * num_types)
+        type_counts = type_counts.reshape(self.num_neighborhoods(), num_types)
+
+        tot_crime = type_counts.sum(axis=1)
+        # argmax takes the first of any tied counts, which is the alphabetically first crime type like the SQL query
+        dominant_type = type_counts.argmax(axis=1)
+
+        codes = np.nonzero((tot_crime > 0) & (self.tot_pop >= 0) & ~np.isnan(self.lat))[0]
+        ratios = self.tot_pop[codes] / tot_crime[codes]
+
+        idxs = top_n_indices_with_ties(ratios, n)
+        return [(self.neigh_names[c], self.crime_types[dominant_type[c]], float(self.lat[c]), float(self.long[c]),
+                 float(r)) for (c, r) in zip(codes[idxs], ratios[idxs])]
+
+    def query_q1_pivot(self, crime_types, lower_limit, upper_limit, by_year):
+        """ Returns an int64 array of the total incidents of each month (or each year and month if by_year) between the
+        two years (inclusive) by each of crime_types.
+
+        Rows are months in order (year by year if by_year) and columns are crime_types in order.
+        """
+        # Crime type code -> its column, or -1 if it isn't one of crime_types
+        type_cols = np.full(len(self.crime_types), -1, dtype=np.int64)
+        for (col, crime_type) in enumerate(crime_types):
+            code = self.crime_type_codes.get(crime_type)
+            if code is not None:
+                type_cols[code] = col
+
+        cols = type_cols[self.crime_type]
+        selected = (self.year >= lower_limit) & (self.year <= upper_limit) & (cols >= 0)
+
+        num_rows = 12 * (upper_limit - lower_limit + 1) if by_year else 12
+        rows = self.month[selected].astype(np.int64) - 1
+        if by_year:
+            rows += (self.year[selected].astype(np.int64) - lower_limit) * 12
+
+        # Sum every (row, column) cell at once by flattening the cell into a single index
+        cells = rows * len(crime_types) + cols[selected]
+        totals = np.bincount(cells, weights=self.count[selected], minlength=num_rows * len(crime_types))
+        return totals.reshape(num_rows, len(crime_types)).astype(np.int64)
+
+
+def top_n_indices_with_ties(values, n, descending=True):
+    """ The NumPy version of top_n.query_top_n_with_ties.
+
+    Returns the indices of the n largest (or smallest) values, plus any values tied with the nth, ordered by value.
+    """
+    if n <= 0 or len(values) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    keys = -values if descending else values
+    if n < len(values):
+        # Find the nth value without sorting everything, then keep everything up to and including it
+        nth_key = np.partition(keys, n - 1)[n - 1]
+        idxs = np.nonzero(keys <= nth_key)[0]
+    else:
+        idxs = np.arange(len(values))
+
+    return idxs[np.argsort(keys[idxs], kind="stable")]
+
+
+def load_engine(conn):
+    """
+    Loads a ColumnarEngine from conn and prints how long it took.
+    """
+    start = time.perf_counter()
+    engine = ColumnarEngine.load(conn)
+    print("Loaded {} incidents into the columnar engine in {:.3f}s.".format(len(engine.year),
+                                                                          time.perf_counter() - start))
+    return engine
+
+
+def _fetch_column(conn, query):
+    return [row[0] for row in conn.execute(query).fetchall()]
@@ -0,0 +1,127 @@
+# Shared, reused read-only database connections.
+#
+# Every query path gets its connection from here instead of calling sqlite3.connect itself. Each thread (of each
+# process) gets one tuned connection that is reused for the life of the program, so SQLite's page cache and the
+# prepared statement cache survive between questions.
+
+import os
+import pathlib
+import sqlite3
+import threading
+
+
+# Memory map up to this many bytes of the database file instead of reading pages through the page cache.
+_MMAP_SIZE_BYTES = 256 * 1024 * 1024
+
+# Page cache size per connection. Negative values are in KiB (See the sqlite docs for PRAGMA cache_size).
+_CACHE_SIZE_KIB = 64 * 1024
+
+# Number of prepared statements kept by each connection (the sqlite3 module's own statement cache).
+_NUM_CACHED_STATEMENTS = 256
+
+_DATABASE_PATH = ""
+
+# The class of the connections opened (see set_connection_factory)
+_CONNECTION_FACTORY = sqlite3.Connection
+
+_thread_local = threading.local()
+
+# Every (pid, connection) opened through get_connection, so that they can all be closed on quit.
+_OPEN_CONNECTIONS = []
+_OPEN_CONNECTIONS_LOCK = threading.Lock()
+
+# Bumped every time the connections are closed so that each thread knows to reopen its connection.
+_connection_generation = 0
+
+
+def set_db_path(db_path):
+    """
+    Sets the database used by get_connection. Closes any connections that were opened to the previous database.
+    """
+    global _DATABASE_PATH
+    if db_path != _DATABASE_PATH:
+        close_all_connections()
+    _DATABASE_PATH = db_path
+
+
+def set_connection_factory(factory):
+    """
+    Open every connection as an instance of factory, a subclass of sqlite3.Connection (ex.
+    profiler.ProfiledConnection). Closes the connections that were already opened so they get reopened with it.
+    """
+    global _CONNECTION_FACTORY
+    close_all_connections()
+    _CONNECTION_FACTORY = factory
+
+
+def get_db_path():
+    return _DATABASE_PATH
+
+
+def get_connection():
+    """ Get the connection for the calling thread, opening it on first use.
+
+    The connection is read-only and must not be closed by the caller (see close_all_connections).
+    """
+    conn = getattr(_thread_local, "conn", None)
+    pid = os.getpid()
+
+    # A connection inherited through a fork belongs to the parent process and must not be used by the child.
+    if conn is None or _thread_local.pid != pid or _thread_local.generation != _connection_generation:
+        conn = open_read_only_connection(_DATABASE_PATH)
+        _thread_local.conn = conn
+        _thread_local.pid = pid
+        _thread_local.generation = _connection_generation
+
+        with _OPEN_CONNECTIONS_LOCK:
+            _OPEN_CONNECTIONS.append((pid, conn))
+
+    return conn
+
+
+def open_read_only_connection(db_path):
+    """
+    Opens a new read-only connection to the database at db_path with the tuning PRAGMAs applied.
+    """
+    db_uri = "{}?mode=ro".format(pathlib.Path(db_path).resolve().as_uri())
+
+    # check_same_thread is off only so that close_all_connections can close every thread's connection on quit.
+    # Each connection is still only ever used by the thread that opened it.
+    conn = sqlite3.connect(db_uri, uri=True, check_same_thread=False, cached_statements=_NUM_CACHED_STATEMENTS,
+                           factory=_CONNECTION_FACTORY)
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute("PRAGMA mmap_size = {}".format(_MMAP_SIZE_BYTES))
+    conn.execute("PRAGMA cache_size = {}".format(-_CACHE_SIZE_KIB))
+    return conn
+
+
+def get_db_file_version(db_path):
+    """ Returns the absolute path and the (size, modification time) of the database file and of its -wal file (None
+    for a file that doesn't exist).
+
+    Any write to the database changes it, so it's a cheap fingerprint of the database's contents that can be kept
+    between runs (unlike PRAGMA data_version, which is only meaningful for the life of a connection).
+    """
+    version = []
+    for path in [db_path, db_path + "-wal"]:
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            version.append(None)
+    return (os.path.abspath(db_path), tuple(version))
+
+
+def close_all_connections():
+    """
+    Closes every connection this process opened through get_connection.
+    """
+    global _connection_generation
+    pid = os.getpid()
+
+    with _OPEN_CONNECTIONS_LOCK:
+        for (conn_pid, conn) in _OPEN_CONNECTIONS:
+            if conn_pid == pid:
+                conn.close()
+        _OPEN_CONNECTIONS.clear()
+        _connection_generation += 1
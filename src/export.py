@@ -0,0 +1,284 @@
+# Export the numbers behind Q1-Q4 and the trend anomalies, or raw filtered incidents, to CSV or Parquet.
+# Run with: python export.py --db_path <db> --out <file.csv|file.parquet> <incidents|q1|q2|q3|q4|anomalies> [options]
+#
+# Rows are read in chunks with fetchmany and each chunk is written out before the next one is read, so memory stays
+# flat no matter how many incidents are exported. The question exports write the same rows the questions show (at
+# most one per month or neighbourhood) through the same writers.
+#
+# Parquet files are written one row group per chunk with zstd compression. Writing them needs pyarrow, which is only
+# imported when a Parquet file is written.
+
+import argparse
+import csv
+import importlib.util
+import os
+import time
+
+import a4_specific_utils
+import db_connection
+import menu_options
+import schema
+import utils
+
+
+FORMAT_CSV = "csv"
+FORMAT_PARQUET = "parquet"
+FORMATS = [FORMAT_CSV, FORMAT_PARQUET]
+
+_CHUNK_ROWS = 50000
+
+# Page cache size of the connection export_incidents scans with (in KiB)
+_SCAN_CACHE_SIZE_KIB = 2 * 1024
+
+_PARQUET_COMPRESSION = "zstd"
+
+'''
+The columns of each question's export as (name, type), in order.
+'''
+_QUESTION_COLUMNS = {
+    "Q1": [("Month", "INTEGER"), ("total_incidents", "INTEGER")],
+    "Q2": [("group", "TEXT"), ("Neighbourhood_Name", "TEXT"), ("population", "INTEGER"), ("Latitude", "REAL"),
+           ("Longitude", "REAL")],
+    "Q3": [("incidents", "INTEGER"), ("Neighbourhood_Name", "TEXT"), ("Latitude", "REAL"), ("Longitude", "REAL")],
+    "Q4": [("Neighbourhood_Name", "TEXT"), ("most_common_crime_type", "TEXT"), ("Latitude", "REAL"),
+           ("Longitude", "REAL"), ("population_to_crime_ratio", "REAL")],
+    "TRENDS": [("Neighbourhood_Name", "TEXT"), ("Crime_Type", "TEXT"), ("Year", "INTEGER"), ("Month", "INTEGER"),
+               ("incidents", "INTEGER"), ("expected", "REAL"), ("z_score", "REAL"), ("rolling_avg", "REAL"),
+               ("change_from_year_before", "REAL"), ("Latitude", "REAL"), ("Longitude", "REAL")],
+}
+
+
+'''
+What one export wrote and how long it took.
+'''
+class ExportResult:
+    def __init__(self, out_path, num_rows, elapsed_secs):
+        self.out_path = out_path
+        self.num_rows = num_rows
+        self.elapsed_secs = elapsed_secs
+
+    def rows_per_sec(self):
+        return self.num_rows / self.elapsed_secs if self.elapsed_secs > 0 else 0
+
+    def describe(self):
+        return "Exported {} rows to \"{}\" in {:.3f}s ({:.0f} rows/s, {:.1f}KiB).".format(
+            self.num_rows, self.out_path, self.elapsed_secs, self.rows_per_sec(), os.path.getsize(self.out_path) / 1024)
+
+
+class CsvChunkWriter:
+    def __init__(self, out_path, columns):
+        self._file = open(out_path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([name for (name, _) in columns])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetChunkWriter:
+    def __init__(self, out_path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64(), "TEXT": pa.string()}
+        self._pa = pa
+        self._schema = pa.schema([(name, arrow_types[col_type]) for (name, col_type) in columns])
+        self._writer = pq.ParquetWriter(out_path, self._schema, compression=_PARQUET_COMPRESSION)
+
+    def write(self, rows):
+        # Transpose the chunk's rows into columns
+        columns = list(zip(*rows)) if rows else [[] for _ in self._schema]
+        arrays = [self._pa.array(col, type=field.type) for (col, field) in zip(columns, self._schema)]
+        self._writer.write_batch(self._pa.RecordBatch.from_arrays(arrays, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def export_incidents(out_path, output_format, crime_type=None, start_year=None, end_year=None, neighbourhood=None):
+    """ Export the crime_incidents rows matching every filter that isn't None, streaming them in chunks.
+
+    Uses the database set in db_connection. Returns an ExportResult.
+    """
+    start = time.perf_counter()
+    filters = []
+    params = []
+    for (condition, val) in [("Crime_Type = ?", crime_type), ("Year >= ?", start_year), ("Year <= ?", end_year),
+                             ("Neighbourhood_Name = ?", neighbourhood)]:
+        if val is not None:
+            filters.append(condition)
+            params.append(val)
+
+    # A single pass over the table gains nothing from the shared connections' page cache and memory map, which would
+    # only make the resident memory grow with the table
+    conn = db_connection.open_read_only_connection(db_connection.get_db_path())
+    conn.execute("PRAGMA mmap_size = 0")
+    conn.execute("PRAGMA cache_size = {}".format(-_SCAN_CACHE_SIZE_KIB))
+
+    columns = schema.TABLE_COLUMNS["crime_incidents"]
+    try:
+        # The call to string.format only substitutes hard coded column names and conditions
+        cur = conn.execute("SELECT {} FROM crime_incidents WHERE {}".format(
+            ", ".join(name for (name, _) in columns), " AND ".join(filters) if filters else "1"), params)
+        return _write_chunks(out_path, output_format, columns, iter(lambda: cur.fetchmany(_CHUNK_ROWS), []), start)
+    finally:
+        conn.close()
+
+
+def export_question(q_num, out_path, output_format, *query_args):
+    """ Export the rows of one question (Q1-Q4, or TRENDS for query_trend_anomalies) for the given arguments of its
+    query function.
+
+    Returns an ExportResult.
+    """
+    start = time.perf_counter()
+    if q_num == "Q1":
+        # query_q1 already imported pandas for its DataFrame
+        import pandas as pd
+
+        df = menu_options.query_q1(*query_args)
+        # Months without any incidents of the crime type have no total (NaN, or None when no month has one)
+        rows = [(int(month), None if pd.isna(total) else int(total))
+                for (month, total) in zip(df["Month"], df["total_incidents"])]
+    elif q_num == "Q2":
+        (bot_n_neigh, top_n_neigh) = menu_options.query_q2(*query_args)
+        rows = [("least_populous",) + tuple(row) for row in bot_n_neigh] + \
+               [("most_populous",) + tuple(row) for row in top_n_neigh]
+    elif q_num == "Q3":
+        rows = menu_options.query_q3(*query_args)
+    elif q_num == "Q4":
+        rows = menu_options.query_q4(*query_args)
+    elif q_num == "TRENDS":
+        rows = menu_options.query_trend_anomalies(*query_args)
+    else:
+        raise ValueError("q_num must be one of {} (got {})".format(", ".join(_QUESTION_COLUMNS), q_num))
+
+    chunks = (rows[i:i + _CHUNK_ROWS] for i in range(0, len(rows), _CHUNK_ROWS))
+    return _write_chunks(out_path, output_format, _QUESTION_COLUMNS[q_num], chunks, start)
+
+
+def get_format_for_path(out_path):
+    """
+    Returns the format implied by the extension of out_path, or False if it's neither .csv nor .parquet.
+    """
+    extension = os.path.splitext(out_path)[1].lower().lstrip(".")
+    return extension if extension in FORMATS else False
+
+
+def _write_chunks(out_path, output_format, columns, chunks, start):
+    """
+    Writes every chunk of rows to out_path. Returns an ExportResult timed from start (a time.perf_counter()).
+    """
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+
+    writer = ParquetChunkWriter(out_path, columns) if output_format == FORMAT_PARQUET else \
+        CsvChunkWriter(out_path, columns)
+    num_rows = 0
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+            num_rows += len(chunk)
+        # A Parquet file needs at least one row group to have its schema
+        if num_rows == 0 and output_format == FORMAT_PARQUET:
+            writer.write([])
+    finally:
+        writer.close()
+
+    return ExportResult(out_path, num_rows, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="CMPUT_291 Result Export")
+    parser.add_argument('--db_path', help="The path to the database file to export from", required=True)
+    parser.add_argument('--out', required=True, help="The file to write (.csv or .parquet)")
+    parser.add_argument('--format', choices=FORMATS,
+                        help="The format to write (default: from the extension of --out)")
+    subparsers = parser.add_subparsers(dest="export", required=True)
+
+    incidents_parser = subparsers.add_parser("incidents", help="The crime_incidents rows matching every filter given")
+    incidents_parser.add_argument('--crime_type')
+    incidents_parser.add_argument('--start_year', type=int)
+    incidents_parser.add_argument('--end_year', type=int)
+    incidents_parser.add_argument('--neighbourhood', help="The exact Neighbourhood_Name")
+
+    q1_parser = subparsers.add_parser("q1", help="Total incidents per month of a crime type for a year range")
+    q1_parser.add_argument('--crime_type', required=True)
+    q1_parser.add_argument('--start_year', type=int, required=True)
+    q1_parser.add_argument('--end_year', type=int, required=True)
+
+    q2_parser = subparsers.add_parser("q2", help="The N least and most populous neighborhoods")
+    q2_parser.add_argument('--n', type=int, required=True)
+
+    q3_parser = subparsers.add_parser("q3", help="The top N neighborhoods for a crime type within a year range")
+    q3_parser.add_argument('--crime_type', required=True)
+    q3_parser.add_argument('--start_year', type=int, required=True)
+    q3_parser.add_argument('--end_year', type=int, required=True)
+    q3_parser.add_argument('--n', type=int, required=True)
+
+    q4_parser = subparsers.add_parser(
+        "q4", help="The top N neighborhoods by population to crime ratio within a year range")
+    q4_parser.add_argument('--start_year', type=int, required=True)
+    q4_parser.add_argument('--end_year', type=int, required=True)
+    q4_parser.add_argument('--n', type=int, required=True)
+
+    anomalies_parser = subparsers.add_parser(
+        "anomalies", help="The months of any neighbourhood and crime type most anomalous against their own history")
+    anomalies_parser.add_argument('--start_year', type=int, required=True)
+    anomalies_parser.add_argument('--end_year', type=int, required=True)
+    anomalies_parser.add_argument('--n', type=int, help="Only the N most anomalous (default: every one of them)")
+    anomalies_parser.add_argument('--min_z', type=float, default=3.0,
+                                  help="The lowest absolute z-score to count as an anomaly (default: 3)")
+    args = parser.parse_args()
+
+    output_format = args.format if args.format is not None else get_format_for_path(args.out)
+    if output_format is False:
+        utils.print_error("Can't tell the format of \"{}\", give --format or end it with .csv or .parquet".format(
+            args.out))
+        return
+
+    if output_format == FORMAT_PARQUET and importlib.util.find_spec("pyarrow") is None:
+        utils.print_error("Writing Parquet needs pyarrow (pip install pyarrow), or export to CSV instead.")
+        return
+
+    if not os.path.exists(args.db_path) or not utils.file_is_a_valid_database(args.db_path):
+        utils.print_error("\"{}\" is not an sqlite3 database file.".format(args.db_path))
+        return
+
+    db_connection.set_db_path(args.db_path)
+    a4_specific_utils.init()
+
+    crime_type = getattr(args, "crime_type", None)
+    if crime_type is not None:
+        crime_type = a4_specific_utils.get_valid_crime_type(crime_type)
+        if crime_type is False:
+            utils.print_error("\"{}\" is not a valid crime type.".format(args.crime_type))
+            return
+
+    if (getattr(args, "n", 0) or 0) < 0:
+        utils.print_error("--n must be non-negative (got {})".format(args.n))
+        return
+
+    if args.export == "incidents":
+        result = export_incidents(args.out, output_format, crime_type, args.start_year, args.end_year,
+                                  args.neighbourhood)
+    elif args.export == "q1":
+        result = export_question("Q1", args.out, output_format, crime_type, args.start_year, args.end_year)
+    elif args.export == "q2":
+        result = export_question("Q2", args.out, output_format, args.n)
+    elif args.export == "q3":
+        result = export_question("Q3", args.out, output_format, args.start_year, args.end_year, crime_type, args.n)
+    elif args.export == "q4":
+        result = export_question("Q4", args.out, output_format, args.start_year, args.end_year, args.n)
+    else:
+        result = export_question("TRENDS", args.out, output_format, args.start_year, args.end_year, args.n,
+                                 abs(args.min_z))
+
+    print(result.describe())
+    db_connection.close_all_connections()
+
+
+if __name__ == "__main__":
+    main()
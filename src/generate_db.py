@@ -0,0 +1,162 @@
+# Generates a synthetic database with the same schema as the real one (crime_incidents, population, coordinates),
+# at any scale. Run with: python generate_db.py --out <db> [options]
+#
+# Every (neighbourhood, year, month, crime type) cell gets an incident row with the same probability, chosen so that
+# the database has roughly the requested number of rows. Incident counts are skewed so that some neighbourhoods and
+# crime types are much busier than others, like the real data.
+
+import argparse
+import math
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import schema
+import utils
+
+
+# The crime types in the real database. Any more requested are named "Crime Type N".
+_EDMONTON_CRIME_TYPES = ["Assault", "Break and Enter", "Homicide", "Robbery", "Sexual Assaults", "Theft From Vehicle",
+                         "Theft Of Vehicle", "Theft Over $5000"]
+
+# Roughly the extent of Edmonton
+_MIN_LAT = 53.40
+_MAX_LAT = 53.65
+_MIN_LONG = -113.70
+_MAX_LONG = -113.27
+
+# Share of neighbourhoods with no population (industrial areas, parks, ...) like the real data
+_EMPTY_NEIGHBOURHOOD_RATE = 0.1
+
+_INSERT_BATCH_ROWS = 500000
+
+
+def generate_db(db_path, num_neighbourhoods, start_year, num_years, num_crime_types, num_rows, seed=0):
+    """ Writes a new database to db_path (which must not exist yet).
+
+    Returns the number of incident rows written, which is num_rows give or take the randomness.
+    """
+    num_cells = num_neighbourhoods * num_years * 12 * num_crime_types
+    if num_rows > num_cells:
+        raise ValueError("Can't fit {} incident rows in {} neighbourhoods x {} years x 12 months x {} crime types "
+                         "({} cells)".format(num_rows, num_neighbourhoods, num_years, num_crime_types, num_cells))
+
+    rng = np.random.default_rng(seed)
+    neigh_names = ["NEIGHBOURHOOD {:0{}d}".format(i, len(str(num_neighbourhoods))) for i in range(num_neighbourhoods)]
+    crime_types = (_EDMONTON_CRIME_TYPES + ["Crime Type {}".format(i) for i in
+                                            range(len(_EDMONTON_CRIME_TYPES) + 1, num_crime_types + 1)])
+    crime_types = crime_types[:num_crime_types]
+
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        for table in schema.TABLE_COLUMNS:
+            conn.execute(schema.create_table_sql(table))
+
+        with conn:
+            _insert_population_and_coordinates(conn, rng, neigh_names)
+            num_written = _insert_incidents(conn, rng, neigh_names, start_year, num_years, crime_types,
+                                            num_rows / num_cells)
+    finally:
+        conn.close()
+
+    return num_written
+
+
+def _insert_population_and_coordinates(conn, rng, neigh_names):
+    num = len(neigh_names)
+    tot_pop = rng.lognormal(mean=8, sigma=0.8, size=num).astype(np.int64)
+    tot_pop[rng.random(num) < _EMPTY_NEIGHBOURHOOD_RATE] = 0
+    non_canadian = (tot_pop * rng.uniform(0.05, 0.25, size=num)).astype(np.int64)
+    no_response = (tot_pop * rng.uniform(0, 0.05, size=num)).astype(np.int64)
+    canadian = tot_pop - non_canadian - no_response
+
+    conn.executemany("INSERT INTO population VALUES (?, ?, ?, ?, ?)",
+                     zip(range(1, num + 1), neigh_names, canadian.tolist(), non_canadian.tolist(),
+                         no_response.tolist()))
+
+    lats = rng.uniform(_MIN_LAT, _MAX_LAT, size=num)
+    longs = rng.uniform(_MIN_LONG, _MAX_LONG, size=num)
+    conn.executemany("INSERT INTO coordinates VALUES (?, ?, ?)", zip(neigh_names, lats.tolist(), longs.tolist()))
+
+
+def _insert_incidents(conn, rng, neigh_names, start_year, num_years, crime_types, row_prob):
+    num_types = len(crime_types)
+    # How busy each neighbourhood and crime type is relative to the others
+    neigh_rates = rng.lognormal(mean=0, sigma=1, size=len(neigh_names))
+    type_rates = rng.lognormal(mean=1, sigma=1, size=num_types)
+
+    # Every (year, month, crime type) cell of one neighbourhood, in primary key order
+    cells_per_neigh = num_years * 12 * num_types
+    years = np.repeat(np.arange(start_year, start_year + num_years), 12 * num_types)
+    months = np.tile(np.repeat(np.arange(1, 13), num_types), num_years)
+    types = np.tile(np.arange(num_types), num_years * 12)
+
+    # Inserting in primary key order keeps the inserts appending to the end of the index
+    neighs_per_batch = max(1, _INSERT_BATCH_ROWS // max(1, int(cells_per_neigh * row_prob)))
+    sorted_neighs = sorted(range(len(neigh_names)), key=lambda i: neigh_names[i])
+    num_written = 0
+
+    for batch_start in range(0, len(sorted_neighs), neighs_per_batch):
+        rows = []
+        for neigh in sorted_neighs[batch_start:batch_start + neighs_per_batch]:
+            keep = rng.random(cells_per_neigh) < row_prob
+            counts = rng.poisson(neigh_rates[neigh] * type_rates[types[keep]]) + 1
+            name = neigh_names[neigh]
+            rows.extend(zip([name] * int(keep.sum()), years[keep].tolist(), ((months[keep] - 1) // 3 + 1).tolist(),
+                            months[keep].tolist(), [crime_types[t] for t in types[keep]], counts.tolist()))
+
+        # Crime types aren't in alphabetical order when there are more than the real ones, so sort within the batch
+        rows.sort(key=lambda r: (r[0], r[1], r[3], r[4]))
+        conn.executemany("INSERT INTO crime_incidents VALUES (?, ?, ?, ?, ?, ?)", rows)
+        num_written += len(rows)
+
+    return num_written
+
+
+def get_num_neighbourhoods_for_rows(num_rows, num_years, num_crime_types, fill_rate=0.5):
+    """
+    Returns how many neighbourhoods a database needs so that num_rows rows fill fill_rate of its cells.
+    """
+    return max(1, math.ceil(num_rows / (num_years * 12 * num_crime_types * fill_rate)))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="CMPUT_291 Synthetic Database Generator")
+    parser.add_argument('--out', help="The path of the database file to write", required=True)
+    parser.add_argument('--rows', type=int, default=1000000, help="Roughly how many incident rows to write")
+    parser.add_argument('--neighbourhoods', type=int,
+                        help="The number of neighbourhoods (default: enough for the rows to fill half of the cells)")
+    parser.add_argument('--start_year', type=int, default=2009)
+    parser.add_argument('--years', type=int, default=11, help="The number of years of incidents")
+    parser.add_argument('--crime_types', type=int, default=len(_EDMONTON_CRIME_TYPES),
+                        help="The number of crime types")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.exists(args.out):
+        utils.print_error("\"{}\" already exists!".format(args.out))
+        return
+
+    num_neighbourhoods = args.neighbourhoods
+    if num_neighbourhoods is None:
+        num_neighbourhoods = get_num_neighbourhoods_for_rows(args.rows, args.years, args.crime_types)
+
+    start = time.perf_counter()
+    try:
+        num_written = generate_db(args.out, num_neighbourhoods, args.start_year, args.years, args.crime_types,
+                                  args.rows, args.seed)
+    except ValueError as e:
+        utils.print_error(str(e))
+        return
+
+    elapsed = time.perf_counter() - start
+    print("Wrote {} incidents for {} neighbourhoods to \"{}\" in {:.1f}s ({:.0f} rows/s).".format(
+        num_written, num_neighbourhoods, args.out, elapsed, num_written / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# Precomputed heatmap grids of incident counts.
+# Build them with: python heatmap_grid.py --db_path <db> [--cells 64]
+#
+# The map of Edmonton is split into a fixed grid of cells, and every neighbourhood's incidents are counted in the cell
+# its coordinates fall in, separately for every (year, month, crime type). The counts are stored as one int32 array of
+# shape (years, 12 months, crime types, rows, cols) in a .npy file that is memory mapped when it's loaded, so the
+# heatmap of any year range (and crime types) is a vectorized sum over a slice of it. Scrubbing through years or crime
+# types only reads the slices asked for and never queries crime_incidents.
+#
+# The grids are derived data, built with one pass over crime_incidents and kept under generated_files (see
+# get_grid_dir). They remember the last incident rowid they counted, and load_heatmap_grids refuses grids that are
+# older than the database (ex. after ingest.py appended incidents). get_heatmap_grids checks the grids it already
+# loaded the same way on every call, so a long running server picks up appended incidents too. Like the rollups, in
+# place changes to incidents and changes to coordinates aren't detected, rebuild the grids after making them.
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import a4_specific_utils
+import db_connection
+import utils
+
+
+DEFAULT_NUM_CELLS = 64
+
+_GRIDS_FILE_NAME = "grids.npy"
+_META_FILE_NAME = "meta.json"
+
+_CHUNK_ROWS = 100000
+
+# The grid's bounds are padded by this fraction of their span, so that no neighbourhood sits on the outer edge
+_BOUNDS_PADDING = 0.01
+
+# How many metres one pixel of a map at zoom 12 (see a4_specific_utils.create_new_edmonton_map) spans at Edmonton's
+# latitude, and how many metres one degree of latitude spans
+_METRES_PER_PIXEL = 23
+_METRES_PER_DEGREE_LAT = 111000
+
+# Loaded grids by grid directory (see get_heatmap_grids)
+_LOADED_GRIDS = {}
+_LOADED_GRIDS_LOCK = threading.Lock()
+
+
+'''
+Incident counts per grid cell for every (year, month, crime type).
+'''
+class HeatmapGrids:
+    def __init__(self, counts, years, crime_types, bounds, max_rowid):
+        # int32 array of (year, month, crime type, row, col), usually memory mapped
+        self.counts = counts
+        self.years = years
+        self.crime_types = crime_types
+        self.crime_type_indexes = {crime_type: i for (i, crime_type) in enumerate(crime_types)}
+        # (south, west, north, east) of the whole grid in degrees. Row 0 is the southmost row, col 0 the westmost.
+        self.bounds = bounds
+        # The rowid of the last incident counted
+        self.max_rowid = max_rowid
+
+    def num_rows(self):
+        return self.counts.shape[3]
+
+    def num_cols(self):
+        return self.counts.shape[4]
+
+    def sum_years(self, lower_limit, upper_limit, crime_types=None):
+        """ Sum the grids between the two years (inclusive), of the given crime types or of every crime type if it's
+        None. Crime types that never appear in crime_incidents add nothing.
+
+        Returns an int64 array of (row, col).
+        """
+        first = max(lower_limit, self.years[0]) - self.years[0]
+        last = min(upper_limit, self.years[-1]) - self.years[0]
+        if last < first:
+            return np.zeros((self.num_rows(), self.num_cols()), dtype=np.int64)
+
+        year_slice = self.counts[first:last + 1]
+        if crime_types is not None:
+            type_indexes = sorted(self.crime_type_indexes[t] for t in crime_types if t in self.crime_type_indexes)
+            year_slice = year_slice[:, :, type_indexes]
+        return year_slice.sum(axis=(0, 1, 2), dtype=np.int64)
+
+    def get_cell_centers(self):
+        """
+        Returns the (latitudes, longitudes) of the center of every cell, as two arrays of (row, col).
+        """
+        (south, west, north, east) = self.bounds
+        lats = south + (np.arange(self.num_rows()) + 0.5) * (north - south) / self.num_rows()
+        longs = west + (np.arange(self.num_cols()) + 0.5) * (east - west) / self.num_cols()
+        return np.meshgrid(lats, longs, indexing="ij")
+
+
+def build_heatmap_grids(db_path, num_cells=DEFAULT_NUM_CELLS, grid_dir=None):
+    """ Count every incident of the database into a num_cells x num_cells grid and write the grids to grid_dir
+    (default: get_grid_dir(db_path)), replacing any that were there.
+
+    Returns the HeatmapGrids written.
+    """
+    start = time.perf_counter()
+    grid_dir = get_grid_dir(db_path) if grid_dir is None else grid_dir
+
+    conn = db_connection.open_read_only_connection(db_path)
+    try:
+        coordinates = conn.execute("SELECT Neighbourhood_Name, Latitude, Longitude FROM coordinates \
+                                    WHERE Latitude IS NOT NULL AND Longitude IS NOT NULL").fetchall()
+        (min_year, max_year) = conn.execute("SELECT MIN(Year), MAX(Year) FROM crime_incidents").fetchone()
+        crime_types = [crime_type for (crime_type,) in conn.execute(
+            "SELECT DISTINCT Crime_Type FROM crime_incidents ORDER BY Crime_Type")]
+        max_rowid = _get_max_rowid(conn)
+
+        years = list(range(min_year, max_year + 1)) if min_year is not None else []
+        bounds = _get_grid_bounds(coordinates)
+        counts = np.zeros((len(years), 12, len(crime_types), num_cells, num_cells), dtype=np.int32)
+        cells = _get_neighbourhood_cells(coordinates, bounds, num_cells)
+        crime_type_indexes = {crime_type: i for (i, crime_type) in enumerate(crime_types)}
+
+        # Counting into the flat view of the array, where a cell's index is that of its (year, month, type, row, col)
+        flat_counts = counts.reshape(-1)
+        cells_per_type = num_cells * num_cells
+        cur = conn.execute("SELECT Neighbourhood_Name, Year, Month, Crime_Type, Incidents_Count FROM crime_incidents")
+        for chunk in iter(lambda: cur.fetchmany(_CHUNK_ROWS), []):
+            located = [(cells[n_name], year, month, crime_type, count)
+                       for (n_name, year, month, crime_type, count) in chunk if n_name in cells]
+            if len(located) == 0:
+                continue
+
+            (cell, year, month, crime_type, count) = zip(*located)
+            type_index = np.array([crime_type_indexes[t] for t in crime_type], dtype=np.int64)
+            index = ((np.array(year, dtype=np.int64) - min_year) * 12 + np.array(month, dtype=np.int64) - 1) * \
+                len(crime_types) + type_index
+            index = index * cells_per_type + np.array(cell, dtype=np.int64)
+            np.add.at(flat_counts, index, np.array(count, dtype=np.int32))
+    finally:
+        conn.close()
+
+    grids = HeatmapGrids(counts, years, crime_types, bounds, max_rowid)
+    _write_heatmap_grids(grids, grid_dir)
+    _LOADED_GRIDS.pop(os.path.abspath(grid_dir), None)
+
+    print("Built {} heatmap grids of {}x{} cells in {:.3f}s.".format(
+        len(years) * 12 * len(crime_types), num_cells, num_cells, time.perf_counter() - start))
+    return grids
+
+
+def load_heatmap_grids(db_path, grid_dir=None):
+    """ Memory map the grids built for the database.
+
+    Returns the HeatmapGrids, or None if they were never built or the database has incidents they didn't count.
+    """
+    grid_dir = get_grid_dir(db_path) if grid_dir is None else grid_dir
+    try:
+        with open(os.path.join(grid_dir, _META_FILE_NAME)) as f:
+            meta = json.load(f)
+        counts = np.load(os.path.join(grid_dir, _GRIDS_FILE_NAME), mmap_mode="r")
+    except FileNotFoundError:
+        return None
+
+    conn = db_connection.open_read_only_connection(db_path)
+    try:
+        max_rowid = _get_max_rowid(conn)
+    finally:
+        conn.close()
+    if max_rowid != meta["max_rowid"]:
+        return None
+
+    return HeatmapGrids(counts, meta["years"], meta["crime_types"], tuple(meta["bounds"]), meta["max_rowid"])
+
+
+def get_heatmap_grids():
+    """ Returns the grids of the database set in db_connection, building them first if they are missing or stale.
+
+    Grids that were loaded are kept, and reloaded (or rebuilt) once crime_incidents has incidents they didn't count.
+    """
+    db_path = db_connection.get_db_path()
+    grid_dir = os.path.abspath(get_grid_dir(db_path))
+    # Looking up the last rowid only reads the end of the table's b-tree, so it's cheap enough for every call
+    max_rowid = _get_max_rowid(db_connection.get_connection())
+    # Threads (ex. of server.py) asking at the same time wait for one of them to load or build the grids
+    with _LOADED_GRIDS_LOCK:
+        grids = _LOADED_GRIDS.get(grid_dir)
+        if grids is None or grids.max_rowid != max_rowid:
+            grids = load_heatmap_grids(db_path, grid_dir)
+            if grids is None:
+                print("Building the heatmap grids...")
+                build_heatmap_grids(db_path, grid_dir=grid_dir)
+                grids = load_heatmap_grids(db_path, grid_dir)
+            _LOADED_GRIDS[grid_dir] = grids
+    return grids
+
+
+def get_grid_dir(db_path):
+    """
+    Returns the directory under generated_files the grids of the database at db_path are kept in.
+    """
+    return a4_specific_utils.get_db_files_dir(db_path, "heatmap_grids")
+
+
+def create_heatmap(grids, grid_sum):
+    """
+    Returns a map of Edmonton with a heatmap layer of grid_sum (a sum of the grids, see HeatmapGrids.sum_years).
+    """
+    # Imported here since importing folium is slow and only needed once a map is made
+    import folium.plugins
+
+    cell_px = _get_cell_px(grids)
+    edmonton_map = a4_specific_utils.create_new_edmonton_map()
+    folium.plugins.HeatMap(_get_heatmap_points(grids, grid_sum, grid_sum.max()), radius=cell_px, blur=cell_px,
+                           min_opacity=0.3).add_to(edmonton_map)
+    return edmonton_map
+
+
+def create_heatmap_by_year(grids, lower_limit, upper_limit, crime_types=None):
+    """ Returns a map of Edmonton with one heatmap frame per year between the two years (inclusive), of the given crime
+    types or of every crime type if it's None.
+
+    The frames are scrubbed through with a slider in the browser. They share a scale, so years can be compared.
+    """
+    import folium.plugins
+
+    years = list(range(lower_limit, upper_limit + 1))
+    grid_sums = [grids.sum_years(year, year, crime_types) for year in years]
+    max_val = max(grid_sum.max() for grid_sum in grid_sums) if grid_sums else 0
+
+    cell_px = _get_cell_px(grids)
+    edmonton_map = a4_specific_utils.create_new_edmonton_map()
+    folium.plugins.HeatMapWithTime([_get_heatmap_points(grids, grid_sum, max_val) for grid_sum in grid_sums],
+                                   index=[str(year) for year in years], radius=cell_px, min_opacity=0.3,
+                                   max_opacity=0.8, auto_play=False).add_to(edmonton_map)
+    return edmonton_map
+
+
+def _get_heatmap_points(grids, grid_sum, max_val):
+    """
+    Returns the [lat, long, weight] of every cell of grid_sum with incidents, weighted from 0 to 1 by max_val.
+    """
+    (lats, longs) = grids.get_cell_centers()
+    nonzero = grid_sum > 0
+    weights = grid_sum[nonzero] / max_val if max_val > 0 else grid_sum[nonzero]
+    return np.column_stack([lats[nonzero], longs[nonzero], weights]).round(5).tolist()
+
+
+def _get_max_rowid(conn):
+    return conn.execute("SELECT MAX(rowid) FROM crime_incidents").fetchone()[0] or 0
+
+
+def _get_cell_px(grids):
+    """
+    Returns about how many pixels tall a cell is on a new map, so that heatmap points of neighbouring cells blend.
+    """
+    (south, _, north, _) = grids.bounds
+    return max(5, round((north - south) / grids.num_rows() * _METRES_PER_DEGREE_LAT / _METRES_PER_PIXEL))
+
+
+def _get_grid_bounds(coordinates):
+    """
+    Returns the padded (south, west, north, east) bounds of the coordinates of every neighbourhood.
+    """
+    if len(coordinates) == 0:
+        (lat, long) = a4_specific_utils._FOLIUM_EDMONTON_MAP_COORDS
+        return (lat - 0.5, long - 0.5, lat + 0.5, long + 0.5)
+
+    lats = [lat for (_, lat, _) in coordinates]
+    longs = [long for (_, _, long) in coordinates]
+    # A single neighbourhood (or a line of them) still gets a grid with some area
+    lat_pad = max(max(lats) - min(lats), 0.01) * _BOUNDS_PADDING
+    long_pad = max(max(longs) - min(longs), 0.01) * _BOUNDS_PADDING
+    return (min(lats) - lat_pad, min(longs) - long_pad, max(lats) + lat_pad, max(longs) + long_pad)
+
+
+def _get_neighbourhood_cells(coordinates, bounds, num_cells):
+    """
+    Returns a dict of Neighbourhood_Name -> the flat (row * num_cells + col) index of the cell its coordinates are in.
+    """
+    (south, west, north, east) = bounds
+    cells = {}
+    for (n_name, lat, long) in coordinates:
+        row = min(num_cells - 1, int((lat - south) / (north - south) * num_cells))
+        col = min(num_cells - 1, int((long - west) / (east - west) * num_cells))
+        cells[n_name] = row * num_cells + col
+    return cells
+
+
+def _write_heatmap_grids(grids, grid_dir):
+    """
+    Writes the grids and then their metadata, so a half written directory has no metadata and isn't loaded.
+    """
+    os.makedirs(grid_dir, exist_ok=True)
+    meta_path = os.path.join(grid_dir, _META_FILE_NAME)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    grids_path = os.path.join(grid_dir, _GRIDS_FILE_NAME)
+    # np.save adds .npy to names that don't end with it
+    tmp_grids_path = grids_path + ".tmp.npy"
+    np.save(tmp_grids_path, grids.counts)
+    os.replace(tmp_grids_path, grids_path)
+
+    with open(meta_path, "w") as f:
+        json.dump({"years": grids.years, "crime_types": grids.crime_types, "bounds": list(grids.bounds),
+                   "max_rowid": grids.max_rowid}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="CMPUT_291 Heatmap Grids")
+    parser.add_argument('--db_path', help="The path to the database file to build the grids of", required=True)
+    parser.add_argument('--cells', type=int, default=DEFAULT_NUM_CELLS,
+                        help="The number of rows and of columns of the grid (default: {})".format(DEFAULT_NUM_CELLS))
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db_path) or not utils.file_is_a_valid_database(args.db_path):
+        utils.print_error("\"{}\" is not an sqlite3 database file.".format(args.db_path))
+        return
+
+    if args.cells <= 0:
+        utils.print_error("--cells must be positive (got {})".format(args.cells))
+        return
+
+    grids = build_heatmap_grids(args.db_path, args.cells)
+    print("Wrote the grids of {} years x {} crime types to \"{}\".".format(
+        len(grids.years), len(grids.crime_types), get_grid_dir(args.db_path)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# Index advisor for the Q1-Q4 access patterns.
+#
+# Runs each question's query with sample parameters, recording every SQL statement it executes (through the
+# connection's trace callback so the advisor always sees the same SQL as the menu) along with its EXPLAIN QUERY PLAN.
+# It then creates the covering indexes the questions need, runs ANALYZE, measures again and writes a before/after
+# report.
+
+import os
+import re
+import sqlite3
+import statistics
+import time
+
+import a4_specific_utils
+import db_connection
+import menu_options
+import rollups
+import utils
+
+
+DEFAULT_REPORT_PATH = "{}/index_report.txt".format(a4_specific_utils._GENERATED_FILES_DIR)
+
+_NUM_TIMING_RUNS = 5
+_SAMPLE_N = 10
+_SAMPLE_NUM_YEARS = 3
+
+_STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+# "SCAN t", "SCAN TABLE t" (older SQLite) or "SCAN t USING ...", where t is a table, an alias, a CTE or "(subquery-N)"
+_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\S+)")
+# Words that can follow a table name in a FROM or JOIN without being its alias
+_NOT_ALIASES = {"WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "NATURAL", "ON", "USING", "GROUP", "ORDER",
+                "LIMIT", "UNION", "EXCEPT", "INTERSECT", "WINDOW", "HAVING", "INDEXED", "NOT"}
+
+'''
+The covering indexes the Q1-Q4 queries need as (index name, table, columns).
+'''
+_COVERING_INDEXES = [
+    # Q1 and Q3: a year range of one crime type, grouped by month or neighbourhood
+    ("idx_crime_incidents_type_year_month", "crime_incidents", ["Crime_Type", "Year", "Month", "Incidents_Count"]),
+    ("idx_crime_incidents_type_year_neigh", "crime_incidents",
+     ["Crime_Type", "Year", "Neighbourhood_Name", "Incidents_Count"]),
+    # Q1 (every month with incidents) and Q4: a year range grouped by neighbourhood
+    ("idx_crime_incidents_year_neigh", "crime_incidents", ["Year", "Neighbourhood_Name", "Incidents_Count"]),
+    # Q4: the most common crime type of each neighbourhood
+    ("idx_crime_incidents_neigh_type", "crime_incidents", ["Neighbourhood_Name", "Crime_Type", "Incidents_Count"]),
+    # Q2 and Q4: joins on the neighbourhood name
+    ("idx_population_neigh", "population",
+     ["Neighbourhood_Name", "CANADIAN_CITIZEN", "NON_CANADIAN_CITIZEN", "NO_RESPONSE"]),
+    ("idx_coordinates_neigh", "coordinates", ["Neighbourhood_Name", "Latitude", "Longitude"]),
+]
+
+
+'''
+What was measured for one question: its median query time and the plan of every statement it ran, each plan a list
+of (plan line, whether it's a full scan of a table).
+'''
+class QuestionProfile:
+    def __init__(self, q_num, median_secs, statement_plans):
+        self.q_num = q_num
+        self.median_secs = median_secs
+        self.statement_plans = statement_plans
+
+    def full_scans(self):
+        """
+        Returns a list of (statement, plan line) for every full table scan in the plans.
+        """
+        scans = []
+        for (statement, plan) in self.statement_plans:
+            for (line, is_full_scan) in plan:
+                if is_full_scan:
+                    scans.append((statement, line))
+        return scans
+
+
+def ensure_indexes(db_path, report_path=DEFAULT_REPORT_PATH):
+    """ Report the full scans of each question, create the missing covering indexes and ANALYZE the database.
+
+    Expects db_connection and a4_specific_utils to already be initialized for db_path.
+    Writes the before/after report to report_path and returns the names of the indexes that were created.
+    """
+    questions = _get_sample_questions()
+    if questions is False:
+        return []
+
+    before = [_profile_question(q_num, func) for (q_num, func) in questions]
+    for profile in before:
+        for (statement, line) in profile.full_scans():
+            print("{}: full scan \"{}\" in: {}".format(profile.q_num, line, _shorten(statement)))
+
+    (created, skipped) = _create_indexes(db_path)
+    for name in created:
+        print("Created index {}".format(name))
+
+    after = [_profile_question(q_num, func) for (q_num, func) in questions]
+
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    with open(report_path, "w") as f:
+        _write_report(f, before, after, created, skipped)
+    print("Wrote \"{}\" to disk.".format(report_path))
+
+    return created
+
+
+def _get_sample_questions():
+    """
+    Returns a list of (question number, function running its query) with typical parameters for this database.
+    """
+    cur = db_connection.get_connection().cursor()
+    max_year = cur.execute("SELECT MAX(Year) FROM crime_incidents").fetchone()[0]
+    if max_year is None:
+        utils.print_error("crime_incidents is empty, there is nothing to measure.")
+        return False
+
+    # A range of the most recent years. A range covering every year is always fastest as a full scan.
+    min_year = max_year - _SAMPLE_NUM_YEARS + 1
+
+    # The most common crime type, so the sample is representative of the heaviest Q1/Q3 queries
+    crime_type = cur.execute("SELECT Crime_Type FROM crime_incidents GROUP BY Crime_Type \
+                              ORDER BY COUNT(*) DESC LIMIT 1").fetchone()[0]
+
+    # The functions under the result_cache.cached decorator, so every run executes (and times) the queries
+    return [
+        ("Q1", lambda: menu_options.query_q1.__wrapped__(crime_type, min_year, max_year)),
+        ("Q1 pivot", lambda: menu_options.query_q1_pivot.__wrapped__(tuple(a4_specific_utils.get_crime_types()),
+                                                                     min_year, max_year)),
+        ("Q2", lambda: menu_options.query_q2.__wrapped__(_SAMPLE_N)),
+        ("Q3", lambda: menu_options.query_q3.__wrapped__(min_year, max_year, crime_type, _SAMPLE_N)),
+        ("Q4", lambda: menu_options.query_q4.__wrapped__(min_year, max_year, _SAMPLE_N)),
+    ]
+
+
+def _profile_question(q_num, func):
+    conn = db_connection.get_connection()
+
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        func()
+    finally:
+        conn.set_trace_callback(None)
+
+    # The traced statements have their parameters filled in, so keep only the first statement of each shape
+    # (ex. the same query run with different years)
+    unique_statements = {}
+    for statement in statements:
+        if statement.lstrip().upper().startswith("SELECT"):
+            unique_statements.setdefault(_STRING_LITERAL_RE.sub("?", statement), statement)
+
+    table_names = {row[0].lower() for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    statement_plans = []
+    for statement in unique_statements.values():
+        scannable_names = _get_table_names_and_aliases(statement, table_names)
+        statement_plans.append((statement, [(line, _is_full_scan(line, scannable_names))
+                                            for line in _explain(conn, statement)]))
+
+    times = []
+    for _ in range(_NUM_TIMING_RUNS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return QuestionProfile(q_num, statistics.median(times), statement_plans)
+
+
+def _explain(conn, statement):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statement).fetchall()]
+
+
+def _get_table_names_and_aliases(statement, table_names):
+    """
+    Returns the names (lower case) of the tables the statement reads and the aliases it gives them.
+    """
+    names = set()
+    for (table, alias) in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", statement, re.IGNORECASE):
+        if table.lower() not in table_names:
+            continue
+        names.add(table.lower())
+        if alias and alias.upper() not in _NOT_ALIASES:
+            names.add(alias.lower())
+    return names
+
+
+def _is_full_scan(plan_line, table_names):
+    # "SCAN t USING (COVERING) INDEX ..." only walks an index. Scans of CTEs, subqueries and sqlite_master aren't
+    # scans of the data's tables.
+    match = _SCAN_RE.match(plan_line)
+    return match is not None and "USING" not in plan_line and match.group(1).lower() in table_names
+
+
+def _create_indexes(db_path):
+    """
+    Returns a tuple of (names of the created indexes, (name, reason) of indexes that couldn't be created).
+    """
+    created = []
+    skipped = []
+
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            for (name, table, columns) in _COVERING_INDEXES:
+                table_columns = [row[1].lower() for row in conn.execute("PRAGMA table_info({})".format(table))]
+                missing = [col for col in columns if col.lower() not in table_columns]
+                if missing:
+                    skipped.append((name, "{} is missing the column(s) {}".format(table, ", ".join(missing))))
+                    continue
+
+                exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                                      (name,)).fetchone()
+                if exists is None:
+                    conn.execute("CREATE INDEX {} ON {} ({})".format(name, table, ", ".join(columns)))
+                    created.append(name)
+
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+    return (created, skipped)
+
+
+def _write_report(f, before, after, created, skipped):
+    f.write("Index report\n")
+    f.write("============\n\n")
+    if rollups.rollups_are_fresh(db_connection.get_connection()):
+        f.write("Note: the rollup tables are fresh, so the plans below are for the rollup queries.\n\n")
+
+    f.write("Created indexes: {}\n".format(", ".join(created) if created else "none"))
+    for (name, reason) in skipped:
+        f.write("Skipped index {}: {}\n".format(name, reason))
+    f.write("\n")
+
+    f.write("{:<6}{:>14}{:>14}{:>10}\n".format("", "before (ms)", "after (ms)", "speedup"))
+    for (b, a) in zip(before, after):
+        f.write("{:<6}{:>14.3f}{:>14.3f}{:>9.2f}x\n".format(
+            b.q_num, b.median_secs * 1000, a.median_secs * 1000, b.median_secs / a.median_secs))
+
+    for (b, a) in zip(before, after):
+        f.write("\n{}\n{}\n".format(b.q_num, "-" * len(b.q_num)))
+        for ((statement, before_plan), (_, after_plan)) in zip(b.statement_plans, a.statement_plans):
+            f.write("\n{}\n".format(" ".join(statement.split())))
+            f.write("  before:\n")
+            _write_plan(f, before_plan)
+            f.write("  after:\n")
+            _write_plan(f, after_plan)
+
+
+def _write_plan(f, plan):
+    for (line, is_full_scan) in plan:
+        f.write("    {}{}\n".format(line, "  <-- full scan" if is_full_scan else ""))
+
+
+def _shorten(statement, max_len=100):
+    statement = " ".join(statement.split())
+    return statement if len(statement) <= max_len else statement[:max_len - 3] + "..."
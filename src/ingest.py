@@ -0,0 +1,440 @@
+# Bulk loading of the database from CSV exports. Run with:
+#   python ingest.py --db_path <db> [--crime_incidents <csv>] [--population <csv>] [--coordinates <csv>]
+#   python ingest.py --db_path <db> --append_incidents <csv>
+#
+# Each CSV replaces the rows of its table. It is streamed in fixed size chunks into a staging table, so memory use
+# doesn't depend on the size of the file, and is then swapped in for the old table in a single transaction. A CSV
+# that fails validation part way through leaves the database as it was, and readers never see a half loaded table.
+#
+# append_incidents is the incremental path for new data (ex. each month's incidents): it inserts or updates only the
+# rows of its CSV and folds just those into the rollups.
+#
+# The table's key (and any other index the old table had, ex. from --ensure_indexes) is only built once every row is
+# loaded, which is much faster than updating the indexes row by row. WAL and synchronous=OFF are only used during the
+# load: the database is put back in rollback journal mode afterwards since the program opens it read-only.
+
+import argparse
+import csv
+import itertools
+import os
+import sqlite3
+import time
+
+import a4_specific_utils
+import catalog
+import neighbourhood_dim
+import rollups
+import schema
+import utils
+
+
+_CHUNK_ROWS = 50000
+_ROWS_PER_TRANSACTION = 1000000
+
+_STAGING_TABLE_SUFFIX = "_ingest"
+
+# Scratch tables of append_incidents, only visible to its connection
+_APPEND_TABLE = "temp.crime_incidents_append"
+_APPEND_CHANGES_TABLE = "temp.crime_incidents_changes"
+
+'''
+Columns that can be left out of a CSV, and how to derive them from the other columns of the row.
+'''
+_DERIVED_COLUMNS = {
+    ("crime_incidents", "Quarter"): ("Month", lambda month: (month - 1) // 3 + 1),
+}
+
+_PARSERS = {
+    "INTEGER": int,
+    "REAL": float,
+    "TEXT": str.strip,
+}
+
+
+'''
+How long loading one table took.
+'''
+class IngestResult:
+    def __init__(self, table, num_rows, load_secs, index_secs):
+        self.table = table
+        self.num_rows = num_rows
+        self.load_secs = load_secs
+        self.index_secs = index_secs
+
+    def describe(self):
+        total_secs = self.load_secs + self.index_secs
+        return "Loaded {} rows into {} in {:.3f}s ({:.0f} rows/s, {:.3f}s of it building indexes).".format(
+            self.num_rows, self.table, total_secs, self.num_rows / max(total_secs, 1e-9), self.index_secs)
+
+
+'''
+What append_incidents did. crime_types are the distinct crime types of the CSV's rows, num_new_neighbourhoods the
+number of its neighbourhoods no table named before, and first_month and last_month the (Year, Month) of its earliest
+and latest rows (None if it had none). Enough to update the database's catalog (see catalog.add_appended_incidents).
+'''
+class AppendResult:
+    def __init__(self, num_inserted, num_updated, num_unchanged, crime_types, num_new_neighbourhoods, first_month,
+                 last_month, elapsed_secs):
+        self.num_inserted = num_inserted
+        self.num_updated = num_updated
+        self.num_unchanged = num_unchanged
+        self.crime_types = crime_types
+        self.num_new_neighbourhoods = num_new_neighbourhoods
+        self.first_month = first_month
+        self.last_month = last_month
+        self.elapsed_secs = elapsed_secs
+
+    def describe(self):
+        return "Appended {} new incidents, updated {} and skipped {} unchanged in {:.3f}s.".format(
+            self.num_inserted, self.num_updated, self.num_unchanged, self.elapsed_secs)
+
+
+def ingest_csvs(db_path, csv_paths):
+    """ Replace the rows of each table in csv_paths with the rows of its CSV, creating the database if needed.
+
+    :param csv_paths: A dict of table name -> path of the CSV to load it from. Every table is needed for a new database.
+    Returns a list of IngestResult, or False (after printing an error) if the database or a CSV is invalid.
+    """
+    unknown = [table for table in csv_paths if table not in schema.TABLE_COLUMNS]
+    if unknown:
+        utils.print_error("Unknown table(s): {}".format(", ".join(unknown)))
+        return False
+
+    if not os.path.exists(db_path):
+        missing = [table for table in schema.TABLE_COLUMNS if table not in csv_paths]
+        if missing:
+            utils.print_error("\"{}\" doesn't exist yet, so a CSV is needed for every table (missing: {})".format(
+                db_path, ", ".join(missing)))
+            return False
+    elif not utils.file_is_a_valid_database(db_path):
+        utils.print_error("\"{}\" is not an sqlite3 database file or is corrupted!".format(db_path))
+        return False
+
+    # Transactions are managed by hand so that each chunk doesn't get its own
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
+
+        results = []
+        for (table, csv_path) in csv_paths.items():
+            try:
+                results.append(_ingest_table(conn, table, csv_path))
+            except (ValueError, OSError, sqlite3.IntegrityError) as e:
+                utils.print_error(str(e))
+                return False
+
+        had_rollups = rollups.rollups_exist(conn)
+        problems = schema.get_schema_problems(conn)
+    finally:
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.close()
+
+    for problem in problems:
+        utils.print_error("The database still needs to be loaded: {}".format(problem))
+
+    # The rowids of a reloaded crime_incidents start over, so the rollups' watermark means nothing anymore, and the
+    # neighbourhood dimension table they're built with is derived from all three tables
+    if had_rollups:
+        rollups.refresh_rollups(db_path, rebuild=True)
+
+    return results
+
+
+def append_incidents(db_path, csv_path):
+    """ Insert or update the incidents of the CSV (ex. one new month) in crime_incidents.
+
+    Rows are matched on (Neighbourhood_Name, Year, Month, Crime_Type): a row that is already in the database replaces
+    its count, so appending the same CSV twice changes nothing (if the CSV repeats a row, its last count wins).
+    Every lookup goes through the table's key and the rollups (if any) are only updated with the inserted and changed
+    rows, so the time taken depends on the size of the CSV, not of the database.
+    Returns an AppendResult, or False (after printing an error) if the database or the CSV is invalid.
+    """
+    if not os.path.exists(db_path) or not utils.file_is_a_valid_database(db_path):
+        utils.print_error("\"{}\" is not an sqlite3 database file, load it with ingest_csvs first.".format(db_path))
+        return False
+
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        problems = schema.get_schema_problems(conn, ["crime_incidents"])
+        if problems:
+            utils.print_error("Can't append to \"{}\": {}".format(db_path, "; ".join(problems)))
+            return False
+
+        # The scratch table has the key so that rows repeated in the CSV are only kept once
+        conn.execute(schema.create_table_sql("crime_incidents", _APPEND_TABLE))
+        try:
+            _load_csv(conn, "crime_incidents", _APPEND_TABLE, csv_path, insert_verb="INSERT OR REPLACE")
+        except (ValueError, OSError) as e:
+            utils.print_error(str(e))
+            return False
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = _upsert_appended_incidents(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+    result.elapsed_secs = time.perf_counter() - start
+    return result
+
+
+def _upsert_appended_incidents(conn):
+    keys = schema.TABLE_KEYS["crime_incidents"]
+    cols = ", ".join(name for (name, _) in schema.TABLE_COLUMNS["crime_incidents"])
+    key_join = " AND ".join("c.{key} = a.{key}".format(key=key) for key in keys)
+    _ensure_unique_key(conn, "crime_incidents")
+
+    num_rows = conn.execute("SELECT COUNT(*) FROM {}".format(_APPEND_TABLE)).fetchone()[0]
+    num_matched = conn.execute("SELECT COUNT(*) FROM {} a INNER JOIN crime_incidents c ON {}".format(
+        _APPEND_TABLE, key_join)).fetchone()[0]
+
+    # The rows whose count changes, and by how much, for the rollups
+    conn.execute("CREATE TABLE {changes} AS \
+                  SELECT {a_keys}, a.Incidents_Count - c.Incidents_Count AS count_change, c.rowid AS incident_rowid \
+                  FROM {append} a \
+                  INNER JOIN crime_incidents c ON {key_join} \
+                  WHERE a.Incidents_Count != c.Incidents_Count".format(
+                      changes=_APPEND_CHANGES_TABLE, append=_APPEND_TABLE, key_join=key_join,
+                      a_keys=", ".join("a." + key for key in keys)))
+    num_updated = conn.execute("SELECT COUNT(*) FROM {}".format(_APPEND_CHANGES_TABLE)).fetchone()[0]
+
+    # Rollups from before the neighbourhood dimension table can't be folded into, refresh_rollups rebuilds them
+    had_rollups = rollups.rollups_exist(conn) and neighbourhood_dim.neighbourhood_dim_exists(conn)
+    if had_rollups:
+        # Rows past the watermark aren't in the rollups yet and will be folded in with their new count
+        conn.execute("DELETE FROM {} WHERE incident_rowid > ?".format(_APPEND_CHANGES_TABLE),
+                     (rollups.get_watermark(conn),))
+        rollups.fold_count_changes(conn, _APPEND_CHANGES_TABLE)
+
+    # Counted before the insert, while the new names are only in the scratch table
+    num_new_neighbourhoods = conn.execute("SELECT COUNT(DISTINCT a.Neighbourhood_Name) \
+                                           FROM {} a \
+                                           WHERE a.Neighbourhood_Name IS NOT NULL \
+                                           AND NOT EXISTS (SELECT 1 FROM crime_incidents c \
+                                                           WHERE c.Neighbourhood_Name = a.Neighbourhood_Name) \
+                                           AND a.Neighbourhood_Name NOT IN (SELECT Neighbourhood_Name FROM population \
+                                                                            WHERE Neighbourhood_Name IS NOT NULL) \
+                                           AND a.Neighbourhood_Name NOT IN (SELECT Neighbourhood_Name FROM coordinates \
+                                                                            WHERE Neighbourhood_Name IS NOT NULL)"
+                                          .format(_APPEND_TABLE)).fetchone()[0]
+
+    # Updated rows keep their rowid and new rows are appended past the watermark
+    conn.execute("INSERT INTO crime_incidents ({cols}) \
+                  SELECT {cols} FROM {append} WHERE 1 \
+                  ON CONFLICT ({keys}) DO UPDATE SET Quarter = excluded.Quarter, \
+                                                     Incidents_Count = excluded.Incidents_Count \
+                  WHERE Incidents_Count != excluded.Incidents_Count".format(
+                      cols=cols, append=_APPEND_TABLE, keys=", ".join(keys)))
+
+    if had_rollups:
+        rollups.fold_new_incidents(conn)
+
+    crime_types = [row[0] for row in conn.execute("SELECT DISTINCT Crime_Type FROM {}".format(_APPEND_TABLE))]
+    first_month = conn.execute("SELECT Year, Month FROM {} ORDER BY Year, Month LIMIT 1".format(
+        _APPEND_TABLE)).fetchone()
+    last_month = conn.execute("SELECT Year, Month FROM {} ORDER BY Year DESC, Month DESC LIMIT 1".format(
+        _APPEND_TABLE)).fetchone()
+    return AppendResult(num_rows - num_matched, num_updated, num_matched - num_updated, crime_types,
+                        num_new_neighbourhoods, first_month, last_month, 0)
+
+
+def _ensure_unique_key(conn, table):
+    """
+    Creates the table's unique key index unless the table already has a primary key or unique index on its key.
+    """
+    keys = {key.lower() for key in schema.TABLE_KEYS[table]}
+    for (_, index_name, is_unique, _, _) in conn.execute("PRAGMA index_list({})".format(table)).fetchall():
+        index_cols = {row[2].lower() for row in conn.execute("PRAGMA index_info({})".format(index_name))}
+        if is_unique and index_cols == keys:
+            return
+
+    print("Creating the missing unique index on the key of {}, this is only needed once.".format(table))
+    conn.execute("CREATE UNIQUE INDEX {}_key ON {} ({})".format(table, table, ", ".join(schema.TABLE_KEYS[table])))
+
+
+def _ingest_table(conn, table, csv_path):
+    start = time.perf_counter()
+    staging_table = table + _STAGING_TABLE_SUFFIX
+
+    conn.execute("DROP TABLE IF EXISTS {}".format(staging_table))
+    conn.execute(schema.create_table_sql(table, staging_table, with_primary_key=False))
+
+    try:
+        num_rows = _load_csv(conn, table, staging_table, csv_path)
+        loaded = time.perf_counter()
+        _swap_in_staging_table(conn, table, staging_table)
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.execute("DROP TABLE IF EXISTS {}".format(staging_table))
+        raise
+
+    return IngestResult(table, num_rows, loaded - start, time.perf_counter() - loaded)
+
+
+def _load_csv(conn, table, staging_table, csv_path, insert_verb="INSERT"):
+    """
+    Streams the rows of the CSV into staging_table and returns how many there were.
+    """
+    num_cols = len(schema.TABLE_COLUMNS[table])
+    insert_sql = "{} INTO {} VALUES ({})".format(insert_verb, staging_table, ", ".join(["?"] * num_cols))
+    num_rows = 0
+
+    with open(csv_path, newline='') as f:
+        reader = csv.reader(f)
+        convert_row = _get_row_converter(table, next(reader, None), csv_path)
+
+        conn.execute("BEGIN")
+        # Line 1 is the header
+        line_num = 2
+        while True:
+            chunk = list(itertools.islice(reader, _CHUNK_ROWS))
+            if not chunk:
+                break
+
+            conn.executemany(insert_sql, [convert_row(row, line_num + i) for (i, row) in enumerate(chunk)])
+            line_num += len(chunk)
+
+            # Commit every so often so the WAL doesn't grow to the size of the whole table
+            if num_rows // _ROWS_PER_TRANSACTION != (num_rows + len(chunk)) // _ROWS_PER_TRANSACTION:
+                conn.execute("COMMIT")
+                conn.execute("BEGIN")
+            num_rows += len(chunk)
+        conn.execute("COMMIT")
+
+    return num_rows
+
+
+def _get_row_converter(table, header, csv_path):
+    """ Match the CSV's header to the table's columns.
+
+    Returns a function converting a CSV row (and its line number, for errors) into a list of the table's column
+    values.
+    """
+    if header is None:
+        raise ValueError("\"{}\" is empty, expected a header row".format(csv_path))
+
+    header_idxs = {_normalize_column_name(name): idx for (idx, name) in enumerate(header)}
+    columns = schema.TABLE_COLUMNS[table]
+    col_idxs = [header_idxs.get(name.lower()) for (name, _) in columns]
+
+    missing = [name for ((name, _), idx) in zip(columns, col_idxs)
+               if idx is None and (table, name) not in _DERIVED_COLUMNS]
+    if missing:
+        raise ValueError("\"{}\" is missing the column(s) {} for {} (its header is: {})".format(
+            csv_path, ", ".join(missing), table, ", ".join(header)))
+
+    col_names = [name for (name, _) in columns]
+    # (CSV index, parser) of every column, or (None, None) for derived columns
+    parsed = [(idx, None if idx is None else _PARSERS[col_type]) for ((_, col_type), idx) in zip(columns, col_idxs)]
+    derived = [(pos, col_names.index(_DERIVED_COLUMNS[(table, name)][0]), _DERIVED_COLUMNS[(table, name)][1])
+               for (pos, (name, idx)) in enumerate(zip(col_names, col_idxs)) if idx is None]
+    num_header_cols = len(header)
+
+    def convert_row(row, line_num):
+        if len(row) != num_header_cols:
+            raise ValueError("\"{}\", line {}: expected {} values, got {}".format(
+                csv_path, line_num, num_header_cols, len(row)))
+
+        try:
+            values = [None if idx is None else parse(row[idx]) for (idx, parse) in parsed]
+        except ValueError:
+            raise ValueError("\"{}\", line {}: {}".format(csv_path, line_num, _describe_bad_value(row, parsed,
+                                                                                                   columns))) from None
+
+        for (pos, source_pos, derive) in derived:
+            values[pos] = derive(values[source_pos])
+        return values
+
+    return convert_row
+
+
+def _describe_bad_value(row, parsed, columns):
+    for ((idx, parse), (name, col_type)) in zip(parsed, columns):
+        if idx is None:
+            continue
+        try:
+            parse(row[idx])
+        except ValueError:
+            return "\"{}\" is not a valid {} for {}".format(row[idx], col_type, name)
+    return "invalid row"
+
+
+def _swap_in_staging_table(conn, table, staging_table):
+    """
+    Replaces table with staging_table and builds the key and the old table's indexes on it, in one transaction.
+    """
+    key_index = "{}_key".format(table)
+    old_index_sqls = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name != ? AND sql IS NOT NULL",
+        (table, key_index))]
+
+    conn.execute("BEGIN")
+    conn.execute("DROP TABLE IF EXISTS {}".format(table))
+    conn.execute("ALTER TABLE {} RENAME TO {}".format(staging_table, table))
+
+    try:
+        conn.execute("CREATE UNIQUE INDEX {} ON {} ({})".format(key_index, table, ", ".join(schema.TABLE_KEYS[table])))
+    except sqlite3.IntegrityError:
+        raise sqlite3.IntegrityError("{} has more than one row with the same {}".format(
+            table, ", ".join(schema.TABLE_KEYS[table]))) from None
+
+    for sql in old_index_sqls:
+        conn.execute(sql)
+    conn.execute("COMMIT")
+
+
+def _normalize_column_name(name):
+    # The open data exports name their columns like "Neighbourhood Name"
+    return name.strip().lower().replace(" ", "_").replace("-", "_")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="CMPUT_291 CSV Ingestion")
+    parser.add_argument('--db_path', help="The database file to load the CSVs into (created if it doesn't exist)",
+                        required=True)
+    for table in schema.TABLE_COLUMNS:
+        parser.add_argument('--{}'.format(table), metavar="CSV",
+                            help="Replace the rows of {} with the rows of this CSV (columns: {})".format(
+                                table, ", ".join(name for (name, _) in schema.TABLE_COLUMNS[table])))
+    parser.add_argument('--append_incidents', metavar="CSV",
+                        help="Insert or update the incidents of this CSV (ex. one new month) instead of replacing "
+                             "crime_incidents")
+    args = parser.parse_args()
+
+    if args.append_incidents is not None:
+        # A catalog that was fresh gets the appended incidents instead of going stale (see catalog.py)
+        catalog_path = a4_specific_utils.get_catalog_path(args.db_path)
+        db_catalog = catalog.load_catalog(catalog_path)
+        if db_catalog is not None and not db_catalog.is_fresh(args.db_path):
+            db_catalog = None
+
+        result = append_incidents(args.db_path, args.append_incidents)
+        if result is not False:
+            print(result.describe())
+            if db_catalog is not None:
+                catalog.add_appended_incidents(db_catalog, result)
+                catalog.restamp_catalog(db_catalog, args.db_path, catalog_path)
+        return
+
+    csv_paths = {table: getattr(args, table) for table in schema.TABLE_COLUMNS if getattr(args, table) is not None}
+    if not csv_paths:
+        utils.print_error("Nothing to load, give at least one of --{}".format(" --".join(schema.TABLE_COLUMNS)))
+        return
+
+    results = ingest_csvs(args.db_path, csv_paths)
+    if results is False:
+        return
+
+    for res in results:
+        print(res.describe())
+
+
+if __name__ == "__main__":
+    main()
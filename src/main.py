@@ -1,9 +1,19 @@
 # Entry point into the program.
 
 import argparse
+import os
 import pathlib
 
+import batch
+import db_connection
+import index_advisor
+import ingest
 import menu_options
+import output_cache
+import profiler
+import result_cache
+import rollups
+import schema
 import utils
 import a4_specific_utils
 
@@ -11,12 +21,14 @@ import a4_specific_utils
 '''
 Represents a menu option.
 Stores the string to select it, a string reprenting it's description, and a function pointer to execute it.
+Running it is recorded by --profile unless traced is False.
 '''
 class MenuItem:
-    def __init__(self, selection_string, description, run_func):
+    def __init__(self, selection_string, description, run_func, traced=True):
         self.selection_string = selection_string
         self.description = description
         self.run_func = run_func
+        self.traced = traced
 
 '''
 The program state, but really this just store whether or not the main menu should terminate.
@@ -33,7 +45,12 @@ class ProgramState:
 Main entry point.
 '''
 def main():
-    if not parse_and_handle_input_args():
+    args = parse_and_handle_input_args()
+    if not args:
+        return
+
+    if args.batch is not None:
+        batch.run_batch(args.db_path, args.batch, args.workers, args.engine)
         return
 
     prog_state = ProgramState()
@@ -43,6 +60,16 @@ def main():
         print_menu(menu)
         handle_user_input(menu)
 
+    if result_cache.get_stats() is not None:
+        print(result_cache.get_stats().describe())
+    if output_cache.get_stats() is not None:
+        print(output_cache.get_stats().describe())
+
+    if menu_options.get_parallel_executor() is not None:
+        menu_options.get_parallel_executor().close()
+
+    db_connection.close_all_connections()
+
 
 '''
 Initializes and returns the array of valid menu options.
@@ -57,7 +84,15 @@ def init_menu(prog_state):
                  menu_options.menu_map_of_top_neighborhoods_for_a_given_crime),
         MenuItem("4", "Q4 (Generate map of neighborhoods with the highest crimes to population ratio)",
                  menu_options.menu_map_of_neighborhoods_with_highest_crime_to_population_ratio),
-        MenuItem("q", "Quit", lambda: prog_state.terminate())
+        MenuItem("5", "Q1 pivot (Bar plot or table of crimes/month for several crime types within a year range)",
+                 menu_options.menu_pivot_of_crimes_per_month_for_year_range),
+        MenuItem("6", "Nearby (Generate map of crimes within a radius of a point or of its K nearest neighborhoods)",
+                 menu_options.menu_map_of_crimes_near_a_point),
+        MenuItem("7", "Heatmap (Generate heatmap of crimes for a year range, from precomputed grids)",
+                 menu_options.menu_heatmap_of_crimes_for_year_range),
+        MenuItem("8", "Trends (Generate map of the most anomalous months of any neighborhood and crime type)",
+                 menu_options.menu_map_of_crime_anomalies),
+        MenuItem("q", "Quit", lambda: prog_state.terminate(), traced=False)
     ]
 
 '''
@@ -79,27 +114,120 @@ def handle_user_input(menu):
 
     for menu_item in menu:
         if menu_item.selection_string == user_input:
-            menu_item.run_func()
+            if not menu_item.traced:
+                menu_item.run_func()
+                return
+
+            with profiler.trace(menu_item.description):
+                menu_item.run_func()
             return
 
     print("\"{}\" is not a valid menu choice.".format(user_input))
 
 '''
-Parses and verifies vargs and uses them for any initialization
+Parses and verifies vargs and uses them for any initialization.
+Returns the parsed args, or False if they were invalid.
 '''
 def parse_and_handle_input_args():
     parser = argparse.ArgumentParser(prog="CMPUT_291 Simple Database UI")
     parser.add_argument('--db_path', help="The path to the database file to load", required=True)
+    parser.add_argument('--batch', metavar="JOB_FILE",
+                        help="Run the jobs in the given csv job file (columns: question,crime_type,start_year,end_year,n) "
+                             "instead of showing the menu")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="The number of worker processes to use with --batch or --engine parallel (default: number "
+                             "of cpus)")
+    parser.add_argument('--refresh_rollups', action="store_true",
+                        help="Fold any new incidents into the rollup tables (creating them if needed) before starting")
+    parser.add_argument('--rebuild_rollups', action="store_true",
+                        help="Rebuild the rollup tables from scratch before starting")
+    parser.add_argument('--ensure_indexes', action="store_true",
+                        help="Report full scans in the Q1-Q4 queries, create the covering indexes they need and run "
+                             "ANALYZE before starting")
+    parser.add_argument('--index_report', default=index_advisor.DEFAULT_REPORT_PATH,
+                        help="Where --ensure_indexes writes its before/after report (default: {})"
+                        .format(index_advisor.DEFAULT_REPORT_PATH))
+    parser.add_argument('--append_incidents', metavar="CSV",
+                        help="Insert or update the incidents of this CSV (ex. one new month) before starting")
+    parser.add_argument('--engine', choices=menu_options.ENGINES, default=menu_options.ENGINE_SQLITE,
+                        help="Answer the questions with SQLite queries, load the tables into memory once and answer "
+                             "them with NumPy, or split the years of Q3/Q4 over --workers processes (default: sqlite)")
+    parser.add_argument('--cache_mb', type=int, default=64,
+                        help="Keep up to this many MB of query results in memory to reuse for identical questions "
+                             "(0 turns caching off, default: 64)")
+    parser.add_argument('--cache_dir',
+                        help="Also cache query results in this directory so they are reused between runs")
+    parser.add_argument('--cache_dir_mb', type=int, default=512,
+                        help="The most MB of results kept in --cache_dir (default: 512)")
+    parser.add_argument('--output_cache_mb', type=int, default=256,
+                        help="Keep up to this many MB of maps and plots and reuse them for identical questions instead "
+                             "of rendering them again (0 turns it off, default: 256)")
+    parser.add_argument('--output_cache_dir', default=output_cache.DEFAULT_CACHE_DIR,
+                        help="Where to keep them (default: {})".format(output_cache.DEFAULT_CACHE_DIR))
+    parser.add_argument('--profile', action="store_true",
+                        help="Write a JSON trace of each menu choice: the time of each phase and SQL statement, the rows "
+                             "fetched and each statement's query plan")
+    parser.add_argument('--profile_dir', default=profiler.DEFAULT_PROFILE_DIR,
+                        help="Where --profile writes its traces (default: {})".format(profiler.DEFAULT_PROFILE_DIR))
+    parser.add_argument('--cprofile', action="store_true",
+                        help="With --profile, also run each menu choice under cProfile and dump its stats next to the "
+                             "trace")
     args = parser.parse_args()
 
+    if args.workers < 1:
+        utils.print_error("--workers must be at least 1 (got {})".format(args.workers))
+        return False
+
 
     if not validate_db_path_arg(args.db_path):
         return False
 
-    menu_options.set_db_path(args.db_path)
-    a4_specific_utils.init(args.db_path)
+    db_connection.set_db_path(args.db_path)
+    if args.profile:
+        profiler.init(args.profile_dir, args.cprofile)
 
-    return True
+    problems = schema.get_schema_problems(db_connection.get_connection())
+    if problems:
+        utils.print_error("Database file provided \"{}\" doesn't have the expected tables: {}".format(
+            args.db_path, "; ".join(problems)))
+        return False
+
+    # Loaded before the writes below, so that they keep a fresh catalog fresh instead of leaving it for a rebuild
+    a4_specific_utils.init(rebuild_stale_catalog=False)
+    catalog_was_fresh = a4_specific_utils.get_catalog().is_fresh(args.db_path)
+
+    if args.refresh_rollups or args.rebuild_rollups:
+        rollups.refresh_rollups(args.db_path, rebuild=args.rebuild_rollups)
+
+    if args.append_incidents is not None:
+        result = ingest.append_incidents(args.db_path, args.append_incidents)
+        if result is False:
+            return False
+        print(result.describe())
+        a4_specific_utils.add_appended_incidents(result)
+
+    # Before the caches are turned on, so the advisor measures the queries and not cache hits
+    if args.ensure_indexes:
+        index_advisor.ensure_indexes(args.db_path, args.index_report)
+
+    a4_specific_utils.finish_own_writes(catalog_was_fresh)
+
+    if args.cache_mb > 0 or args.cache_dir is not None:
+        result_cache.init(args.cache_mb * 1024 * 1024, args.cache_dir, args.cache_dir_mb * 1024 * 1024)
+
+    if args.output_cache_mb > 0:
+        output_cache.init(args.output_cache_dir, args.output_cache_mb * 1024 * 1024)
+
+    if args.engine == menu_options.ENGINE_NUMPY:
+        import columnar_engine
+        menu_options.set_engine(columnar_engine.load_engine(db_connection.get_connection()))
+
+    # A batch already spreads its jobs over --workers processes, which answer them like sqlite
+    if args.engine == menu_options.ENGINE_PARALLEL and args.batch is None:
+        import parallel_query
+        menu_options.set_parallel_executor(parallel_query.ParallelExecutor(args.db_path, args.workers))
+
+    return args
 
 
 '''
@@ -120,4 +248,6 @@ def validate_db_path_arg(db_path):
     return True
 
 
-main()
+# Guarded so that worker processes (see batch.py) can re-import this module without running the menu.
+if __name__ == "__main__":
+    main()
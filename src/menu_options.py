@@ -1,20 +1,41 @@
 
 import utils
 import a4_specific_utils
-import folium
+import catalog
+import db_connection
+import neighbourhood_dim
+import output_cache
+import profiler
+import result_cache
+import rollups
+import spatial_index
+import top_n
 from a4_specific_utils import FolioMarker
 
-import sqlite3
-import pandas as pd
-import matplotlib.pyplot as plt
+# pandas and matplotlib are only imported by the questions that use them, since importing them takes longer than
+# everything else at startup.
 
-_DATABASE_PATH = ""
+ENGINE_SQLITE = "sqlite"
+ENGINE_NUMPY = "numpy"
+ENGINE_PARALLEL = "parallel"
+ENGINES = [ENGINE_SQLITE, ENGINE_NUMPY, ENGINE_PARALLEL]
+
+# How run_q1_pivot shows the pivot
+PIVOT_GROUPED = "grouped"
+PIVOT_STACKED = "stacked"
+PIVOT_TABLE = "table"
+PIVOT_OUTPUTS = [PIVOT_GROUPED, PIVOT_STACKED, PIVOT_TABLE]
+
+# If set, the questions are answered by this columnar_engine.ColumnarEngine instead of SQLite
+_ENGINE = None
+
+# If set, Q3 and Q4 are aggregated by this parallel_query.ParallelExecutor, one year partition per process
+_PARALLEL_EXECUTOR = None
 
 month_strs = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
 
 
 def menu_bar_plot_total_crimes_per_month_for_year_range():
-    connection = sqlite3.connect(_DATABASE_PATH)
     crime_type = a4_specific_utils.get_and_validate_crime_type(
         "Enter the crime type you wish to return results for: ")
     if crime_type is False:
@@ -29,33 +50,248 @@ def menu_bar_plot_total_crimes_per_month_for_year_range():
         return
 
     if lower_limit <= upper_limit:
-        # Execute the query
-        df = pd.read_sql_query("SELECT a.Month, b.total_incidents \
+        run_q1(crime_type, lower_limit, upper_limit)
+    else:
+        utils.print_error("Upper year limit must be greater or equal to the lower year limit.")
+
+
+def run_q1(crime_type, lower_limit, upper_limit, show_plot=True):
+    """ Plot the total crimes per month of crime_type between the two years (inclusive) and save it.
+
+    If show_plot is False the plot is drawn headless, without pyplot, so nothing blocks and nothing is left open.
+    Returns the name of the file the plot was written to.
+    """
+    if not show_plot:
+        return _write_q1_plot(crime_type, lower_limit, upper_limit)
+
+    with profiler.phase("query"):
+        df = query_q1(crime_type, lower_limit, upper_limit)
+    plot_name = a4_specific_utils.generate_filename_for_question_file("Q1", "png")
+
+    import matplotlib.pyplot as plt
+
+    with profiler.phase("plot"):
+        fig = plt.figure()
+        plot_q1(df, crime_type, plot_name, fig)
+    plt.show()
+    plt.close(fig)
+    return plot_name
+
+
+@output_cache.cached_output("Q1", "png")
+def _write_q1_plot(crime_type, lower_limit, upper_limit):
+    """
+    Draws the plot of run_q1 headless and returns the name of the file it was written to.
+    """
+    with profiler.phase("query"):
+        df = query_q1(crime_type, lower_limit, upper_limit)
+    plot_name = a4_specific_utils.generate_filename_for_question_file("Q1", "png")
+
+    with profiler.phase("plot"):
+        plot_q1(df, crime_type, plot_name)
+    return plot_name
+
+
+def plot_q1(df, crime_type, plot_name, fig=None):
+    """ Draws the bar plot of a query_q1 result on fig and saves it to plot_name.
+
+    If fig is None the plot is drawn on a new Figure that pyplot doesn't know about, so it is rendered by Agg and freed
+    as soon as it's no longer referenced. This is safe to call from several threads or processes at once.
+    Returns the figure.
+    """
+    if fig is None:
+        from matplotlib.figure import Figure
+        fig = Figure()
+
+    ax = fig.add_subplot()
+
+    # Convert month indexes to month strings
+    df['Month'] = df["Month"].apply(lambda x: month_strs[x - 1])
+    df.plot.bar(x="Month", y="total_incidents", title="Per month incident count for crime type {}".format(crime_type),
+                ax=ax)
+    fig.subplots_adjust(0.13, 0.37, 0.94, 0.92, 0.20, 0.20)
+
+    with profiler.phase("save"):
+        fig.savefig(plot_name, bbox_inches="tight")
+    return fig
+
+
+@result_cache.cached("Q1")
+def query_q1(crime_type, lower_limit, upper_limit):
+    """
+    Returns a DataFrame of (Month, total_incidents) for crime_type between the two years (inclusive).
+    """
+    if _ENGINE is not None:
+        return _ENGINE.query_q1(crime_type, lower_limit, upper_limit)
+
+    import pandas as pd
+
+    connection = db_connection.get_connection()
+
+    if rollups.rollups_are_fresh(connection):
+        return pd.read_sql_query("SELECT a.Month, b.total_incidents \
         FROM ( \
-                Select * \
-                From crime_incidents c \
-                where (c.year >= ? and c.year <= ? ) \
-                Group by c.month) AS a \
-        LEFT JOIN (Select *,c.Month, SUM(c.incidents_count) as total_incidents \
-                From crime_incidents c \
-                where (c.year >= ? and c.year <= ? ) \
-                and c.Crime_type = ?\
-                Group by c.month) as b  on a.Month = b.Month \
-        ", connection, params=(lower_limit, upper_limit, lower_limit, upper_limit, crime_type))
-
-        # Convert month indexes to month strings
-        df['Month'] = df["Month"].apply(lambda x: month_strs[x - 1])
-        df.plot.bar(x="Month", y="total_incidents", title="Per month incident count for crime type {}".format(crime_type))
-        plt.subplots_adjust(0.13, 0.37, 0.94, 0.92, 0.20, 0.20)
-
-        plot_name = a4_specific_utils.generate_filename_for_question_file("Q1", "png")
-
-        plt.plot()
-        plt.savefig(plot_name, bbox_inches="tight")
-        plt.show()
+                SELECT DISTINCT r.Month \
+                FROM {rollup} r \
+                WHERE r.Year >= ? AND r.Year <= ?) AS a \
+        LEFT JOIN (SELECT r.Month, SUM(r.total) as total_incidents \
+                FROM {rollup} r \
+                WHERE r.Year >= ? AND r.Year <= ? \
+                AND r.Crime_Type = ? \
+                GROUP BY r.Month) AS b ON a.Month = b.Month \
+        ORDER BY a.Month".format(rollup=rollups.ROLLUP_MONTH_CRIME_TYPE),
+        connection, params=(lower_limit, upper_limit, lower_limit, upper_limit, crime_type))
+
+    # Execute the query
+    return pd.read_sql_query("SELECT a.Month, b.total_incidents \
+    FROM ( \
+            Select * \
+            From crime_incidents c \
+            where (c.year >= ? and c.year <= ? ) \
+            Group by c.month) AS a \
+    LEFT JOIN (Select *,c.Month, SUM(c.incidents_count) as total_incidents \
+            From crime_incidents c \
+            where (c.year >= ? and c.year <= ? ) \
+            and c.Crime_type = ?\
+            Group by c.month) as b  on a.Month = b.Month \
+    ", connection, params=(lower_limit, upper_limit, lower_limit, upper_limit, crime_type))
+
+
+def menu_pivot_of_crimes_per_month_for_year_range():
+    crime_types = a4_specific_utils.get_and_validate_crime_types(
+        "Enter the crime types you wish to compare, separated by commas (leave empty for all of them): ")
+    if crime_types is False:
+        return
 
-    else:
+    lower_limit = utils.get_and_validate_date("Enter the lower year limit you wish to return from: ")
+    if lower_limit is False:
+        return
+
+    upper_limit = utils.get_and_validate_date("Enter the upper year limit you wish to return from: ")
+    if upper_limit is False:
+        return
+
+    if lower_limit > upper_limit:
         utils.print_error("Upper year limit must be greater or equal to the lower year limit.")
+        return
+
+    by_year = input("Split the months by year? (y/n): ").strip().lower() == "y"
+
+    output = input("Show it as {}: ".format(", ".join(PIVOT_OUTPUTS))).strip().lower()
+    if output not in PIVOT_OUTPUTS:
+        utils.print_error("\"{}\" is not one of {}.".format(output, ", ".join(PIVOT_OUTPUTS)))
+        return
+
+    run_q1_pivot(crime_types, lower_limit, upper_limit, by_year, output)
+
+
+def run_q1_pivot(crime_types, lower_limit, upper_limit, by_year=False, output=PIVOT_GROUPED, show_plot=True):
+    """ Compare the total crimes per month of several crime types between the two years (inclusive) and save it.
+
+    output is PIVOT_GROUPED or PIVOT_STACKED for a bar plot, or PIVOT_TABLE for a CSV table. If by_year is True, each
+    month of each year is its own row. If show_plot is False the plot is drawn headless (see run_q1).
+    Returns the name of the file the plot or table was written to.
+    """
+    with profiler.phase("query"):
+        df = query_q1_pivot(tuple(crime_types), lower_limit, upper_limit, by_year)
+
+    if output == PIVOT_TABLE:
+        table_name = a4_specific_utils.generate_filename_for_question_file("Q1-pivot", "csv")
+        with profiler.phase("save"):
+            df.to_csv(table_name)
+        print("Wrote \"{}\" to disk.".format(table_name))
+        return table_name
+
+    plot_name = a4_specific_utils.generate_filename_for_question_file("Q1-pivot", "png")
+    stacked = output == PIVOT_STACKED
+
+    if not show_plot:
+        with profiler.phase("plot"):
+            plot_q1_pivot(df, plot_name, stacked)
+        return plot_name
+
+    import matplotlib.pyplot as plt
+
+    with profiler.phase("plot"):
+        fig = plt.figure()
+        plot_q1_pivot(df, plot_name, stacked, fig)
+    plt.show()
+    plt.close(fig)
+    return plot_name
+
+
+def plot_q1_pivot(df, plot_name, stacked=False, fig=None):
+    """ Draws the grouped (or stacked) bar plot of a query_q1_pivot result on fig and saves it to plot_name.
+
+    If fig is None the plot is drawn on a new Figure that pyplot doesn't know about (see plot_q1). Returns the figure.
+    """
+    if fig is None:
+        from matplotlib.figure import Figure
+        fig = Figure()
+
+    ax = fig.add_subplot()
+
+    # Label the bars with month strings (and years) instead of the index
+    df = df.copy()
+    if df.index.nlevels == 2:
+        df.index = ["{} {}".format(month_strs[month - 1], year) for (year, month) in df.index]
+    else:
+        df.index = [month_strs[month - 1] for month in df.index]
+
+    df.plot.bar(stacked=stacked, title="Per month incident count by crime type", ax=ax)
+    ax.legend(fontsize="small")
+    fig.subplots_adjust(0.13, 0.37, 0.94, 0.92, 0.20, 0.20)
+
+    with profiler.phase("save"):
+        fig.savefig(plot_name, bbox_inches="tight")
+    return fig
+
+
+@result_cache.cached("Q1_PIVOT")
+def query_q1_pivot(crime_types, lower_limit, upper_limit, by_year=False):
+    """ Get the total incidents of every month by each of crime_types between the two years (inclusive), in a single
+    aggregation no matter how many crime types there are.
+
+    :param crime_types: A tuple of crime types, spelled as in the database. They are the columns, in order.
+    :param by_year: If True, the rows are indexed by (Year, Month) instead of just Month.
+    Returns a DataFrame of int64 counts with a row for every month (of every year) in the range, months without
+    incidents of a crime type being 0.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if by_year:
+        index = pd.MultiIndex.from_product([range(lower_limit, upper_limit + 1), range(1, 13)],
+                                           names=["Year", "Month"])
+    else:
+        index = pd.Index(range(1, 13), name="Month")
+
+    if _ENGINE is not None:
+        totals = _ENGINE.query_q1_pivot(crime_types, lower_limit, upper_limit, by_year)
+        return pd.DataFrame(totals, index=index, columns=list(crime_types))
+
+    connection = db_connection.get_connection()
+    if rollups.rollups_are_fresh(connection):
+        (incidents, count_col) = (rollups.ROLLUP_MONTH_CRIME_TYPE, "total")
+    else:
+        (incidents, count_col) = ("crime_incidents", "Incidents_Count")
+
+    # The call to string.format only substitutes hard coded table/column names and one placeholder per crime type
+    rows = connection.execute("SELECT i.Year, i.Month, i.Crime_Type, SUM(i.{count}) \
+                               FROM {incidents} i \
+                               WHERE i.Year >= ? AND i.Year <= ? AND i.Crime_Type IN ({placeholders}) \
+                               GROUP BY i.Year, i.Month, i.Crime_Type".format(
+                                   incidents=incidents, count=count_col,
+                                   placeholders=", ".join("?" * len(crime_types))),
+                              (lower_limit, upper_limit) + tuple(crime_types)).fetchall()
+
+    type_cols = {crime_type: col for (col, crime_type) in enumerate(crime_types)}
+    totals = np.zeros((len(index), len(crime_types)), dtype=np.int64)
+    for (year, month, crime_type, total) in rows:
+        row = month - 1 + ((year - lower_limit) * 12 if by_year else 0)
+        totals[row, type_cols[crime_type]] += total
+
+    return pd.DataFrame(totals, index=index, columns=list(crime_types))
 
 
 def menu_map_of_n_least_and_most_populous_neighborhoods():
@@ -64,122 +300,176 @@ def menu_map_of_n_least_and_most_populous_neighborhoods():
     if n is False:
         return
 
+    return run_q2(n)
+
+
+@output_cache.cached_output("Q2", "html")
+def run_q2(n):
+    """ Map the N least (red) and most (blue) populous neighborhoods and save it.
+
+    Returns the name of the file the map was written to, or None if there was nothing to map.
+    """
+    with profiler.phase("query"):
+        (bot_n_neigh, top_n_neigh) = query_q2(n)
+    if len(top_n_neigh) == 0:
+        utils.print_error("No neighborhoods to map.")
+        return None
+
+    edmonton_map = create_q2_map(bot_n_neigh, top_n_neigh)
+
+    with profiler.phase("save"):
+        return a4_specific_utils.write_map_to_file(edmonton_map, "Q2")
+
+
+def create_q2_map(bot_n_neigh, top_n_neigh):
+    """
+    Returns the map of a query_q2 result: the least populous neighborhoods in red and the most populous in blue.
+    """
+    with profiler.phase("markers"):
+        bot_markers = create_marker_for_q2_query_items(bot_n_neigh, "red")
+        top_markers = create_marker_for_q2_query_items(top_n_neigh, "blue")
+        avg_val = get_avg_marker_val(top_markers)
+
+    with profiler.phase("map"):
+        edmonton_map = a4_specific_utils.create_new_edmonton_map(len(bot_markers) + len(top_markers))
+        a4_specific_utils.add_markers_to_map(edmonton_map, bot_markers, avg_val)
+        a4_specific_utils.add_markers_to_map(edmonton_map, top_markers, avg_val)
+    return edmonton_map
+
+
+@result_cache.cached("Q2")
+def query_q2(n):
+    """ Get the N least and most populous neighborhoods (including ties).
+
+    Returns a tuple of (least populous, most populous) lists of (n_name, tot_pop, lat, long) rows.
+    """
     # If N is greater than half of the number of neighborhoods then we need to clamp it at num_neigh / 2.
     # This is because if we have 60 records and N is 40, then the 10 smallest/largest population circles will overlap.
-    num_neigh = a4_specific_utils.get_num_neighborhoods()
-    largest_needs_to_take_an_extra_neigh = False
-    if (n > (num_neigh / 2)):
-        n = num_neigh / 2
+    # Counted here rather than taken from the catalog, which may be stale and isn't part of the cache key.
+    conn = db_connection.get_connection()
+    num_neigh = catalog.count_neighbourhoods_with_pop(conn)
+    num_most_populous = n
+    if (n > (num_neigh // 2)):
+        n = num_neigh // 2
+        num_most_populous = n
+        # With an odd number of neighborhoods, the largest ones take the one in the middle
         if num_neigh % 2 != 0:
-            largest_needs_to_take_an_extra_neigh = True
-
-    top_n = n if not largest_needs_to_take_an_extra_neigh else n + 1
-
-    q2_get_last_item_query = "SELECT tot_pop \
-                              FROM \
-                              ( \
-                              SELECT p.Neighbourhood_Name as n_name, (p.CANADIAN_CITIZEN + p.NON_CANADIAN_CITIZEN + p.NO_RESPONSE) as tot_pop \
-                              FROM POPULATION p \
-                              ) \
-                              INNER JOIN COORDINATES c ON n_name = c.Neighbourhood_Name \
-                              WHERE tot_pop > 0 AND c.Latitude != 0 AND c.Longitude != 0 \
-                              ORDER BY tot_pop {} \
-                              LIMIT ?,1"
-
-    q2_query_str = "SELECT n_name, tot_pop, c.Latitude, c.Longitude \
-                    FROM \
-                    ( \
-                    SELECT p.Neighbourhood_Name as n_name, (p.CANADIAN_CITIZEN + p.NON_CANADIAN_CITIZEN + p.NO_RESPONSE) as tot_pop \
-                    FROM POPULATION p \
-                    ) \
-                    INNER JOIN COORDINATES c ON n_name = c.Neighbourhood_Name \
-                    WHERE tot_pop > 0 AND tot_pop {} ? AND c.Latitude != 0 AND c.Longitude != 0 \
-                    ORDER BY tot_pop {}"
-
-    conn = sqlite3.connect(_DATABASE_PATH)
-    cur = conn.cursor()
-
-    # Get the pop of the neighborhoods at the bottom of the queries
-    # The calls to string.format should be safe since we are substituing hard coded values
-    bot_n_neigh_largest_pop = cur.execute(q2_get_last_item_query.format("ASC"), (n - 1,)).fetchall()[0][0]
-    top_n_neigh_smallest_pop = cur.execute(q2_get_last_item_query.format("DESC"), (top_n - 1,)).fetchall()[0][0]
-
-
-    # Use a where clause to capture any ties
-    bot_n_neigh = cur.execute(q2_query_str.format("<=", "ASC"), (bot_n_neigh_largest_pop,)).fetchall()
-    top_n_neigh = cur.execute(q2_query_str.format(">=", "DESC"), (top_n_neigh_smallest_pop,)).fetchall()
-
-    bot_markers = create_marker_for_q2_query_items(bot_n_neigh, "red")
-    top_markers = create_marker_for_q2_query_items(top_n_neigh, "blue")
+            num_most_populous = n + 1
 
-    sum = 0
-    for marker in top_markers:
-        sum += marker.val
-    avg_val = sum / len(top_markers)
+    if _ENGINE is not None:
+        return _ENGINE.query_q2(n, num_most_populous)
+
+    if neighbourhood_dim.neighbourhood_dim_exists(conn):
+        # The total population is precomputed and the coordinates are on the same row, so there is nothing to join
+        q2_query_str = "SELECT Neighbourhood_Name as n_name, Total_Population as tot_pop, Latitude, Longitude \
+                        FROM {} \
+                        WHERE tot_pop > 0 AND Latitude != 0 AND Longitude != 0".format(
+                            neighbourhood_dim.NEIGHBOURHOOD_DIM)
+    else:
+        q2_query_str = "SELECT n_name, tot_pop, c.Latitude, c.Longitude \
+                        FROM \
+                        ( \
+                        SELECT p.Neighbourhood_Name as n_name, (p.CANADIAN_CITIZEN + p.NON_CANADIAN_CITIZEN + p.NO_RESPONSE) as tot_pop \
+                        FROM POPULATION p \
+                        ) \
+                        INNER JOIN COORDINATES c ON n_name = c.Neighbourhood_Name \
+                        WHERE tot_pop > 0 AND c.Latitude != 0 AND c.Longitude != 0"
+
+    # Ties with the last neighborhood are included
+    bot_n_neigh = top_n.query_top_n_with_ties(conn, q2_query_str, (), "tot_pop", n, top_n.ASC)
+    top_n_neigh = top_n.query_top_n_with_ties(conn, q2_query_str, (), "tot_pop", num_most_populous,
+                                              top_n.DESC)
 
-    edmonton_map = a4_specific_utils.create_new_edmonton_map()
-    a4_specific_utils.add_markers_to_map(edmonton_map, bot_markers, avg_val)
-    a4_specific_utils.add_markers_to_map(edmonton_map, top_markers, avg_val)
-    a4_specific_utils.write_map_to_file(edmonton_map, "Q2")
+    return (bot_n_neigh, top_n_neigh)
 
 
 def menu_map_of_top_neighborhoods_for_a_given_crime():
-    #print("TODO: map_of_top_neighborhoods_for_a_given_crime")
-    
-    connection = sqlite3.connect(_DATABASE_PATH)
-    cur = connection.cursor()
-    
     lower_limit = utils.input_int_and_validate_with_predicate("Enter start year: ",check_if_int_is_year_format)
+    if lower_limit is False:
+        return
+
     upper_limit = utils.input_int_and_validate_with_predicate("Enter end year: ",check_if_int_is_year_format)
+    if upper_limit is False:
+        return
+
     crime_type = input("Enter crime type: ")
     num_neighborhood = utils.input_int_and_validate_with_predicate("Enter number of neighborhoods: ",check_if_int_is_non_negative_and_handle)
-    
-    cur.execute("SELECT sum(i.Incidents_Count) as counts, i.Neighbourhood_Name, c.Latitude, c.Longitude \
+    if num_neighborhood is False:
+        return
+
+    return run_q3(lower_limit, upper_limit, crime_type, num_neighborhood)
+
+
+@output_cache.cached_output("Q3", "html")
+def run_q3(lower_limit, upper_limit, crime_type, num_neighborhood):
+    """ Map the top num_neighborhood neighborhoods for crime_type between the two years and save it.
+
+    Returns the name of the file the map was written to, or None if there was nothing to map.
+    """
+    with profiler.phase("query"):
+        newList = query_q3(lower_limit, upper_limit, crime_type, num_neighborhood)
+    if len(newList) == 0:
+        utils.print_error("No neighborhoods had any \"{}\" incidents between {} and {}.".format(
+            crime_type, lower_limit, upper_limit))
+        return None
+
+    edmonton_map = create_q3_map(newList)
+
+    with profiler.phase("save"):
+        return a4_specific_utils.write_map_to_file(edmonton_map, "Q3")
+
+
+def create_q3_map(query_items):
+    """
+    Returns the map of a query_q3 result.
+    """
+    with profiler.phase("markers"):
+        markers = create_markers_for_q3_query_items(query_items)
+
+    with profiler.phase("map"):
+        edmonton_map = a4_specific_utils.create_new_edmonton_map(len(markers))
+        a4_specific_utils.add_markers_to_map(edmonton_map, markers, get_avg_marker_val(markers))
+    return edmonton_map
+
+
+@result_cache.cached("Q3")
+def query_q3(lower_limit, upper_limit, crime_type, num_neighborhood):
+    """ Get the top num_neighborhood neighborhoods for crime_type between the two years (including ties).
+
+    Returns a list of (counts, Neighbourhood_Name, Latitude, Longitude) rows ordered by counts.
+    """
+    if _ENGINE is not None:
+        return _ENGINE.query_q3(lower_limit, upper_limit, crime_type, num_neighborhood)
+    if _PARALLEL_EXECUTOR is not None:
+        return _PARALLEL_EXECUTOR.query_q3(lower_limit, upper_limit, crime_type, num_neighborhood)
+
+    connection = db_connection.get_connection()
+    params = (str(lower_limit), str(upper_limit), crime_type)
+
+    if rollups.rollups_are_fresh(connection):
+        # The rollup is keyed by neighbourhood id and the dimension table has the coordinates (see neighbourhood_dim)
+        # The call to string.format only substitutes hard coded table names
+        return top_n.query_top_n_with_ties(connection, "SELECT sum(r.total) as counts, d.Neighbourhood_Name, d.Latitude, d.Longitude \
+        FROM {rollup} r \
+        INNER JOIN {dim} d ON d.Neighbourhood_Id = r.Neighbourhood_Id \
+        WHERE r.Year >= ? AND \
+            r.Year <= ? AND \
+            r.Crime_Type = ? AND \
+            d.Latitude IS NOT NULL \
+        GROUP BY r.Neighbourhood_Id".format(rollup=rollups.ROLLUP_YEAR_CRIME_TYPE_NEIGHBOURHOOD,
+                                            dim=neighbourhood_dim.NEIGHBOURHOOD_DIM),
+            params, "counts", num_neighborhood)
+
+    return top_n.query_top_n_with_ties(connection, "SELECT sum(i.Incidents_Count) as counts, i.Neighbourhood_Name, c.Latitude, c.Longitude \
     FROM coordinates c  \
     LEFT JOIN crime_incidents i on c.Neighbourhood_Name = i.Neighbourhood_Name  \
     WHERE i.Year >= ? AND  \
 	i.Year <= ? AND  \
 	i.Crime_Type = ?  \
-        GROUP BY i.Neighbourhood_Name  \
-        ORDER BY counts DESC  \
-        LIMIT ?  " , (str(lower_limit), str(upper_limit),crime_type,str(num_neighborhood)) )
-    
-    nList = cur.fetchall()
-    bot_of_top = nList[num_neighborhood-1][0]
-    #print(nList)
-    
-    
-    cur.execute("SELECT sum(i.Incidents_Count) as counts, i.Neighbourhood_Name, c.Latitude, c.Longitude \
-    FROM coordinates c  \
-    LEFT JOIN crime_incidents i on c.Neighbourhood_Name = i.Neighbourhood_Name  \
-    WHERE i.Year >= ? AND  \
-	i.Year <= ? AND  \
-	i.Crime_Type = ? \
-        GROUP BY i.Neighbourhood_Name \
-        HAVING counts >= ? \
-        ORDER BY counts DESC" , (str(lower_limit), str(upper_limit),crime_type, bot_of_top) )
-    
-    newList = cur.fetchall()
-    markers = []
-    avg_val = 0
-
-    edmonton_map = a4_specific_utils.create_new_edmonton_map()
-
-    for n in newList:
-        nPopup = "%s <br> %s" % (n[1],n[0])
-        markers.append(FolioMarker([n[2], n[3]], nPopup, 'crimson', n[0]))
-        avg_val += n[0]
-
-    avg_val /= len(newList)
-    a4_specific_utils.add_markers_to_map(edmonton_map, markers, avg_val)
-    a4_specific_utils.write_map_to_file(edmonton_map, "Q3")
-    
-    
-    
+        GROUP BY i.Neighbourhood_Name", params, "counts", num_neighborhood)
+
+
 def menu_map_of_neighborhoods_with_highest_crime_to_population_ratio():
-    connection = sqlite3.connect(_DATABASE_PATH)
-    cur = connection.cursor()
-    
     lower_limit = utils.get_and_validate_date("Enter the lower year limit you wish to return from: ")
     if lower_limit is False:
         return
@@ -195,68 +485,353 @@ def menu_map_of_neighborhoods_with_highest_crime_to_population_ratio():
         check_if_int_is_non_negative_and_handle)
     if n is False:
         return    
-    
-    edmonton_map = a4_specific_utils.create_new_edmonton_map()
-    
-    cur.execute("SELECT n_name, tot_pop, SUM(c.Incidents_Count), CAST(tot_pop AS FLOAT) / CAST(SUM(c.Incidents_Count) AS FLOAT) as pop_crime_rat \
-    FROM \
-    ( \
-        SELECT p.Neighbourhood_Name as n_name, (p.CANADIAN_CITIZEN + p.NON_CANADIAN_CITIZEN + p.NO_RESPONSE) as tot_pop \
-        FROM POPULATION p \
-    ) \
-    INNER JOIN crime_incidents c ON n_name = c.Neighbourhood_Name \
-    WHERE c.Year >= ? AND \
-            c.Year <= ? \
-    GROUP BY n_name \
-    ORDER BY pop_crime_rat DESC \
-    LIMIT ?", (str(lower_limit), str(upper_limit) , n)) 
-    
-    list_rat = cur.fetchall()
-    bot_of_top = list_rat[n-1][3]
-    
-    #print(list_rat)
-    #print(bot_of_top)
-    
-    
-    cur.execute("SELECT n_name, tot_pop, SUM(c.Incidents_Count), CAST(tot_pop AS FLOAT) / CAST(SUM(c.Incidents_Count) AS FLOAT) as pop_crime_rat \
-    FROM \
-    ( \
-        SELECT p.Neighbourhood_Name as n_name, (p.CANADIAN_CITIZEN + p.NON_CANADIAN_CITIZEN + p.NO_RESPONSE) as tot_pop \
-        FROM POPULATION p \
+
+    return run_q4(lower_limit, upper_limit, n)
+
+
+@output_cache.cached_output("Q4", "html")
+def run_q4(lower_limit, upper_limit, n):
+    """ Map the top N neighborhoods by population to crime ratio between the two years and save it.
+
+    Returns the name of the file the map was written to, or None if there was nothing to map.
+    """
+    with profiler.phase("query"):
+        rows = query_q4(lower_limit, upper_limit, n)
+    if len(rows) == 0:
+        utils.print_error("No neighborhoods had any incidents between {} and {}.".format(lower_limit, upper_limit))
+        return None
+
+    edmonton_map = create_q4_map(rows)
+
+    with profiler.phase("save"):
+        return a4_specific_utils.write_map_to_file(edmonton_map, "Q4")
+
+
+def create_q4_map(query_items):
+    """
+    Returns the map of a query_q4 result.
+    """
+    with profiler.phase("markers"):
+        markers = create_markers_for_q4_query_items(query_items)
+
+    with profiler.phase("map"):
+        edmonton_map = a4_specific_utils.create_new_edmonton_map(len(markers))
+        a4_specific_utils.add_markers_to_map(edmonton_map, markers, get_avg_marker_val(markers))
+    return edmonton_map
+
+
+@result_cache.cached("Q4")
+def query_q4(lower_limit, upper_limit, n):
+    """ Get the top N neighborhoods by population to crime ratio between the two years (including ties).
+
+    Returns a list of (Neighbourhood_Name, most common Crime_Type, Latitude, Longitude, ratio) rows ordered by ratio.
+    The most common crime type is also taken from between the two years.
+    """
+    if _ENGINE is not None:
+        return _ENGINE.query_q4(lower_limit, upper_limit, n)
+    if _PARALLEL_EXECUTOR is not None:
+        return _PARALLEL_EXECUTOR.query_q4(lower_limit, upper_limit, n)
+
+    connection = db_connection.get_connection()
+    params = (str(lower_limit), str(upper_limit))
+
+    # Everything is computed in one pass over the year range: the per crime type counts of each neighbourhood give both
+    # the neighbourhood's total (for the ratio) and its most common crime type.
+    if rollups.rollups_are_fresh(connection):
+        # The rollup is keyed by neighbourhood id and the dimension table has the total population and the coordinates
+        # (see neighbourhood_dim), so the only join is on the id.
+        # The call to string.format only substitutes hard coded table names
+        return top_n.query_top_n_with_ties(connection, "WITH type_counts AS ( \
+            SELECT r.Neighbourhood_Id AS n_id, r.Crime_Type AS crime_type, SUM(r.total) AS type_count \
+            FROM {rollup} r \
+            WHERE r.Year >= ? AND r.Year <= ? \
+            GROUP BY r.Neighbourhood_Id, r.Crime_Type \
+        ), \
+        ranked_types AS ( \
+            SELECT n_id, crime_type, \
+                   SUM(type_count) OVER (PARTITION BY n_id) AS tot_crime, \
+                   ROW_NUMBER() OVER (PARTITION BY n_id ORDER BY type_count DESC, crime_type) AS type_rank \
+            FROM type_counts \
+        ) \
+        SELECT d.Neighbourhood_Name, t.crime_type, d.Latitude, d.Longitude, \
+               CAST(d.Total_Population AS FLOAT) / CAST(t.tot_crime AS FLOAT) AS pop_crime_rat \
+        FROM ranked_types t \
+        INNER JOIN {dim} d ON d.Neighbourhood_Id = t.n_id \
+        WHERE t.type_rank = 1 AND t.tot_crime > 0 AND d.Total_Population IS NOT NULL AND d.Latitude IS NOT NULL".format(
+            rollup=rollups.ROLLUP_YEAR_CRIME_TYPE_NEIGHBOURHOOD, dim=neighbourhood_dim.NEIGHBOURHOOD_DIM),
+            params, "pop_crime_rat", n)
+
+    return top_n.query_top_n_with_ties(connection, "WITH type_counts AS ( \
+        SELECT i.Neighbourhood_Name AS n_name, i.Crime_Type AS crime_type, SUM(i.Incidents_Count) AS type_count \
+        FROM crime_incidents i \
+        WHERE i.Year >= ? AND i.Year <= ? \
+        GROUP BY i.Neighbourhood_Name, i.Crime_Type \
+    ), \
+    ranked_types AS ( \
+        SELECT n_name, crime_type, \
+               SUM(type_count) OVER (PARTITION BY n_name) AS tot_crime, \
+               ROW_NUMBER() OVER (PARTITION BY n_name ORDER BY type_count DESC, crime_type) AS type_rank \
+        FROM type_counts \
     ) \
-    INNER JOIN crime_incidents c ON n_name = c.Neighbourhood_Name \
-    WHERE c.Year >= ? AND \
-            c.Year <= ? \
-    GROUP BY n_name \
-    HAVING pop_crime_rat >= ?\
-    ORDER BY pop_crime_rat DESC ", (str(lower_limit), str(upper_limit) , bot_of_top)) 
-    
-    newRat = cur.fetchall()
-    
-    markers = []
-    avg_val = 0
-
-    for rat in newRat:
-        cur.execute("SELECT c.Neighbourhood_Name, c.Crime_type, l.Latitude, l.Longitude \
-        From crime_incidents c, coordinates l \
-        where c.Neighbourhood_name = ? AND \
-                l.Neighbourhood_Name = c.Neighbourhood_Name \
-        GROUP BY c.Crime_type \
-        ORDER BY sum(c.Incidents_count) DESC LIMIT 1", (rat[0], ))
-        cType = cur.fetchall()
-        nPopup = "%s <br> %s <br> %s" % (cType[0][0] , cType[0][1] , rat[3])
-
-        markers.append(FolioMarker([cType[0][2], cType[0][3]], nPopup, 'crimson', rat[3]))
-        avg_val += rat[3]
-
-    avg_val /= len(newRat)
-    a4_specific_utils.add_markers_to_map(edmonton_map, markers, avg_val)
-    a4_specific_utils.write_map_to_file(edmonton_map, "Q4")
-    
-    
-def set_db_path(db_path):
-    global _DATABASE_PATH
-    _DATABASE_PATH = db_path
+    SELECT t.n_name, t.crime_type, l.Latitude, l.Longitude, \
+           CAST(p.CANADIAN_CITIZEN + p.NON_CANADIAN_CITIZEN + p.NO_RESPONSE AS FLOAT) / CAST(t.tot_crime AS FLOAT) AS pop_crime_rat \
+    FROM ranked_types t \
+    INNER JOIN population p ON p.Neighbourhood_Name = t.n_name \
+    INNER JOIN coordinates l ON l.Neighbourhood_Name = t.n_name \
+    WHERE t.type_rank = 1 AND t.tot_crime > 0", params, "pop_crime_rat", n)
+
+
+def menu_map_of_crimes_near_a_point():
+    lat = utils.input_float("Enter the latitude of the point: ")
+    if lat is False:
+        return
+
+    long = utils.input_float("Enter the longitude of the point: ")
+    if long is False:
+        return
+
+    radius_km = None
+    k = None
+    mode = input("Search within a radius (r) or for the K nearest neighborhoods (k)? ").strip().lower()
+    if mode == "r":
+        radius_km = utils.input_float("Enter the radius in km: ")
+        if radius_km is False:
+            return
+        if radius_km < 0:
+            utils.print_error("The radius can not be negative (got {})".format(radius_km))
+            return
+    elif mode == "k":
+        k = utils.input_int_and_validate_with_predicate("Enter K: ", check_if_int_is_non_negative_and_handle)
+        if k is False:
+            return
+    else:
+        utils.print_error("\"{}\" is not r or k.".format(mode))
+        return
+
+    lower_limit = utils.get_and_validate_date("Enter the lower year limit you wish to return from: ")
+    if lower_limit is False:
+        return
+
+    upper_limit = utils.get_and_validate_date("Enter the upper year limit you wish to return from: ")
+    if upper_limit is False:
+        return
+
+    if lower_limit > upper_limit:
+        utils.print_error("Upper year limit must be greater or equal to the lower year limit.")
+        return
+
+    crime_type = input("Enter the crime type (leave empty for every crime type): ").strip()
+    if crime_type == "":
+        crime_type = None
+    else:
+        valid_crime_type = a4_specific_utils.get_valid_crime_type(crime_type)
+        if valid_crime_type is False:
+            utils.print_error("\"{}\" is not a valid crime type.".format(crime_type))
+            return
+        crime_type = valid_crime_type
+
+    return run_nearby(lat, long, lower_limit, upper_limit, crime_type, radius_km, k)
+
+
+@output_cache.cached_output("Nearby", "html")
+def run_nearby(lat, long, lower_limit, upper_limit, crime_type=None, radius_km=None, k=None):
+    """ Map the incident totals of the neighborhoods within radius_km of the point, or of its k nearest
+    neighborhoods if radius_km is None, between the two years (of crime_type, or of every crime type if it's None).
+
+    Returns the name of the file the map was written to, or None if there was nothing to map.
+    """
+    with profiler.phase("query"):
+        if radius_km is not None:
+            rows = spatial_index.query_within_radius(lat, long, radius_km, lower_limit, upper_limit, crime_type)
+        else:
+            rows = spatial_index.query_nearest(lat, long, k, lower_limit, upper_limit, crime_type)
+    if len(rows) == 0:
+        utils.print_error("No neighborhoods to map.")
+        return None
+
+    edmonton_map = create_nearby_map(lat, long, rows)
+
+    with profiler.phase("save"):
+        return a4_specific_utils.write_map_to_file(edmonton_map, "Nearby")
+
+
+def create_nearby_map(lat, long, query_items):
+    """
+    Returns the map of a spatial_index.query_within_radius or query_nearest result, centered on the point.
+    """
+    with profiler.phase("markers"):
+        markers = [FolioMarker([n_lat, n_long], "%s <br> %.2f km <br> %s" % (n_name, distance_km, incidents),
+                               'crimson', incidents)
+                   for (n_name, n_lat, n_long, distance_km, incidents) in query_items]
+        # Every total can be 0, which would make every radius a division by 0
+        avg_val = get_avg_marker_val(markers) or 1
+
+    with profiler.phase("map"):
+        edmonton_map = a4_specific_utils.create_new_edmonton_map(len(markers), location=[lat, long])
+        a4_specific_utils.add_markers_to_map(edmonton_map, markers, avg_val)
+    return edmonton_map
+
+
+def menu_heatmap_of_crimes_for_year_range():
+    crime_types = a4_specific_utils.get_and_validate_crime_types(
+        "Enter the crime types to map, separated by commas (leave empty for all of them): ")
+    if crime_types is False:
+        return
+
+    lower_limit = utils.get_and_validate_date("Enter the lower year limit you wish to return from: ")
+    if lower_limit is False:
+        return
+
+    upper_limit = utils.get_and_validate_date("Enter the upper year limit you wish to return from: ")
+    if upper_limit is False:
+        return
+
+    if lower_limit > upper_limit:
+        utils.print_error("Upper year limit must be greater or equal to the lower year limit.")
+        return
+
+    by_year = input("One frame per year, with a slider to scrub through them? (y/n): ").strip().lower() == "y"
+
+    run_heatmap(crime_types, lower_limit, upper_limit, by_year)
+
+
+@output_cache.cached_output("Heatmap", "html")
+def run_heatmap(crime_types, lower_limit, upper_limit, by_year=False):
+    """ Map a heatmap of the incidents of the crime types between the two years (inclusive) from the precomputed grids
+    (see heatmap_grid.py), building the grids first if they are missing or stale. If by_year is True the map has one
+    frame per year instead of their sum.
+
+    Returns the name of the file the map was written to.
+    """
+    # Imported here since it imports numpy, which only the heatmap needs
+    import heatmap_grid
+
+    with profiler.phase("query"):
+        grids = heatmap_grid.get_heatmap_grids()
+        grid_sum = None if by_year else grids.sum_years(lower_limit, upper_limit, crime_types)
+
+    with profiler.phase("map"):
+        if by_year:
+            edmonton_map = heatmap_grid.create_heatmap_by_year(grids, lower_limit, upper_limit, crime_types)
+        else:
+            edmonton_map = heatmap_grid.create_heatmap(grids, grid_sum)
+
+    with profiler.phase("save"):
+        return a4_specific_utils.write_map_to_file(edmonton_map, "Heatmap")
+
+
+def menu_map_of_crime_anomalies():
+    lower_limit = utils.get_and_validate_date("Enter the lower year limit you wish to return from: ")
+    if lower_limit is False:
+        return
+
+    upper_limit = utils.get_and_validate_date("Enter the upper year limit you wish to return from: ")
+    if upper_limit is False:
+        return
+
+    if lower_limit > upper_limit:
+        utils.print_error("Upper year limit must be greater or equal to the lower year limit.")
+        return
+
+    n = utils.input_int_and_validate_with_predicate("Enter the number of anomalies: ",
+                                                    check_if_int_is_non_negative_and_handle)
+    if n is False:
+        return
+
+    min_abs_z = utils.input_float("Enter the lowest z-score (against the month's own history) to count as an anomaly: ")
+    if min_abs_z is False:
+        return
+
+    return run_trends(lower_limit, upper_limit, n, abs(min_abs_z))
+
+
+@output_cache.cached_output("Trends", "html")
+def run_trends(lower_limit, upper_limit, n, min_abs_z):
+    """ Map the n most anomalous months between the two years (inclusive) of any neighborhood and crime type, spikes
+    in red and drops in blue, and save it.
+
+    Returns the name of the file the map was written to, or None if there was nothing to map.
+    """
+    if n == 0:
+        utils.print_error("No anomalies to map.")
+        return None
+
+    with profiler.phase("query"):
+        rows = query_trend_anomalies(lower_limit, upper_limit, n, min_abs_z)
+    if len(rows) == 0:
+        utils.print_error("No neighborhood had a month with a z-score of at least {} between {} and {}.".format(
+            min_abs_z, lower_limit, upper_limit))
+        return None
+
+    edmonton_map = create_trends_map(rows)
+
+    with profiler.phase("save"):
+        return a4_specific_utils.write_map_to_file(edmonton_map, "Trends")
+
+
+@result_cache.cached("TRENDS")
+def query_trend_anomalies(lower_limit, upper_limit, n, min_abs_z):
+    """ Find the n months between the two years (inclusive) of any neighborhood and crime type that are the most
+    anomalous against their own history, with an absolute z-score of at least min_abs_z (see trends.py).
+
+    Returns a list of trends.top_anomalies rows.
+    """
+    # Imported here since columnar_engine imports pandas and trends imports numpy, which only some questions need
+    import columnar_engine
+    import trends
+
+    engine = _ENGINE if _ENGINE is not None else columnar_engine.ColumnarEngine.load(db_connection.get_connection())
+    cube = trends.TrendCube.from_engine(engine)
+    return trends.top_anomalies(cube, trends.compute_trends(cube), lower_limit, upper_limit, n, min_abs_z)
+
+
+def create_trends_map(query_items):
+    """
+    Returns the map of a query_trend_anomalies result, leaving out neighborhoods without coordinates.
+    """
+    import trends
+
+    with profiler.phase("markers"):
+        markers = []
+        for (n_name, crime_type, year, month, incidents, expected, z_score, rolling_avg, yoy_change, lat, long) \
+                in query_items:
+            if lat is None:
+                continue
+            popup = "%s <br> %s <br> %s %s <br> %s incidents (expected %.1f) <br> z-score %.2f <br> " \
+                    "%d month average %.1f <br> %s from a year before" % (
+                        n_name, crime_type, month_strs[month - 1], year, incidents, expected, z_score,
+                        trends.DEFAULT_WINDOW_MONTHS, rolling_avg, "n/a" if yoy_change is None else "%+d" % yoy_change)
+            markers.append(FolioMarker([lat, long], popup, 'crimson' if z_score > 0 else 'blue', abs(z_score)))
+        avg_val = get_avg_marker_val(markers)
+
+    with profiler.phase("map"):
+        edmonton_map = a4_specific_utils.create_new_edmonton_map(len(markers))
+        a4_specific_utils.add_markers_to_map(edmonton_map, markers, avg_val)
+    return edmonton_map
+
+
+def set_engine(engine):
+    """
+    Answer the questions with the given columnar_engine.ColumnarEngine, or with SQLite if engine is None.
+    """
+    global _ENGINE
+    _ENGINE = engine
+
+
+def get_engine():
+    return _ENGINE
+
+
+def set_parallel_executor(executor):
+    """
+    Aggregate Q3 and Q4 with the given parallel_query.ParallelExecutor, or in this process if executor is None.
+    """
+    global _PARALLEL_EXECUTOR
+    _PARALLEL_EXECUTOR = executor
+
+
+def get_parallel_executor():
+    return _PARALLEL_EXECUTOR
 
 
 def check_if_int_is_non_negative_and_handle(int):
@@ -281,3 +856,28 @@ def create_marker_for_q2_query_items(query_items, colour):
         marker_str = "{}\n{}".format(n_name, tot_pop)
         list.append(FolioMarker(coords, marker_str, colour, tot_pop))
     return list
+
+
+def create_markers_for_q3_query_items(query_items):
+    list = []
+
+    for n in query_items:
+        nPopup = "%s <br> %s" % (n[1],n[0])
+        list.append(FolioMarker([n[2], n[3]], nPopup, 'crimson', n[0]))
+    return list
+
+
+def create_markers_for_q4_query_items(query_items):
+    list = []
+
+    for (n_name, crime_type, lat, long, ratio) in query_items:
+        nPopup = "%s <br> %s <br> %s" % (n_name, crime_type, ratio)
+        list.append(FolioMarker([lat, long], nPopup, 'crimson', ratio))
+    return list
+
+
+def get_avg_marker_val(markers):
+    sum = 0
+    for marker in markers:
+        sum += marker.val
+    return sum / len(markers)
@@ -0,0 +1,66 @@
+# The neighbourhood dimension table.
+#
+# population, coordinates and crime_incidents only relate to each other through the Neighbourhood_Name text, and the
+# total population is a sum of three columns that Q2 and Q4 used to recompute on every query. neighbourhood_dim
+# gives every neighbourhood named by any of the three tables an integer id, and stores its total population and its
+# coordinates next to it. The neighbourhood rollup (see rollups.py) is keyed by that id, so the questions join
+# integers instead of comparing names.
+#
+# It is derived data: build_neighbourhood_dim rebuilds it from the source tables, and it is rebuilt along with the
+# rollups (refresh_rollups(db_path, rebuild=True)). A neighbourhood with no population row has a NULL
+# Total_Population, and one with no coordinates row has NULL coordinates.
+
+NEIGHBOURHOOD_DIM = "neighbourhood_dim"
+
+
+def build_neighbourhood_dim(conn):
+    """ (Re)build the dimension table from population, coordinates and crime_incidents, in the caller's transaction.
+
+    Ids are given in order of name. Returns the number of neighbourhoods.
+    """
+    conn.execute("DROP TABLE IF EXISTS {}".format(NEIGHBOURHOOD_DIM))
+    conn.execute("CREATE TABLE {} ( \
+                      Neighbourhood_Id INTEGER PRIMARY KEY, \
+                      Neighbourhood_Name TEXT NOT NULL UNIQUE, \
+                      Total_Population INTEGER, \
+                      Latitude REAL, \
+                      Longitude REAL \
+                  )".format(NEIGHBOURHOOD_DIM))
+
+    # The population table is keyed by number, so a name could appear more than once
+    conn.execute("INSERT INTO {} (Neighbourhood_Name, Total_Population, Latitude, Longitude) \
+                  SELECT n.Neighbourhood_Name, p.tot_pop, c.Latitude, c.Longitude \
+                  FROM ( \
+                      SELECT Neighbourhood_Name FROM population \
+                      UNION SELECT Neighbourhood_Name FROM coordinates \
+                      UNION SELECT Neighbourhood_Name FROM crime_incidents \
+                  ) n \
+                  LEFT JOIN ( \
+                      SELECT Neighbourhood_Name, SUM(CANADIAN_CITIZEN + NON_CANADIAN_CITIZEN + NO_RESPONSE) AS tot_pop \
+                      FROM population \
+                      GROUP BY Neighbourhood_Name \
+                  ) p ON p.Neighbourhood_Name = n.Neighbourhood_Name \
+                  LEFT JOIN coordinates c ON c.Neighbourhood_Name = n.Neighbourhood_Name \
+                  WHERE n.Neighbourhood_Name IS NOT NULL \
+                  GROUP BY n.Neighbourhood_Name \
+                  ORDER BY n.Neighbourhood_Name".format(NEIGHBOURHOOD_DIM))
+
+    return conn.execute("SELECT COUNT(*) FROM {}".format(NEIGHBOURHOOD_DIM)).fetchone()[0]
+
+
+def add_incident_neighbourhoods(conn, min_rowid, max_rowid):
+    """ Give an id to the neighbourhoods of the incidents with a rowid in (min_rowid, max_rowid] that don't have one yet,
+    in the caller's transaction.
+
+    Their population and coordinates are left NULL until the next rebuild.
+    """
+    conn.execute("INSERT OR IGNORE INTO {} (Neighbourhood_Name) \
+                  SELECT DISTINCT Neighbourhood_Name \
+                  FROM crime_incidents \
+                  WHERE rowid > ? AND rowid <= ? AND Neighbourhood_Name IS NOT NULL".format(NEIGHBOURHOOD_DIM),
+                 (min_rowid, max_rowid))
+
+
+def neighbourhood_dim_exists(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (NEIGHBOURHOOD_DIM,)).fetchone() is not None
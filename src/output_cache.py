@@ -0,0 +1,163 @@
+# Content addressed cache of the maps and plots the questions write.
+#
+# Each file a question writes is moved into the cache directory under a hash of the question, its (normalized)
+# parameters and the version of the database file (see db_connection.get_db_file_version), and its usual Qn-k name
+# becomes a symbolic link to it (or a copy, where links aren't supported). Asking the same question again with the same
+# parameters against the same database links a new Qn-k name to the file that's already there, without querying or
+# rendering anything.
+#
+# The cache is bounded by the total size of its files, evicting the least recently used file first (a file's mtime is
+# its last use). The Qn-k links to an evicted file are left dangling, ask the question again to get it back.
+
+import functools
+import os
+import shutil
+import threading
+
+import a4_specific_utils
+import db_connection
+import result_cache
+
+
+DEFAULT_CACHE_DIR = "{}/output_cache".format(a4_specific_utils._GENERATED_FILES_DIR)
+
+_CACHE = None
+
+
+'''
+Hit and miss counts of an OutputCache.
+'''
+class OutputCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def describe(self):
+        total = self.hits + self.misses
+        hit_rate = 0 if total == 0 else 100 * self.hits / total
+        return "Output cache: {} hits, {} misses ({:.1f}% hit rate)".format(self.hits, self.misses, hit_rate)
+
+
+class OutputCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.stats = OutputCacheStats()
+        self._lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, key, extension):
+        """
+        Returns the path of the cached file of key, or None on a miss.
+        """
+        path = self._cached_path(key, extension)
+        try:
+            # The file's mtime is its last use, for evicting the least recently used files
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.stats.misses += 1
+            return None
+
+        with self._lock:
+            self.stats.hits += 1
+        return path
+
+    def put(self, key, extension, file_name):
+        """
+        Moves file_name into the cache as the file of key and leaves a link to it at file_name.
+        """
+        path = self._cached_path(key, extension)
+        if os.path.getsize(file_name) > self.max_bytes:
+            return
+
+        # Move to a temporary name first so other processes never see a half moved file
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        shutil.move(file_name, tmp_path)
+        os.replace(tmp_path, path)
+        link_to(path, file_name)
+
+        self._evict(path)
+
+    def _evict(self, keep_path):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def _cached_path(self, key, extension):
+        return os.path.join(self.cache_dir, "{}.{}".format(key, extension))
+
+
+def init(cache_dir, max_bytes):
+    """
+    Turns on caching of every function decorated with cached_output.
+    """
+    global _CACHE
+    _CACHE = OutputCache(cache_dir, max_bytes)
+
+
+def get_stats():
+    """
+    Returns the OutputCacheStats of the cache, or None if caching is off.
+    """
+    return None if _CACHE is None else _CACHE.stats
+
+
+def cached_output(question, extension):
+    """ Decorator caching the file written by a question's run function, which must return the name of the file it
+    wrote (named by a4_specific_utils.generate_filename_for_question_file), or None if it wrote nothing.
+
+    The function's arguments are the cache key, like result_cache.cached. Does nothing until init is called.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            if _CACHE is None:
+                return func(*args)
+
+            params = tuple(result_cache.normalize_param(arg) for arg in args)
+            key = result_cache.hash_key((question, params,
+                                         db_connection.get_db_file_version(db_connection.get_db_path())))
+
+            path = _CACHE.get(key, extension)
+            if path is not None:
+                file_name = a4_specific_utils.generate_filename_for_question_file(question, extension)
+                link_to(path, file_name)
+                print("Wrote \"{}\" to disk (the same as an earlier identical request).".format(file_name))
+                return file_name
+
+            file_name = func(*args)
+            if file_name is not None:
+                _CACHE.put(key, extension, file_name)
+            return file_name
+        return wrapper
+    return decorator
+
+
+def link_to(path, link_name):
+    """
+    Makes link_name a relative symbolic link to path, or a copy of it if symbolic links can't be made here.
+    """
+    if os.path.lexists(link_name):
+        os.remove(link_name)
+
+    try:
+        os.symlink(os.path.relpath(path, os.path.dirname(os.path.abspath(link_name))), link_name)
+    except (OSError, NotImplementedError):
+        shutil.copyfile(path, link_name)
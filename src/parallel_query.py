@@ -0,0 +1,156 @@
+# Year partitioned parallel aggregation for Q3 and Q4 (main.py --engine parallel).
+#
+# With a wide year range, Q3 and Q4 spend nearly all their time in one SQLite aggregation that only uses one core.
+# ParallelExecutor splits the year range into contiguous partitions and aggregates each of them in its own worker
+# process, with its own read-only connection (see db_connection.get_connection). It then merges the partial sums per
+# (neighbourhood, crime type) and ranks the merged sums the same way as the serial queries in menu_options.
+#
+# The partial sums are integers, so merging them is exact and the results are the same as the serial path's (rows
+# tied in rank may come back in a different order). Like the serial queries, the partitions read the neighbourhood
+# rollup while it is fresh and crime_incidents otherwise.
+
+import multiprocessing
+
+import db_connection
+import neighbourhood_dim
+import rollups
+import top_n
+
+
+class ParallelExecutor:
+    def __init__(self, db_path, num_workers):
+        self.num_workers = num_workers
+        self._pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(db_path,))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def query_q3(self, lower_limit, upper_limit, crime_type, num_neighborhood):
+        """
+        Returns a list of (counts, Neighbourhood_Name, Latitude, Longitude) rows ordered by counts, including ties.
+        """
+        conn = db_connection.get_connection()
+        use_rollups = rollups.rollups_are_fresh(conn)
+        type_counts = self.aggregate(lower_limit, upper_limit, crime_type, use_rollups)
+        neighbourhoods = _get_neighbourhoods(conn, use_rollups)
+
+        rows = [(count, n_name) + neighbourhoods[n_name][1:]
+                for ((n_name, _), count) in type_counts.items() if n_name in neighbourhoods]
+        return top_n.top_n_rows_with_ties(rows, lambda row: row[0], num_neighborhood)
+
+    def query_q4(self, lower_limit, upper_limit, n):
+        """
+        Returns a list of (Neighbourhood_Name, most common Crime_Type, Latitude, Longitude, ratio) rows ordered by
+        ratio, including ties.
+        """
+        conn = db_connection.get_connection()
+        use_rollups = rollups.rollups_are_fresh(conn)
+        type_counts = self.aggregate(lower_limit, upper_limit, None, use_rollups)
+        neighbourhoods = _get_neighbourhoods(conn, use_rollups)
+
+        # n_name -> [total crimes, most common crime type, its count]
+        totals = {}
+        for ((n_name, crime_type), count) in type_counts.items():
+            total = totals.setdefault(n_name, [0, None, None])
+            total[0] += count
+            # Ties go to the alphabetically first crime type, like the serial query
+            if total[1] is None or count > total[2] or (count == total[2] and crime_type < total[1]):
+                total[1] = crime_type
+                total[2] = count
+
+        rows = []
+        for (n_name, (tot_crime, crime_type, _)) in totals.items():
+            if n_name not in neighbourhoods or tot_crime <= 0:
+                continue
+            (tot_pop, lat, long) = neighbourhoods[n_name]
+            if tot_pop is None:
+                continue
+            rows.append((n_name, crime_type, lat, long, float(tot_pop) / float(tot_crime)))
+
+        return top_n.top_n_rows_with_ties(rows, lambda row: row[4], n)
+
+    def aggregate(self, lower_limit, upper_limit, crime_type, use_rollups):
+        """ Sums the incidents between the two years (inclusive), of crime_type or of every crime type if it's None,
+        one year partition per worker.
+
+        Returns a dict of (Neighbourhood_Name, Crime_Type) -> total incidents.
+        """
+        partitions = [(start, end, crime_type, use_rollups)
+                      for (start, end) in partition_years(lower_limit, upper_limit, self.num_workers)]
+
+        type_counts = {}
+        for partial in self._pool.imap_unordered(_aggregate_partition, partitions):
+            for (n_name, partial_crime_type, count) in partial:
+                key = (n_name, partial_crime_type)
+                type_counts[key] = type_counts.get(key, 0) + count
+        return type_counts
+
+
+def partition_years(lower_limit, upper_limit, num_partitions):
+    """
+    Splits the years between the two limits (inclusive) into at most num_partitions contiguous (start, end) ranges.
+    """
+    num_years = upper_limit - lower_limit + 1
+    if num_years <= 0:
+        return []
+
+    num_partitions = min(num_partitions, num_years)
+    (per_partition, extra) = divmod(num_years, num_partitions)
+
+    partitions = []
+    start = lower_limit
+    for i in range(num_partitions):
+        end = start + per_partition - 1 + (1 if i < extra else 0)
+        partitions.append((start, end))
+        start = end + 1
+    return partitions
+
+
+def _init_worker(db_path):
+    db_connection.set_db_path(db_path)
+
+
+def _aggregate_partition(partition):
+    """
+    Runs in a worker. Returns a list of (Neighbourhood_Name, Crime_Type, total incidents) for one year partition.
+    """
+    (start, end, crime_type, use_rollups) = partition
+    conn = db_connection.get_connection()
+
+    type_filter = "" if crime_type is None else "AND i.Crime_Type = ?"
+    params = (start, end) if crime_type is None else (start, end, crime_type)
+
+    # The calls to string.format only substitute hard coded table names and the crime type filter
+    if use_rollups:
+        return conn.execute("SELECT d.Neighbourhood_Name, i.Crime_Type, SUM(i.total) \
+                             FROM {rollup} i \
+                             INNER JOIN {dim} d ON d.Neighbourhood_Id = i.Neighbourhood_Id \
+                             WHERE i.Year >= ? AND i.Year <= ? {type_filter} \
+                             GROUP BY i.Neighbourhood_Id, i.Crime_Type".format(
+                                 rollup=rollups.ROLLUP_YEAR_CRIME_TYPE_NEIGHBOURHOOD,
+                                 dim=neighbourhood_dim.NEIGHBOURHOOD_DIM, type_filter=type_filter),
+                            params).fetchall()
+
+    return conn.execute("SELECT i.Neighbourhood_Name, i.Crime_Type, SUM(i.Incidents_Count) \
+                         FROM crime_incidents i \
+                         WHERE i.Year >= ? AND i.Year <= ? {type_filter} \
+                         GROUP BY i.Neighbourhood_Name, i.Crime_Type".format(type_filter=type_filter),
+                        params).fetchall()
+
+
+def _get_neighbourhoods(conn, use_rollups):
+    """ Returns a dict of Neighbourhood_Name -> (total population, Latitude, Longitude) of the neighbourhoods the serial
+    queries can show, the ones with coordinates. The population is None for neighbourhoods without one.
+    """
+    if use_rollups:
+        return {n_name: (tot_pop, lat, long)
+                for (n_name, tot_pop, lat, long) in conn.execute(
+                    "SELECT Neighbourhood_Name, Total_Population, Latitude, Longitude \
+                     FROM {} \
+                     WHERE Latitude IS NOT NULL".format(neighbourhood_dim.NEIGHBOURHOOD_DIM))}
+
+    populations = dict(conn.execute("SELECT Neighbourhood_Name, CANADIAN_CITIZEN + NON_CANADIAN_CITIZEN + NO_RESPONSE \
+                                     FROM population").fetchall())
+    return {n_name: (populations.get(n_name), lat, long)
+            for (n_name, lat, long) in conn.execute("SELECT Neighbourhood_Name, Latitude, Longitude FROM coordinates")}
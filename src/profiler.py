@@ -0,0 +1,261 @@
+# Opt-in profiling of the questions (main.py --profile).
+#
+# Each menu invocation is recorded as a trace: the wall time of each phase of the question (ex. query, markers, map,
+# save) and of every SQL statement it ran, split into executing and fetching, with the number of rows fetched and the
+# statement's EXPLAIN QUERY PLAN. The trace is written as JSON when the invocation finishes, optionally along with a
+# cProfile dump of the whole invocation.
+#
+# SQL statements are timed by opening the shared connections with ProfiledConnection (see
+# db_connection.set_connection_factory), so while profiling is off the connections are plain sqlite3 connections and
+# phase() only costs a function call.
+
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import a4_specific_utils
+import db_connection
+
+
+DEFAULT_PROFILE_DIR = "{}/profiles".format(a4_specific_utils._GENERATED_FILES_DIR)
+
+_PROFILER = None
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+_FILENAME_UNSAFE_RE = re.compile(r"[^A-Za-z0-9_-]+")
+
+
+'''
+One SQL statement run while tracing.
+'''
+class StatementRecord:
+    def __init__(self, phase, sql, params, execute_secs):
+        self.phase = phase
+        self.sql = sql
+        self.params = params
+        self.execute_secs = execute_secs
+        self.fetch_secs = 0
+        self.rows = 0
+        self.plan = None
+
+    def to_dict(self):
+        return {"phase": self.phase, "sql": " ".join(self.sql.split()), "params": list(self.params),
+                "execute_ms": self.execute_secs * 1000, "fetch_ms": self.fetch_secs * 1000, "rows": self.rows,
+                "plan": self.plan}
+
+
+'''
+One phase of a traced invocation. Nested phases are named by their path (ex. "map/save").
+'''
+class PhaseRecord:
+    def __init__(self, name):
+        self.name = name
+        self.secs = 0
+        self.sql_rows = 0
+
+    def to_dict(self):
+        return {"name": self.name, "ms": self.secs * 1000, "sql_rows": self.sql_rows}
+
+
+'''
+Everything recorded during one menu invocation.
+'''
+class Trace:
+    def __init__(self, label):
+        self.label = label
+        self.started_at = datetime.datetime.now()
+        self.total_secs = 0
+        self.phases = []
+        self.statements = []
+        self.phase_stack = []
+        self.cprofile_path = None
+
+    def current_phase_name(self):
+        return self.phase_stack[-1].name if self.phase_stack else None
+
+    def to_dict(self):
+        return {"label": self.label, "started_at": self.started_at.isoformat(timespec="milliseconds"),
+                "total_ms": self.total_secs * 1000, "phases": [p.to_dict() for p in self.phases],
+                "statements": [s.to_dict() for s in self.statements], "cprofile": self.cprofile_path}
+
+
+class Profiler:
+    def __init__(self, out_dir, use_cprofile):
+        self.out_dir = out_dir
+        self.use_cprofile = use_cprofile
+        self._thread_local = threading.local()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def get_trace(self):
+        return getattr(self._thread_local, "trace", None)
+
+    @contextlib.contextmanager
+    def trace(self, label):
+        trace = Trace(label)
+        self._thread_local.trace = trace
+        cprofile = cProfile.Profile() if self.use_cprofile else None
+
+        start = time.perf_counter()
+        if cprofile is not None:
+            cprofile.enable()
+        try:
+            yield trace
+        finally:
+            if cprofile is not None:
+                cprofile.disable()
+            trace.total_secs = time.perf_counter() - start
+            self._thread_local.trace = None
+            self._write_trace(trace, cprofile)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        trace = self.get_trace()
+        if trace is None:
+            yield
+            return
+
+        parent = trace.current_phase_name()
+        record = PhaseRecord(name if parent is None else "{}/{}".format(parent, name))
+        trace.phases.append(record)
+        trace.phase_stack.append(record)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record.secs = time.perf_counter() - start
+            trace.phase_stack.pop()
+
+    def _write_trace(self, trace, cprofile):
+        _explain_statements(trace.statements)
+
+        base_name = "{}-{}".format(trace.started_at.strftime("%Y%m%d-%H%M%S-%f"),
+                                   _FILENAME_UNSAFE_RE.sub("_", trace.label).strip("_")[:40])
+        base_path = os.path.join(self.out_dir, base_name)
+
+        if cprofile is not None:
+            trace.cprofile_path = base_path + ".prof"
+            cprofile.dump_stats(trace.cprofile_path)
+
+        with open(base_path + ".json", "w") as f:
+            json.dump(trace.to_dict(), f, indent=2, default=str)
+        print("Wrote profile \"{}.json\" to disk.".format(base_path))
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    A cursor recording each statement it runs, and the time and rows of its fetches, in the current trace.
+    """
+    _record = None
+
+    def execute(self, sql, parameters=()):
+        trace = _get_current_trace()
+        if trace is None:
+            self._record = None
+            return super().execute(sql, parameters)
+
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record = StatementRecord(trace.current_phase_name(), sql, parameters, time.perf_counter() - start)
+            trace.statements.append(self._record)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone, lambda row: 0 if row is None else 1)
+
+    def fetchmany(self, size=None):
+        fetch = super().fetchmany if size is None else lambda: super(ProfiledCursor, self).fetchmany(size)
+        return self._timed_fetch(fetch, len)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall, len)
+
+    def __next__(self):
+        return self._timed_fetch(super().__next__, lambda row: 1)
+
+    def _timed_fetch(self, fetch, count_rows):
+        if self._record is None:
+            return fetch()
+
+        start = time.perf_counter()
+        res = fetch()
+        self._record.fetch_secs += time.perf_counter() - start
+
+        num_rows = count_rows(res)
+        self._record.rows += num_rows
+        trace = _get_current_trace()
+        if trace is not None:
+            for phase in trace.phase_stack:
+                phase.sql_rows += num_rows
+        return res
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    A connection whose cursors (including the ones made by execute) are ProfiledCursors.
+    """
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def init(out_dir=DEFAULT_PROFILE_DIR, use_cprofile=False):
+    """
+    Turns profiling on. Every trace() is written to out_dir, with a cProfile dump if use_cprofile is True.
+    """
+    global _PROFILER
+    _PROFILER = Profiler(out_dir, use_cprofile)
+    db_connection.set_connection_factory(ProfiledConnection)
+
+
+def trace(label):
+    """
+    Context manager recording everything run inside it as one trace named label. Does nothing if profiling is off.
+    """
+    if _PROFILER is None:
+        return _NULL_CONTEXT
+    return _PROFILER.trace(label)
+
+
+def phase(name):
+    """
+    Context manager timing the code run inside it as a phase of the current trace. Does nothing if profiling is off.
+    """
+    if _PROFILER is None:
+        return _NULL_CONTEXT
+    return _PROFILER.phase(name)
+
+
+def _get_current_trace():
+    return None if _PROFILER is None else _PROFILER.get_trace()
+
+
+def _explain_statements(statements):
+    """
+    Fills in the plan of every query in statements, explaining each distinct statement once.
+    """
+    conn = db_connection.get_connection()
+    plans = {}
+    for record in statements:
+        if not record.sql.lstrip().upper().startswith(("SELECT", "WITH")):
+            continue
+
+        key = (record.sql, repr(record.params))
+        if key not in plans:
+            # A plain cursor so that explaining isn't recorded itself
+            cur = conn.cursor(sqlite3.Cursor)
+            try:
+                plans[key] = [row[3] for row in cur.execute("EXPLAIN QUERY PLAN " + record.sql, record.params)]
+            except sqlite3.Error as e:
+                plans[key] = ["Could not explain the statement: {}".format(e)]
+        record.plan = plans[key]
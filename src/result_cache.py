@@ -0,0 +1,216 @@
+# Cache of query results.
+#
+# Results are keyed by the question, its (normalized) parameters and the version of the database, so a change to the
+# database makes every older entry unreachable. The version is the database file's size and modification time (and
+# its -wal file's, if any), plus a generation that is bumped whenever any of our connections sees its
+# PRAGMA data_version change, which happens as soon as another connection commits even if the file's mtime doesn't.
+#
+# There are two tiers: an in-memory LRU bounded by the total size of the (pickled) results, and an optional directory
+# on disk so results survive between runs. The disk tier can only use the file part of the version since
+# data_version is only meaningful for the life of a connection. It is bounded by size too, evicting the least
+# recently used file.
+#
+# Results are stored pickled and unpickled on every hit, so callers are free to modify what they get back.
+
+import collections
+import functools
+import hashlib
+import os
+import pickle
+import threading
+
+import db_connection
+
+
+_CACHE = None
+
+
+'''
+Hit and miss counts of a ResultCache.
+'''
+class CacheStats:
+    def __init__(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def describe(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        hit_rate = 0 if total == 0 else 100 * (self.memory_hits + self.disk_hits) / total
+        return "Result cache: {} memory hits, {} disk hits, {} misses ({:.1f}% hit rate)".format(
+            self.memory_hits, self.disk_hits, self.misses, hit_rate)
+
+
+class ResultCache:
+    def __init__(self, max_memory_bytes, disk_dir=None, max_disk_bytes=0):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = CacheStats()
+
+        # key -> pickled result, least recently used first
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        # data_version values can only be compared between calls on the same connection, so remember the last one
+        # seen on each connection and bump the generation when any of them changes.
+        self._data_versions = {}
+        self._generation = 0
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get_or_compute(self, question, params, compute):
+        """
+        Returns the cached result of question with params, calling compute() to get it (and caching it) on a miss.
+        """
+        file_version = db_connection.get_db_file_version(db_connection.get_db_path())
+        memory_key = (question, params, file_version, self._get_generation())
+        disk_key = hash_key((question, params, file_version))
+
+        with self._lock:
+            data = self._memory.get(memory_key)
+            if data is not None:
+                self._memory.move_to_end(memory_key)
+                self.stats.memory_hits += 1
+                return pickle.loads(data)
+
+        data = self._read_from_disk(disk_key)
+        if data is not None:
+            with self._lock:
+                self.stats.disk_hits += 1
+            self._put_in_memory(memory_key, data)
+            return pickle.loads(data)
+
+        with self._lock:
+            self.stats.misses += 1
+
+        result = compute()
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        self._put_in_memory(memory_key, data)
+        self._write_to_disk(disk_key, data)
+        return result
+
+    def _get_generation(self):
+        conn = db_connection.get_connection()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+
+        with self._lock:
+            last_data_version = self._data_versions.get(id(conn))
+            if last_data_version is not None and last_data_version != data_version:
+                self._generation += 1
+            self._data_versions[id(conn)] = data_version
+            return self._generation
+
+    def _put_in_memory(self, key, data):
+        # A result bigger than the whole cache would just evict everything else
+        if len(data) > self.max_memory_bytes:
+            return
+
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old)
+
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+
+            while self._memory_bytes > self.max_memory_bytes:
+                (_, evicted) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _read_from_disk(self, key):
+        if self.disk_dir is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # The file's mtime is its last use, for evicting the least recently used files
+        os.utime(path)
+        return data
+
+    def _write_to_disk(self, key, data):
+        if self.disk_dir is None or len(data) > self.max_disk_bytes:
+            return
+
+        # Write to a temporary file first so other processes never read a half written result
+        path = self._disk_path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        entries = []
+        with os.scandir(self.disk_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".pickle"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, "{}.pickle".format(key))
+
+
+def init(max_memory_bytes, disk_dir=None, max_disk_bytes=0):
+    """
+    Turns on caching of every function decorated with cached. Pass a disk_dir to also cache results on disk.
+    """
+    global _CACHE
+    _CACHE = ResultCache(max_memory_bytes, disk_dir, max_disk_bytes)
+
+
+def get_stats():
+    """
+    Returns the CacheStats of the cache, or None if caching is off.
+    """
+    return None if _CACHE is None else _CACHE.stats
+
+
+def cached(question):
+    """ Decorator caching the results of a query function for question.
+
+    The function's arguments are the cache key, so they must be hashable and have a stable repr. Integers passed as
+    strings (ex. "2010" vs 2010) are normalized so they share an entry. Does nothing until init is called.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            if _CACHE is None:
+                return func(*args)
+
+            params = tuple(normalize_param(arg) for arg in args)
+            return _CACHE.get_or_compute(question, params, lambda: func(*args))
+        return wrapper
+    return decorator
+
+
+def normalize_param(param):
+    if isinstance(param, str):
+        try:
+            return int(param)
+        except ValueError:
+            return param
+    return param
+
+
+def hash_key(key):
+    return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
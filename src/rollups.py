@@ -0,0 +1,190 @@
+# Pre-aggregated rollups of crime_incidents.
+#
+# Q1, Q3 and Q4 only ever need SUM(Incidents_Count) grouped by some subset of (Year, Month, Crime_Type,
+# Neighbourhood_Name). The rollup tables below store those sums so the questions don't have to re-aggregate the whole
+# incidents table on every request. They are optional: the queries only use them while they are fresh (see
+# rollups_are_fresh) and fall back to crime_incidents otherwise.
+#
+# Refreshing is incremental. The rowid of the last incident folded into the rollups is stored as a watermark, and a
+# refresh only folds in the rows appended after it. Rows that were updated or deleted in place can't be detected this
+# way, so rebuild the rollups after doing that (refresh_rollups(db_path, rebuild=True)), or fold the changes in with
+# fold_count_changes like ingest.append_incidents does.
+#
+# The neighbourhood rollup is keyed by the integer Neighbourhood_Id of neighbourhood_dim (see neighbourhood_dim.py)
+# instead of the name, so the rollups are built and rebuilt along with the dimension table and the spatial index over
+# its coordinates (see spatial_index.py).
+
+import sqlite3
+import time
+
+import neighbourhood_dim
+import spatial_index
+
+
+_ROLLUP_META_TABLE = "rollup_meta"
+
+ROLLUP_MONTH_CRIME_TYPE = "rollup_month_crime_type"
+ROLLUP_YEAR_CRIME_TYPE_NEIGHBOURHOOD = "rollup_year_crime_type_neighbourhood"
+
+'''
+Each rollup table and the crime_incidents columns it's grouped by.
+'''
+_ROLLUP_KEYS = {
+    ROLLUP_MONTH_CRIME_TYPE: ["Year", "Month", "Crime_Type"],
+    ROLLUP_YEAR_CRIME_TYPE_NEIGHBOURHOOD: ["Year", "Crime_Type", "Neighbourhood_Id"],
+}
+
+'''
+Extra indexes on the rollup tables as (index name, table, columns).
+'''
+_ROLLUP_INDEXES = [
+    # The totals of given neighbourhoods (see spatial_index) without scanning every neighbourhood in the year range
+    ("idx_rollup_neighbourhood_year_type", ROLLUP_YEAR_CRIME_TYPE_NEIGHBOURHOOD,
+     ["Neighbourhood_Id", "Year", "Crime_Type", "total"]),
+]
+
+_KEY_COLUMN_TYPES = {
+    "Year": "INTEGER",
+    "Month": "INTEGER",
+    "Crime_Type": "TEXT",
+    "Neighbourhood_Id": "INTEGER",
+}
+
+# Gives the incidents (aliased i, ex. crime_incidents or a table of changes to it) the Neighbourhood_Id of their name
+_INCIDENTS_WITH_IDS = "{incidents} i INNER JOIN " + neighbourhood_dim.NEIGHBOURHOOD_DIM + " d \
+                       ON d.Neighbourhood_Name = i.Neighbourhood_Name"
+
+
+def refresh_rollups(db_path, rebuild=False):
+    """ Create the rollup tables if needed and fold in every incident appended since the last refresh.
+
+    If rebuild is True, or the neighbourhood dimension table is missing, the rollups and the dimension table are
+    dropped and rebuilt from scratch.
+    Returns the number of incident rows that were folded in.
+    """
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_path)
+
+    try:
+        with conn:
+            # Rollups built before the dimension table existed are keyed by name and can't be folded into
+            if rebuild or not neighbourhood_dim.neighbourhood_dim_exists(conn):
+                _drop_rollups(conn)
+                neighbourhood_dim.build_neighbourhood_dim(conn)
+                spatial_index.build_spatial_index(conn)
+            _create_rollups(conn)
+            num_rows = fold_new_incidents(conn)
+    finally:
+        conn.close()
+
+    print("Folded {} incident rows into the rollups in {:.3f}s.".format(num_rows, time.perf_counter() - start))
+    return num_rows
+
+
+def fold_new_incidents(conn):
+    """ Fold every incident appended since the last refresh into the existing rollups, in the caller's transaction.
+
+    Returns the number of incident rows that were folded in.
+    """
+    watermark = get_watermark(conn)
+    new_watermark = _get_max_incident_rowid(conn)
+    num_rows = conn.execute("SELECT COUNT(*) FROM crime_incidents WHERE rowid > ? AND rowid <= ?",
+                            (watermark, new_watermark)).fetchone()[0]
+    neighbourhood_dim.add_incident_neighbourhoods(conn, watermark, new_watermark)
+
+    for (table, keys) in _ROLLUP_KEYS.items():
+        _fold_into_rollup(conn, table, keys, "SELECT {{keys}}, SUM(i.Incidents_Count) \
+                                              FROM {} \
+                                              WHERE i.rowid > ? AND i.rowid <= ? \
+                                              GROUP BY {{keys}}".format(
+                                                  _INCIDENTS_WITH_IDS.format(incidents="crime_incidents")),
+                          (watermark, new_watermark))
+
+    conn.execute("UPDATE {} SET watermark = ?".format(_ROLLUP_META_TABLE), (new_watermark,))
+    return num_rows
+
+
+def fold_count_changes(conn, changes_table):
+    """ Fold in place changes of Incidents_Count into the rollups, in the caller's transaction.
+
+    Only changes to rows that were already folded in (rowid <= the watermark, see get_watermark) belong here, the
+    others are picked up by the next fold_new_incidents.
+    :param changes_table: A table with the crime_incidents key columns and a count_change column (new - old count).
+                          Must be a hard coded name, it is formatted into the query.
+    """
+    for (table, keys) in _ROLLUP_KEYS.items():
+        _fold_into_rollup(conn, table, keys, "SELECT {{keys}}, SUM(i.count_change) \
+                                              FROM {} \
+                                              WHERE 1 \
+                                              GROUP BY {{keys}}".format(
+                                                  _INCIDENTS_WITH_IDS.format(incidents=changes_table)), ())
+
+
+def rollups_are_fresh(conn):
+    """
+    Returns whether the rollups exist and every row of crime_incidents has been folded into them.
+    """
+    try:
+        watermark = get_watermark(conn)
+    except sqlite3.OperationalError:
+        # The rollups were never built
+        return False
+
+    # Rollups from before the dimension table are keyed by name (see refresh_rollups)
+    if not neighbourhood_dim.neighbourhood_dim_exists(conn):
+        return False
+
+    return watermark == _get_max_incident_rowid(conn)
+
+
+def rollups_exist(conn):
+    """
+    Returns whether the rollup tables have been created, fresh or not.
+    """
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (_ROLLUP_META_TABLE,)).fetchone() is not None
+
+
+def _create_rollups(conn):
+    for (table, keys) in _ROLLUP_KEYS.items():
+        key_col_defs = ", ".join("{} {}".format(key, _KEY_COLUMN_TYPES[key]) for key in keys)
+        conn.execute("CREATE TABLE IF NOT EXISTS {} ({}, total INTEGER NOT NULL, PRIMARY KEY ({}))".format(
+            table, key_col_defs, ", ".join(keys)))
+
+    for (index_name, table, columns) in _ROLLUP_INDEXES:
+        conn.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(index_name, table, ", ".join(columns)))
+
+    conn.execute("CREATE TABLE IF NOT EXISTS {} (watermark INTEGER NOT NULL)".format(_ROLLUP_META_TABLE))
+    if conn.execute("SELECT COUNT(*) FROM {}".format(_ROLLUP_META_TABLE)).fetchone()[0] == 0:
+        conn.execute("INSERT INTO {} (watermark) VALUES (0)".format(_ROLLUP_META_TABLE))
+
+
+def _drop_rollups(conn):
+    for table in list(_ROLLUP_KEYS) + [_ROLLUP_META_TABLE]:
+        conn.execute("DROP TABLE IF EXISTS {}".format(table))
+
+
+def _fold_into_rollup(conn, table, keys, select_query, params):
+    """
+    Adds the (keys..., count) rows of select_query to the totals of the rollup table. select_query has {keys}
+    formatted to the key columns.
+    """
+    key_cols = ", ".join(keys)
+    # The table and column names come from _ROLLUP_KEYS, so formatting them into the query is safe.
+    conn.execute("INSERT INTO {table} ({keys}, total) \
+                  {select} \
+                  ON CONFLICT ({keys}) DO UPDATE SET total = total + excluded.total"
+                 .format(table=table, keys=key_cols, select=select_query.format(keys=key_cols)), params)
+
+
+def get_watermark(conn):
+    """
+    Returns the rowid of the last incident folded into the rollups.
+    """
+    return conn.execute("SELECT watermark FROM {}".format(_ROLLUP_META_TABLE)).fetchone()[0]
+
+
+def _get_max_incident_rowid(conn):
+    max_rowid = conn.execute("SELECT MAX(rowid) FROM crime_incidents").fetchone()[0]
+    return max_rowid if max_rowid is not None else 0
+
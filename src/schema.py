@@ -0,0 +1,67 @@
+# The tables the program reads and their columns.
+
+'''
+Each table's columns as (name, type), in order.
+'''
+TABLE_COLUMNS = {
+    "population": [
+        ("Neighbourhood_Number", "INTEGER"),
+        ("Neighbourhood_Name", "TEXT"),
+        ("CANADIAN_CITIZEN", "INTEGER"),
+        ("NON_CANADIAN_CITIZEN", "INTEGER"),
+        ("NO_RESPONSE", "INTEGER"),
+    ],
+    "crime_incidents": [
+        ("Neighbourhood_Name", "TEXT"),
+        ("Year", "INTEGER"),
+        ("Quarter", "INTEGER"),
+        ("Month", "INTEGER"),
+        ("Crime_Type", "TEXT"),
+        ("Incidents_Count", "INTEGER"),
+    ],
+    "coordinates": [
+        ("Neighbourhood_Name", "TEXT"),
+        ("Latitude", "REAL"),
+        ("Longitude", "REAL"),
+    ],
+}
+
+'''
+The columns that identify a row of each table.
+'''
+TABLE_KEYS = {
+    "population": ["Neighbourhood_Number"],
+    "crime_incidents": ["Neighbourhood_Name", "Year", "Month", "Crime_Type"],
+    "coordinates": ["Neighbourhood_Name"],
+}
+
+
+def create_table_sql(table, table_name=None, with_primary_key=True):
+    """ Returns the CREATE TABLE statement of one of the tables.
+
+    :param table_name: The name to create the table as, if not table.
+    :param with_primary_key: If False the key is left out, so it can be added as a unique index after loading.
+    """
+    col_defs = ["{} {}".format(name, col_type) for (name, col_type) in TABLE_COLUMNS[table]]
+    if with_primary_key:
+        col_defs.append("PRIMARY KEY ({})".format(", ".join(TABLE_KEYS[table])))
+    return "CREATE TABLE {} ({})".format(table_name or table, ", ".join(col_defs))
+
+
+def get_schema_problems(conn, tables=TABLE_COLUMNS):
+    """ Compare the database's tables against the expected schema.
+
+    Returns a list of strings describing each missing table or column (empty if the schema is fine).
+    Extra tables and columns are allowed.
+    """
+    problems = []
+    for table in tables:
+        columns = {row[1].lower() for row in conn.execute("PRAGMA table_info({})".format(table))}
+        if not columns:
+            problems.append("the table {} is missing".format(table))
+            continue
+
+        missing = [name for (name, _) in TABLE_COLUMNS[table] if name.lower() not in columns]
+        if missing:
+            problems.append("the table {} is missing the column(s) {}".format(table, ", ".join(missing)))
+    return problems
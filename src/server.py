@@ -0,0 +1,492 @@
+# HTTP/JSON API for Q1-Q4. Run with: python server.py --db_path <db> [--port 8291] [--threads N]
+#
+# Every endpoint is a GET with its parameters in the query string:
+#   /q1?crime_type=&start_year=&end_year=       (&format=png for the bar plot)
+#   /q2?n=                                      (&format=html for the map)
+#   /q3?crime_type=&start_year=&end_year=&n=    (&format=html for the map)
+#   /q4?start_year=&end_year=&n=                (&format=html for the map)
+#   /within_radius?lat=&long=&radius_km=&start_year=&end_year=         (&crime_type=, &format=html for the map)
+#   /within_box?south=&west=&north=&east=&start_year=&end_year=        (&crime_type=)
+#   /nearest?lat=&long=&k=&start_year=&end_year=                       (&crime_type=, &format=html for the map)
+#   /heatmap?start_year=&end_year=              (&crime_type=, &format=html for the map)
+#   /trends?start_year=&end_year=&n=            (&min_z=, &format=html for the map)
+#   /health                                     (request counters)
+#
+# The event loop only reads requests and writes responses. Queries and rendering run on a bounded pool of threads, each
+# of which has its own read-only connection (see db_connection.get_connection). Identical requests that arrive while
+# one is already being answered wait for that answer instead of running again.
+
+import argparse
+import asyncio
+import concurrent.futures
+import http
+import io
+import json
+import math
+import os
+import urllib.parse
+
+import a4_specific_utils
+import db_connection
+import main as main_module
+import menu_options
+import result_cache
+import schema
+import spatial_index
+import utils
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8291
+
+_FORMAT_JSON = "json"
+_JSON_CONTENT_TYPE = "application/json"
+
+
+'''
+An error answered with the given HTTP status and a JSON body describing it.
+'''
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class ApiServer:
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.num_requests = 0
+        self.num_coalesced = 0
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(num_threads, thread_name_prefix="api")
+        # (path, params) -> future of the answer, for requests that are being answered
+        self._in_flight = {}
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answers the requests of one client connection until it closes it (connections are kept alive).
+        """
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+
+                (method, target, keep_alive) = request
+                (status, content_type, body) = await self._answer(method, target)
+                _write_response(writer, status, content_type, body, keep_alive)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def _answer(self, method, target):
+        """
+        Returns a tuple of (HTTP status, content type, body bytes) for the request.
+        """
+        self.num_requests += 1
+        if method != "GET":
+            return _error_response(HttpError(http.HTTPStatus.METHOD_NOT_ALLOWED, "Only GET is supported"))
+
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == "/health":
+            return (http.HTTPStatus.OK, _JSON_CONTENT_TYPE, _to_json_bytes({
+                "requests": self.num_requests, "coalesced": self.num_coalesced, "in_flight": len(self._in_flight),
+                "threads": self.num_threads}))
+
+        key = (url.path, tuple(sorted(params.items())))
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, _run_endpoint, url.path, params)
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.num_coalesced += 1
+
+        try:
+            # Shielded so that a client going away doesn't cancel the answer for the others waiting on it
+            (content_type, body) = await asyncio.shield(future)
+        except HttpError as e:
+            return _error_response(e)
+        except Exception as e:
+            return _error_response(HttpError(http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                                             "{}: {}".format(type(e).__name__, e)))
+        return (http.HTTPStatus.OK, content_type, body)
+
+
+def _run_endpoint(path, params):
+    """
+    Runs on the thread pool. Returns a tuple of (content type, body bytes) or raises HttpError.
+    """
+    endpoint = _ENDPOINTS.get(path)
+    if endpoint is None:
+        raise HttpError(http.HTTPStatus.NOT_FOUND, "Unknown endpoint {} (expected one of {})".format(
+            path, ", ".join(list(_ENDPOINTS) + ["/health"])))
+    return endpoint(params)
+
+
+def _get_q1(params):
+    crime_type = _get_crime_type_param(params)
+    (start_year, end_year) = _get_year_range_params(params)
+    output_format = _get_format_param(params, "png")
+
+    df = menu_options.query_q1(crime_type, start_year, end_year)
+    if output_format == "png":
+        png = io.BytesIO()
+        menu_options.plot_q1(df, crime_type, png)
+        return ("image/png", png.getvalue())
+
+    return _json_answer([{"month": int(month), "total_incidents": _json_number(total)}
+                         for (month, total) in zip(df["Month"], df["total_incidents"])])
+
+
+def _get_q2(params):
+    n = _get_int_param(params, "n", 0)
+    output_format = _get_format_param(params, "html")
+
+    (bot_n_neigh, top_n_neigh) = menu_options.query_q2(n)
+    if output_format == "html":
+        if len(top_n_neigh) == 0:
+            raise HttpError(http.HTTPStatus.NOT_FOUND, "No neighborhoods to map")
+        return _html_answer(menu_options.create_q2_map(bot_n_neigh, top_n_neigh))
+
+    to_dicts = lambda rows: [{"neighbourhood": n_name, "population": tot_pop, "latitude": lat, "longitude": long}
+                             for (n_name, tot_pop, lat, long) in rows]
+    return _json_answer({"least_populous": to_dicts(bot_n_neigh), "most_populous": to_dicts(top_n_neigh)})
+
+
+def _get_q3(params):
+    crime_type = _get_crime_type_param(params)
+    (start_year, end_year) = _get_year_range_params(params)
+    n = _get_int_param(params, "n", 0)
+    output_format = _get_format_param(params, "html")
+
+    rows = menu_options.query_q3(start_year, end_year, crime_type, n)
+    if output_format == "html":
+        if len(rows) == 0:
+            raise HttpError(http.HTTPStatus.NOT_FOUND, "No neighborhoods to map")
+        return _html_answer(menu_options.create_q3_map(rows))
+
+    return _json_answer([{"neighbourhood": n_name, "incidents": counts, "latitude": lat, "longitude": long}
+                         for (counts, n_name, lat, long) in rows])
+
+
+def _get_q4(params):
+    (start_year, end_year) = _get_year_range_params(params)
+    n = _get_int_param(params, "n", 0)
+    output_format = _get_format_param(params, "html")
+
+    rows = menu_options.query_q4(start_year, end_year, n)
+    if output_format == "html":
+        if len(rows) == 0:
+            raise HttpError(http.HTTPStatus.NOT_FOUND, "No neighborhoods to map")
+        return _html_answer(menu_options.create_q4_map(rows))
+
+    return _json_answer([{"neighbourhood": n_name, "most_common_crime_type": crime_type, "latitude": lat,
+                          "longitude": long, "population_to_crime_ratio": _json_number(ratio)}
+                         for (n_name, crime_type, lat, long, ratio) in rows])
+
+
+def _get_within_radius(params):
+    (lat, long) = _get_point_params(params)
+    radius_km = _get_float_param(params, "radius_km", 0)
+    (start_year, end_year) = _get_year_range_params(params)
+    crime_type = _get_optional_crime_type_param(params)
+    output_format = _get_format_param(params, "html")
+
+    rows = spatial_index.query_within_radius(lat, long, radius_km, start_year, end_year, crime_type)
+    return _nearby_answer(lat, long, rows, output_format)
+
+
+def _get_within_box(params):
+    (south, north) = [_get_float_param(params, name, -90) for name in ("south", "north")]
+    (west, east) = [_get_float_param(params, name, -180) for name in ("west", "east")]
+    (start_year, end_year) = _get_year_range_params(params)
+    crime_type = _get_optional_crime_type_param(params)
+
+    rows = spatial_index.query_within_box(south, west, north, east, start_year, end_year, crime_type)
+    return _json_answer([{"neighbourhood": n_name, "incidents": incidents, "latitude": lat, "longitude": long}
+                         for (n_name, lat, long, incidents) in rows])
+
+
+def _get_nearest(params):
+    (lat, long) = _get_point_params(params)
+    k = _get_int_param(params, "k", 0)
+    (start_year, end_year) = _get_year_range_params(params)
+    crime_type = _get_optional_crime_type_param(params)
+    output_format = _get_format_param(params, "html")
+
+    rows = spatial_index.query_nearest(lat, long, k, start_year, end_year, crime_type)
+    return _nearby_answer(lat, long, rows, output_format)
+
+
+def _get_heatmap(params):
+    (start_year, end_year) = _get_year_range_params(params)
+    crime_type = _get_optional_crime_type_param(params)
+    output_format = _get_format_param(params, "html")
+
+    # Imported here since it imports numpy, which only the heatmap needs
+    import heatmap_grid
+    grids = heatmap_grid.get_heatmap_grids()
+    grid_sum = grids.sum_years(start_year, end_year, None if crime_type is None else [crime_type])
+    if output_format == "html":
+        return _html_answer(heatmap_grid.create_heatmap(grids, grid_sum))
+
+    (south, west, north, east) = grids.bounds
+    return _json_answer({"south": south, "west": west, "north": north, "east": east,
+                         "rows": grids.num_rows(), "cols": grids.num_cols(), "counts": grid_sum.tolist()})
+
+
+def _get_trends(params):
+    (start_year, end_year) = _get_year_range_params(params)
+    n = _get_int_param(params, "n", 0)
+    output_format = _get_format_param(params, "html")
+
+    # Imported here since it imports numpy, which only the trends need
+    import trends
+    min_abs_z = _get_float_param(params, "min_z", 0) if "min_z" in params else trends.DEFAULT_MIN_ABS_Z
+
+    rows = menu_options.query_trend_anomalies(start_year, end_year, n, min_abs_z)
+    if output_format == "html":
+        if len(rows) == 0:
+            raise HttpError(http.HTTPStatus.NOT_FOUND, "No anomalies to map")
+        return _html_answer(menu_options.create_trends_map(rows))
+
+    return _json_answer([{"neighbourhood": n_name, "crime_type": crime_type, "year": year, "month": month,
+                          "incidents": incidents, "expected": expected, "z_score": z_score, "rolling_avg": rolling_avg,
+                          "change_from_year_before": yoy_change, "latitude": lat, "longitude": long}
+                         for (n_name, crime_type, year, month, incidents, expected, z_score, rolling_avg, yoy_change,
+                              lat, long) in rows])
+
+
+def _nearby_answer(lat, long, rows, output_format):
+    if output_format == "html":
+        if len(rows) == 0:
+            raise HttpError(http.HTTPStatus.NOT_FOUND, "No neighborhoods to map")
+        return _html_answer(menu_options.create_nearby_map(lat, long, rows))
+
+    return _json_answer([{"neighbourhood": n_name, "incidents": incidents, "latitude": n_lat, "longitude": n_long,
+                          "distance_km": distance_km}
+                         for (n_name, n_lat, n_long, distance_km, incidents) in rows])
+
+
+_ENDPOINTS = {
+    "/q1": _get_q1,
+    "/q2": _get_q2,
+    "/q3": _get_q3,
+    "/q4": _get_q4,
+    "/within_radius": _get_within_radius,
+    "/within_box": _get_within_box,
+    "/nearest": _get_nearest,
+    "/heatmap": _get_heatmap,
+    "/trends": _get_trends,
+}
+
+
+def _get_int_param(params, name, min_val):
+    if name not in params:
+        raise HttpError(http.HTTPStatus.BAD_REQUEST, "Missing the parameter {}".format(name))
+
+    val = utils.try_parse_int(params[name])
+    if val is False or val < min_val:
+        raise HttpError(http.HTTPStatus.BAD_REQUEST, "{} must be an integer of at least {} (got \"{}\")".format(
+            name, min_val, params[name]))
+    return val
+
+
+def _get_float_param(params, name, min_val):
+    if name not in params:
+        raise HttpError(http.HTTPStatus.BAD_REQUEST, "Missing the parameter {}".format(name))
+
+    val = utils.try_parse_float(params[name])
+    if val is False or val < min_val:
+        raise HttpError(http.HTTPStatus.BAD_REQUEST, "{} must be a number of at least {} (got \"{}\")".format(
+            name, min_val, params[name]))
+    return val
+
+
+def _get_point_params(params):
+    lat = _get_float_param(params, "lat", -90)
+    long = _get_float_param(params, "long", -180)
+    if lat > 90 or long > 180:
+        raise HttpError(http.HTTPStatus.BAD_REQUEST, "lat must be at most 90 and long at most 180")
+    return (lat, long)
+
+
+def _get_year_range_params(params):
+    start_year = _get_int_param(params, "start_year", 0)
+    end_year = _get_int_param(params, "end_year", 0)
+    if start_year > end_year:
+        raise HttpError(http.HTTPStatus.BAD_REQUEST, "end_year must be greater or equal to start_year")
+    return (start_year, end_year)
+
+
+def _get_crime_type_param(params):
+    crime_type = a4_specific_utils.get_valid_crime_type(params.get("crime_type", ""))
+    if crime_type is False:
+        raise HttpError(http.HTTPStatus.BAD_REQUEST, "\"{}\" is not a valid crime type".format(
+            params.get("crime_type", "")))
+    # The exact case of how the crime type is spelled in the database
+    return crime_type
+
+
+def _get_optional_crime_type_param(params):
+    """
+    Returns the crime type parameter, or None for every crime type if it's missing or empty.
+    """
+    if params.get("crime_type", "") == "":
+        return None
+    return _get_crime_type_param(params)
+
+
+def _get_format_param(params, rendered_format):
+    output_format = params.get("format", _FORMAT_JSON)
+    if output_format not in (_FORMAT_JSON, rendered_format):
+        raise HttpError(http.HTTPStatus.BAD_REQUEST, "format must be {} or {} (got \"{}\")".format(
+            _FORMAT_JSON, rendered_format, output_format))
+    return output_format
+
+
+def _json_number(val):
+    # NaN or None (ex. a month without incidents of the crime type, None when no month has any) isn't a JSON number
+    if val is None:
+        return None
+    val = float(val)
+    if math.isnan(val):
+        return None
+    return int(val) if val.is_integer() else val
+
+
+def _json_answer(result):
+    return (_JSON_CONTENT_TYPE, _to_json_bytes(result))
+
+
+def _html_answer(edmonton_map):
+    return ("text/html; charset=utf-8", edmonton_map.get_root().render().encode("utf-8"))
+
+
+def _to_json_bytes(obj):
+    return json.dumps(obj).encode("utf-8")
+
+
+def _error_response(error):
+    return (error.status, _JSON_CONTENT_TYPE, _to_json_bytes({"error": error.message}))
+
+
+async def _read_request(reader):
+    """
+    Reads the request line and headers of the next request. Returns a tuple of (method, target, keep alive), or None
+    once the client closed the connection.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise ConnectionError("Malformed request line")
+    (method, target, version) = parts
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        (name, _, value) = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip().lower()
+
+    # Skip any body, none of the endpoints use one
+    content_length = utils.try_parse_int(headers.get("content-length", "0"))
+    if content_length:
+        await reader.readexactly(content_length)
+
+    keep_alive = version == "HTTP/1.1" and headers.get("connection") != "close"
+    return (method, target, keep_alive)
+
+
+def _write_response(writer, status, content_type, body, keep_alive):
+    status = http.HTTPStatus(status)
+    writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+        status.value, status.phrase, content_type, len(body), "keep-alive" if keep_alive else "close")
+        .encode("latin-1"))
+    writer.write(body)
+
+
+async def serve(host, port, num_threads):
+    api_server = ApiServer(num_threads)
+    server = await asyncio.start_server(api_server.handle_connection, host, port)
+
+    (bound_host, bound_port) = server.sockets[0].getsockname()[:2]
+    # benchmarks.py reads the port from this line
+    print("Serving on http://{}:{} with {} threads".format(bound_host, bound_port, num_threads), flush=True)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        api_server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="CMPUT_291 Query API Server")
+    parser.add_argument('--db_path', help="The path to the database file to serve", required=True)
+    parser.add_argument('--host', default=DEFAULT_HOST, help="The address to listen on (default: {})".format(
+        DEFAULT_HOST))
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help="The port to listen on, 0 picks a free one (default: {})".format(DEFAULT_PORT))
+    parser.add_argument('--threads', type=int, default=min(32, (os.cpu_count() or 1) + 4),
+                        help="The number of threads (and database connections) answering requests")
+    parser.add_argument('--engine', choices=menu_options.ENGINES, default=menu_options.ENGINE_SQLITE,
+                        help="Answer the questions with SQLite queries, with NumPy over the tables loaded into "
+                             "memory, or split the years of Q3/Q4 over one process per cpu (default: sqlite)")
+    parser.add_argument('--cache_mb', type=int, default=64,
+                        help="Keep up to this many MB of query results in memory (0 turns caching off, default: 64)")
+    args = parser.parse_args()
+
+    if args.threads < 1:
+        utils.print_error("--threads must be at least 1 (got {})".format(args.threads))
+        return
+
+    if not main_module.validate_db_path_arg(args.db_path):
+        return
+
+    # Plots are only ever rendered to bytes
+    os.environ["MPLBACKEND"] = "Agg"
+
+    db_connection.set_db_path(args.db_path)
+    problems = schema.get_schema_problems(db_connection.get_connection())
+    if problems:
+        utils.print_error("\"{}\" doesn't have the expected tables: {}".format(args.db_path, "; ".join(problems)))
+        return
+
+    a4_specific_utils.init()
+    if args.cache_mb > 0:
+        result_cache.init(args.cache_mb * 1024 * 1024)
+    if args.engine == menu_options.ENGINE_NUMPY:
+        import columnar_engine
+        menu_options.set_engine(columnar_engine.load_engine(db_connection.get_connection()))
+    elif args.engine == menu_options.ENGINE_PARALLEL:
+        import parallel_query
+        menu_options.set_parallel_executor(parallel_query.ParallelExecutor(args.db_path, os.cpu_count() or 1))
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.threads))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if menu_options.get_parallel_executor() is not None:
+            menu_options.get_parallel_executor().close()
+        db_connection.close_all_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# Spatial queries over the neighbourhood coordinates: incident totals within a radius of a point, within a bounding
+# box (ex. a map's viewport) and of the k nearest neighbourhoods, for a year range.
+#
+# neighbourhood_rtree is an R*Tree virtual table holding one point (a box with min = max) per neighbourhood of
+# neighbourhood_dim that has coordinates, keyed by its Neighbourhood_Id. It is built along with the dimension table
+# and the rollups (see rollups.refresh_rollups). A query only visits the tree nodes overlapping the area asked about,
+# and joins the neighbourhood rollup by id for the totals of just the neighbourhoods found. Radius and nearest queries
+# search the bounding box of their circle and keep the neighbourhoods whose great circle distance is within it.
+# The R*Tree stores 32 bit floats, so its matches are checked against the exact coordinates of neighbourhood_dim.
+#
+# While the index or fresh rollups aren't there (or SQLite was built without R*Tree), the queries fall back to
+# scanning coordinates in Python and summing crime_incidents for the neighbourhoods found.
+#
+# Bounding boxes are computed in degrees and don't wrap around the antimeridian or the poles.
+
+import math
+import sqlite3
+
+import db_connection
+import neighbourhood_dim
+import result_cache
+import rollups
+
+
+NEIGHBOURHOOD_RTREE = "neighbourhood_rtree"
+
+_EARTH_RADIUS_KM = 6371.0088
+_KM_PER_DEGREE = math.pi * _EARTH_RADIUS_KM / 180
+# No two points are farther apart than this
+_MAX_DISTANCE_KM = math.pi * _EARTH_RADIUS_KM
+
+# The radius the nearest neighbourhood search starts from. It doubles until the circle holds k neighbourhoods.
+_NEAREST_START_RADIUS_KM = 1.0
+
+# Neighbourhood names per query when summing crime_incidents for the fallback
+_NAMES_PER_QUERY = 500
+
+
+def build_spatial_index(conn):
+    """ (Re)build the R*Tree from neighbourhood_dim, in the caller's transaction.
+
+    Returns the number of neighbourhoods indexed, or False if this SQLite doesn't have the R*Tree module.
+    """
+    conn.execute("DROP TABLE IF EXISTS {}".format(NEIGHBOURHOOD_RTREE))
+    try:
+        conn.execute("CREATE VIRTUAL TABLE {} USING rtree(id, min_lat, max_lat, min_long, max_long)".format(
+            NEIGHBOURHOOD_RTREE))
+    except sqlite3.OperationalError:
+        return False
+
+    conn.execute("INSERT INTO {} (id, min_lat, max_lat, min_long, max_long) \
+                  SELECT Neighbourhood_Id, Latitude, Latitude, Longitude, Longitude \
+                  FROM {} \
+                  WHERE Latitude IS NOT NULL AND Longitude IS NOT NULL".format(
+                      NEIGHBOURHOOD_RTREE, neighbourhood_dim.NEIGHBOURHOOD_DIM))
+    return conn.execute("SELECT COUNT(*) FROM {}".format(NEIGHBOURHOOD_RTREE)).fetchone()[0]
+
+
+def spatial_index_exists(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (NEIGHBOURHOOD_RTREE,)).fetchone() is not None
+
+
+@result_cache.cached("WITHIN_RADIUS")
+def query_within_radius(lat, long, radius_km, lower_limit, upper_limit, crime_type=None):
+    """ Get the incident totals of the neighbourhoods within radius_km of (lat, long) between the two years
+    (inclusive), of crime_type or of every crime type if it's None.
+
+    Returns a list of (Neighbourhood_Name, Latitude, Longitude, distance in km, incidents) rows ordered by distance.
+    """
+    rows = _query_box(_get_bounding_box(lat, long, radius_km), lower_limit, upper_limit, crime_type)
+    return _rows_within_radius(rows, lat, long, radius_km)
+
+
+@result_cache.cached("WITHIN_BOX")
+def query_within_box(south, west, north, east, lower_limit, upper_limit, crime_type=None):
+    """ Get the incident totals of the neighbourhoods within the bounding box between the two years (inclusive), of
+    crime_type or of every crime type if it's None.
+
+    Returns a list of (Neighbourhood_Name, Latitude, Longitude, incidents) rows ordered by incidents, most first.
+    """
+    rows = _query_box((south, west, north, east), lower_limit, upper_limit, crime_type)
+    return sorted(rows, key=lambda row: (-row[3], row[0]))
+
+
+@result_cache.cached("NEAREST")
+def query_nearest(lat, long, k, lower_limit, upper_limit, crime_type=None):
+    """ Get the incident totals of the k neighbourhoods nearest to (lat, long) between the two years (inclusive), of
+    crime_type or of every crime type if it's None.
+
+    Returns a list of (Neighbourhood_Name, Latitude, Longitude, distance in km, incidents) rows ordered by distance.
+    """
+    if k <= 0:
+        return []
+
+    radius_km = _NEAREST_START_RADIUS_KM
+    while True:
+        rows = _rows_within_radius(
+            _query_box(_get_bounding_box(lat, long, radius_km), lower_limit, upper_limit, crime_type),
+            lat, long, radius_km)
+        # Anything outside the circle is farther than everything in it, so the k nearest in it are the k nearest
+        if len(rows) >= k or radius_km >= _MAX_DISTANCE_KM:
+            return rows[:k]
+        radius_km *= 2
+
+
+def haversine_km(lat1, long1, lat2, long2):
+    """
+    Returns the great circle distance in km between two points given in degrees.
+    """
+    (lat1, long1, lat2, long2) = map(math.radians, (lat1, long1, lat2, long2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+    return 2 * _EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _get_bounding_box(lat, long, radius_km):
+    """
+    Returns the (south, west, north, east) box containing every point within radius_km of (lat, long).
+    """
+    lat_delta = radius_km / _KM_PER_DEGREE
+    # A degree of longitude shrinks with the cosine of the latitude, and is smallest at the edge closest to a pole
+    max_abs_lat = min(90.0, abs(lat) + lat_delta)
+    cos_lat = math.cos(math.radians(max_abs_lat))
+    long_delta = 180.0 if cos_lat <= 1e-9 else min(180.0, radius_km / (_KM_PER_DEGREE * cos_lat))
+    return (lat - lat_delta, long - long_delta, lat + lat_delta, long + long_delta)
+
+
+def _rows_within_radius(rows, lat, long, radius_km):
+    with_distances = [(n_name, n_lat, n_long, haversine_km(lat, long, n_lat, n_long), incidents)
+                      for (n_name, n_lat, n_long, incidents) in rows]
+    return sorted([row for row in with_distances if row[3] <= radius_km], key=lambda row: (row[3], row[0]))
+
+
+def _query_box(box, lower_limit, upper_limit, crime_type):
+    """
+    Returns a list of (Neighbourhood_Name, Latitude, Longitude, incidents) for every neighbourhood in the box.
+    """
+    conn = db_connection.get_connection()
+    if spatial_index_exists(conn) and rollups.rollups_are_fresh(conn):
+        return _query_box_with_index(conn, box, lower_limit, upper_limit, crime_type)
+    return _query_box_with_scan(conn, box, lower_limit, upper_limit, crime_type)
+
+
+def _query_box_with_index(conn, box, lower_limit, upper_limit, crime_type):
+    (south, west, north, east) = box
+    type_filter = "" if crime_type is None else "AND r.Crime_Type = ?"
+    params = (lower_limit, upper_limit) + (() if crime_type is None else (crime_type,)) + \
+        (north, south, east, west) * 2
+
+    # The call to string.format only substitutes hard coded table names and the crime type filter
+    return conn.execute("SELECT d.Neighbourhood_Name, d.Latitude, d.Longitude, COALESCE(SUM(r.total), 0) \
+                         FROM {rtree} t \
+                         INNER JOIN {dim} d ON d.Neighbourhood_Id = t.id \
+                         LEFT JOIN {rollup} r ON r.Neighbourhood_Id = t.id AND r.Year >= ? AND r.Year <= ? \
+                                                 {type_filter} \
+                         WHERE t.min_lat <= ? AND t.max_lat >= ? AND t.min_long <= ? AND t.max_long >= ? \
+                               AND d.Latitude <= ? AND d.Latitude >= ? AND d.Longitude <= ? AND d.Longitude >= ? \
+                         GROUP BY t.id".format(rtree=NEIGHBOURHOOD_RTREE, dim=neighbourhood_dim.NEIGHBOURHOOD_DIM,
+                                               rollup=rollups.ROLLUP_YEAR_CRIME_TYPE_NEIGHBOURHOOD,
+                                               type_filter=type_filter), params).fetchall()
+
+
+def _query_box_with_scan(conn, box, lower_limit, upper_limit, crime_type):
+    (south, west, north, east) = box
+    in_box = [(n_name, lat, long) for (n_name, lat, long) in conn.execute(
+                  "SELECT Neighbourhood_Name, Latitude, Longitude FROM coordinates \
+                   WHERE Latitude IS NOT NULL AND Longitude IS NOT NULL")
+              if south <= lat <= north and west <= long <= east]
+
+    type_filter = "" if crime_type is None else "AND Crime_Type = ?"
+    totals = {}
+    for i in range(0, len(in_box), _NAMES_PER_QUERY):
+        names = [n_name for (n_name, _, _) in in_box[i:i + _NAMES_PER_QUERY]]
+        params = [lower_limit, upper_limit] + ([] if crime_type is None else [crime_type]) + names
+        # The call to string.format only substitutes the crime type filter and one placeholder per name
+        totals.update(conn.execute("SELECT Neighbourhood_Name, SUM(Incidents_Count) \
+                                    FROM crime_incidents \
+                                    WHERE Year >= ? AND Year <= ? {} AND Neighbourhood_Name IN ({}) \
+                                    GROUP BY Neighbourhood_Name".format(type_filter, ", ".join("?" * len(names))),
+                                   params).fetchall())
+
+    return [(n_name, lat, long, totals.get(n_name, 0)) for (n_name, lat, long) in in_box]
+
@@ -0,0 +1,59 @@
+# Top N with ties, in a single query.
+#
+# Q2, Q3 and Q4 all want "the top N rows, plus any rows tied with the Nth". Rather than running the aggregation once
+# with a LIMIT to find the Nth value and again with a HAVING filter to catch the ties, the query is wrapped so that
+# RANK() does both in one pass.
+
+
+ASC = "ASC"
+DESC = "DESC"
+
+
+def query_top_n_with_ties(conn, query, params, order_col, n, direction=DESC):
+    """ Run query and return its top n rows ordered by order_col, including any rows tied with the nth row.
+
+    :param query: A SELECT statement with an output column named order_col. It must not end with an ORDER BY/LIMIT.
+    :param params: The parameters for query.
+    :param order_col: The name of the column to rank by. Must be a hard coded name, it is formatted into the query.
+    :param n: The number of rows wanted. If there are fewer than n rows, every row is returned. If n is 0, no rows are.
+    :param direction: DESC for the largest n values, ASC for the smallest.
+    """
+    if direction not in (ASC, DESC):
+        raise ValueError("direction must be ASC or DESC (got {})".format(direction))
+
+    if n <= 0:
+        return []
+
+    # Rows that tie share a rank, and the rank after a tie skips ahead, so "rank <= n" keeps exactly the top n rows
+    # and everything tied with the nth.
+    rows = conn.execute("SELECT * \
+                         FROM ( \
+                             SELECT *, RANK() OVER (ORDER BY {col} {dir}) AS top_n_rank \
+                             FROM ({query}) \
+                         ) \
+                         WHERE top_n_rank <= ? \
+                         ORDER BY top_n_rank".format(col=order_col, dir=direction, query=query),
+                        tuple(params) + (n,)).fetchall()
+
+    # Drop the rank column
+    return [row[:-1] for row in rows]
+
+
+def top_n_rows_with_ties(rows, key, n, direction=DESC):
+    """ The Python version of query_top_n_with_ties, for rows that were already computed.
+
+    Returns the top n rows ordered by key(row), including any rows tied with the nth row.
+    """
+    if direction not in (ASC, DESC):
+        raise ValueError("direction must be ASC or DESC (got {})".format(direction))
+
+    if n <= 0:
+        return []
+
+    descending = direction == DESC
+    ordered = sorted(rows, key=key, reverse=descending)
+    if n >= len(ordered):
+        return ordered
+
+    nth_val = key(ordered[n - 1])
+    return [row for row in ordered if (key(row) >= nth_val if descending else key(row) <= nth_val)]
@@ -0,0 +1,164 @@
+# Trend and anomaly analysis of every neighbourhood x crime type at once.
+#
+# The incidents are turned into a cube of monthly counts with one row per (neighbourhood, crime type) series that has
+# any incidents and one column per month from the first year's January to the last incident's month, zero filled.
+# Every statistic is then computed for all the series together with cumulative sums along the months, so the cost is a
+# few passes over the cube no matter how many series there are:
+#   - the rolling average of the last window months (including the month itself),
+#   - the change from the same month of the year before,
+#   - a z-score of the month against the series' own history, the history months before it.
+#
+# A month is only scored once its series has at least min_history months of history before it. The standard deviation
+# of the history is floored at _MIN_STD incidents, so that a series that never varied (ex. always 0) doesn't make any
+# change to it infinitely anomalous.
+
+import numpy as np
+
+
+DEFAULT_WINDOW_MONTHS = 12
+DEFAULT_HISTORY_MONTHS = 24
+DEFAULT_MIN_HISTORY_MONTHS = 12
+DEFAULT_MIN_ABS_Z = 3.0
+
+_MIN_STD = 1.0
+
+
+'''
+Monthly incident counts of every (neighbourhood, crime type) series with any incidents.
+'''
+class TrendCube:
+    def __init__(self, neigh_names, crime_types, lat, long, series_neigh, series_type, first_year, counts):
+        # Dictionaries and coordinates of the ColumnarEngine the cube was built from (NaN for no coordinates)
+        self.neigh_names = neigh_names
+        self.crime_types = crime_types
+        self.lat = lat
+        self.long = long
+
+        # Per series: its neighbourhood and crime type codes
+        self.series_neigh = series_neigh
+        self.series_type = series_type
+
+        # float64 array of (series, month), month 0 being January of first_year
+        self.first_year = first_year
+        self.counts = counts
+
+    @staticmethod
+    def from_engine(engine):
+        """
+        Builds the cube from the incident columns of a ColumnarEngine (see columnar_engine.py).
+        """
+        num_types = max(1, len(engine.crime_types))
+        if len(engine.year) == 0:
+            return TrendCube(engine.neigh_names, engine.crime_types, engine.lat, engine.long,
+                             np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0, np.zeros((0, 0)))
+
+        first_year = int(engine.year.min())
+        months = (engine.year.astype(np.int64) - first_year) * 12 + engine.month.astype(np.int64) - 1
+        num_months = int(months.max()) + 1
+
+        series_keys = engine.neigh.astype(np.int64) * num_types + engine.crime_type
+        (unique_keys, series) = np.unique(series_keys, return_inverse=True)
+
+        counts = np.bincount(series * num_months + months, weights=engine.count,
+                             minlength=len(unique_keys) * num_months).reshape(len(unique_keys), num_months)
+        return TrendCube(engine.neigh_names, engine.crime_types, engine.lat, engine.long, unique_keys // num_types,
+                         unique_keys % num_types, first_year, counts)
+
+    def num_series(self):
+        return self.counts.shape[0]
+
+    def num_months(self):
+        return self.counts.shape[1]
+
+    def get_year_month(self, month):
+        return (self.first_year + month // 12, month % 12 + 1)
+
+
+'''
+The statistics of every series and month of a TrendCube, each a float64 array of (series, month). NaN where a month
+has no value (ex. no year before it, or not enough history to be scored).
+'''
+class Trends:
+    def __init__(self, rolling_avg, yoy_change, expected, z_score):
+        self.rolling_avg = rolling_avg
+        self.yoy_change = yoy_change
+        # The mean of the month's history, what the z-score compares the month to
+        self.expected = expected
+        self.z_score = z_score
+
+
+def compute_trends(cube, window=DEFAULT_WINDOW_MONTHS, history=DEFAULT_HISTORY_MONTHS,
+                   min_history=DEFAULT_MIN_HISTORY_MONTHS):
+    """
+    Returns the Trends of every series and month of the cube.
+    """
+    counts = cube.counts
+    num_months = cube.num_months()
+    month_idxs = np.arange(num_months)
+
+    # sums[:, t] is the sum of the months before t, so the sum of months [a, b) is sums[:, b] - sums[:, a]
+    sums = np.zeros((cube.num_series(), num_months + 1))
+    np.cumsum(counts, axis=1, out=sums[:, 1:])
+    squared_sums = np.zeros_like(sums)
+    np.cumsum(counts * counts, axis=1, out=squared_sums[:, 1:])
+
+    # The rolling window ends with the month itself
+    window_starts = np.maximum(month_idxs + 1 - window, 0)
+    rolling_avg = (sums[:, month_idxs + 1] - sums[:, window_starts]) / (month_idxs + 1 - window_starts)
+
+    yoy_change = np.full(counts.shape, np.nan)
+    yoy_change[:, 12:] = counts[:, 12:] - counts[:, :-12]
+
+    # The history ends with the month before
+    history_starts = np.maximum(month_idxs - history, 0)
+    history_lens = month_idxs - history_starts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = (sums[:, month_idxs] - sums[:, history_starts]) / history_lens
+        variance = (squared_sums[:, month_idxs] - squared_sums[:, history_starts]) / history_lens - expected ** 2
+    std = np.maximum(np.sqrt(np.maximum(variance, 0)), _MIN_STD)
+
+    scored = history_lens >= max(1, min_history)
+    expected[:, ~scored] = np.nan
+    z_score = (counts - expected) / std
+
+    return Trends(rolling_avg, yoy_change, expected, z_score)
+
+
+def top_anomalies(cube, trends, lower_limit, upper_limit, n, min_abs_z=DEFAULT_MIN_ABS_Z):
+    """ Find the n scored months between the two years (inclusive) of any series with the highest absolute z-scores
+    of at least min_abs_z, or every one of them if n is None.
+
+    Returns a list of (Neighbourhood_Name, Crime_Type, Year, Month, incidents, expected, z-score, rolling average,
+    change from the year before, Latitude, Longitude) rows ordered by absolute z-score, highest first. The coordinates
+    are None for neighbourhoods without any.
+    """
+    first_month = max(0, (lower_limit - cube.first_year) * 12)
+    last_month = min(cube.num_months(), (upper_limit - cube.first_year + 1) * 12)
+    if last_month <= first_month or cube.num_series() == 0:
+        return []
+
+    abs_z = np.abs(trends.z_score[:, first_month:last_month])
+    (series, months) = np.nonzero(abs_z >= min_abs_z)
+    scores = abs_z[series, months]
+    months += first_month
+
+    if n is not None and n < len(scores):
+        kept = np.argpartition(-scores, n - 1)[:n] if n > 0 else np.empty(0, dtype=np.int64)
+        (series, months, scores) = (series[kept], months[kept], scores[kept])
+    # Highest first, and the same order every run for equal scores
+    order = np.lexsort((months, series, -scores))
+
+    rows = []
+    for (s, t) in zip(series[order], months[order]):
+        neigh = cube.series_neigh[s]
+        (year, month) = cube.get_year_month(t)
+        has_coords = not np.isnan(cube.lat[neigh])
+        rows.append((cube.neigh_names[neigh], cube.crime_types[cube.series_type[s]], int(year), int(month),
+                     int(cube.counts[s, t]), float(trends.expected[s, t]), float(trends.z_score[s, t]),
+                     float(trends.rolling_avg[s, t]), _to_optional_float(trends.yoy_change[s, t]),
+                     float(cube.lat[neigh]) if has_coords else None, float(cube.long[neigh]) if has_coords else None))
+    return rows
+
+
+def _to_optional_float(val):
+    return None if np.isnan(val) else float(val)
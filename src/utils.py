@@ -1,5 +1,6 @@
 # Various util functions
 
+import math
 import os.path
 
 '''
@@ -38,6 +39,32 @@ def try_parse_int(string):
         return False
 
 
+'''
+Get a decimal number input and prints an errors if it got something else.
+Returns False if parsing failed.
+'''
+def input_float(input_msg):
+    user_input = input(input_msg)
+    res = try_parse_float(user_input)
+
+    if res is False:
+        print("Cannot parse \"{}\" into a number.".format(user_input))
+
+    return res
+
+
+'''
+Tries to parse a string to a finite float.
+Returns False on failure.
+'''
+def try_parse_float(string):
+    try:
+        res = float(string)
+    except Exception:
+        return False
+    return res if math.isfinite(res) else False
+
+
 '''
 Prints an error in a common format.
 '''